@@ -0,0 +1,489 @@
+# -*- coding: utf-8 -*-
+"""Micro-benchmarks for the script hosting engine in bot.py.
+
+Usage: python benchmarks.py <name> [count]
+Run `python benchmarks.py` to list the available benchmarks.
+"""
+import json
+import os
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import psutil
+
+import bot
+
+
+def _wait_for_files(paths, timeout=120):
+    deadline = time.time() + timeout
+    pending = set(paths)
+    done = {}
+    while pending and time.time() < deadline:
+        for path in list(pending):
+            if os.path.exists(path):
+                done[path] = time.time()
+                pending.discard(path)
+        time.sleep(0.005)
+    return done
+
+
+def bench_zygote(count=10):
+    """Start latency and private memory (USS) of scripts: plain Popen vs zygote fork."""
+    work_dir = tempfile.mkdtemp(prefix='bench_zygote_')
+    imports = ', '.join(m for m in bot.ZYGOTE_PRELOAD_MODULES if _importable(m)) or 'json'
+    script_path = os.path.join(work_dir, 'script.py')
+    with open(script_path, 'w') as f:
+        f.write(f"import os, sys, time\nimport {imports}\nopen(f'{{sys.argv[0]}}.{{os.getpid()}}.ready', 'w').close()\ntime.sleep(600)\n")
+    print(f"Script imports: {imports}; {count} scripts per mode")
+    if not bot.start_zygote():
+        print("Zygote could not be started; only Popen numbers are meaningful.")
+
+    results = {}
+    for mode in ('popen', 'zygote'):
+        if mode == 'zygote' and not bot.zygote_available():
+            continue
+        procs, latencies = [], []
+        for i in range(count):
+            log_path = os.path.join(work_dir, f'{mode}_{i}.log')
+            started = time.time()
+            if mode == 'popen':
+                with open(log_path, 'w') as log_file:
+                    proc = subprocess.Popen([sys.executable, script_path], cwd=work_dir, stdout=log_file, stderr=log_file)
+            else:
+                proc = bot.zygote_spawn(script_path, work_dir, log_path, {}, None)
+            marker = f"{script_path}.{proc.pid}.ready"
+            ready = _wait_for_files([marker])
+            if marker in ready:
+                latencies.append(ready[marker] - started)
+            procs.append(proc)
+        uss = []
+        for proc in procs:
+            try:
+                uss.append(psutil.Process(proc.pid).memory_full_info().uss)
+            except (psutil.Error, OSError):
+                pass
+        for proc in procs:
+            proc.kill()
+        for proc in procs:
+            try:
+                proc.wait(timeout=5)
+            except Exception:
+                pass
+        results[mode] = (latencies, uss)
+        print(f"{mode:>7}: start median {statistics.median(latencies) * 1000:8.1f} ms, "
+              f"max {max(latencies) * 1000:8.1f} ms, "
+              f"USS/script {statistics.mean(uss) / 1024 / 1024 if uss else 0:6.1f} MB")
+    bot.stop_zygote()
+    if 'popen' in results and 'zygote' in results and results['zygote'][0]:
+        speedup = statistics.median(results['popen'][0]) / statistics.median(results['zygote'][0])
+        print(f"Zygote start-up speedup: {speedup:.1f}x")
+
+
+def _spawn_dummy_scripts(work_dir, count, stubborn_every):
+    script_path = os.path.join(tempfile.mkdtemp(dir=work_dir), 'dummy.py')
+    with open(script_path, 'w') as f:
+        f.write("import signal, sys, time\n"
+                "if sys.argv[1] == '1':\n    signal.signal(signal.SIGTERM, signal.SIG_IGN)\n"
+                "open(f'{sys.argv[0]}.{sys.argv[2]}.ready', 'w').close()\n"
+                "time.sleep(3600)\n")
+    infos = []
+    for i in range(count):
+        stubborn = '1' if stubborn_every and i % stubborn_every == 0 else '0'
+        proc = subprocess.Popen([sys.executable, script_path, stubborn, str(i)], cwd=work_dir,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+        infos.append({'process': proc, 'pgid': proc.pid, 'script_key': f'bench_{i}', 'file_name': f'dummy_{i}.py'})
+    _wait_for_files([f"{script_path}.{i}.ready" for i in range(count)])
+    return infos
+
+
+def bench_shutdown(count=50):
+    """Time to stop N dummy scripts (every 10th ignores SIGTERM): one at a time vs terminate_scripts bulk."""
+    work_dir = tempfile.mkdtemp(prefix='bench_shutdown_')
+    print(f"{count} scripts, grace period {bot.SHUTDOWN_GRACE_SECONDS}s")
+    for mode in ('serial', 'bulk'):
+        infos = _spawn_dummy_scripts(work_dir, count, 10)
+        started = time.time()
+        if mode == 'serial':
+            for info in infos:
+                bot.terminate_scripts([info])
+        else:
+            bot.terminate_scripts(infos)
+        elapsed = time.time() - started
+        leftovers = sum(1 for info in infos if info['process'].poll() is None)
+        print(f"{mode:>7}: {elapsed:7.2f}s total, {elapsed / count * 1000:7.1f} ms/script, still running: {leftovers}")
+
+
+def bench_requirements(count=30):
+    """Checking a requirements.txt of N installed packages: `pip show` per line vs the cached distribution index."""
+    names = sorted(bot._build_installed_index())[:count]
+    req_path = os.path.join(tempfile.mkdtemp(prefix='bench_req_'), 'requirements.txt')
+    with open(req_path, 'w') as f:
+        f.write('\n'.join(names) + '\n')
+    print(f"requirements.txt with {len(names)} installed packages")
+
+    started = time.time()
+    for name in names:
+        subprocess.run([sys.executable, '-m', 'pip', 'show', name], capture_output=True, text=True, check=False)
+    pip_show = time.time() - started
+    print(f"pip show: {pip_show:8.2f}s")
+
+    bot.invalidate_installed_index()
+    started = time.time()
+    bot.get_installed_index()
+    built = time.time() - started
+    started = time.time()
+    with open(req_path) as f:
+        found = sum(bot.check_package_installed(line.strip()) for line in f if line.strip())
+    lookups = time.time() - started
+    print(f"   index: {built * 1000:8.2f} ms to build, {lookups * 1000:.3f} ms for {len(names)} lookups ({found} found)")
+    print(f"Speedup: {pip_show / (built + lookups):.0f}x")
+
+
+VENV_BENCH_PACKAGES = ['requests', 'flask', 'aiohttp', 'httpx', 'pyyaml', 'python-dateutil', 'pytz', 'six', 'attrs',
+                       'click', 'jinja2', 'beautifulsoup4', 'pillow', 'numpy', 'psutil', 'tqdm', 'colorama',
+                       'python-dotenv', 'pydantic', 'packaging']
+
+
+def _extra_disk(path):
+    """Bytes under path that are not shared with another link (hardlinked store files count once, elsewhere)."""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            st = os.lstat(os.path.join(root, name))
+            if st.st_nlink == 1:
+                total += st.st_blocks * 512
+    return total
+
+
+def bench_venv(count=3):
+    """Provisioning N user venvs with ~20 common packages: first (cold store) vs the rest, and disk per venv."""
+    bot.VENVS_DIR = tempfile.mkdtemp(prefix='bench_venvs_')
+    bot.PACKAGE_STORE_DIR = tempfile.mkdtemp(prefix='bench_store_')
+    print(f"{count} venvs, {len(VENV_BENCH_PACKAGES)} requirements each")
+    for user_id in range(1, count + 1):
+        started = time.time()
+        result = bot.install_into_venv(user_id, VENV_BENCH_PACKAGES)
+        elapsed = time.time() - started
+        venv_dir = bot.get_user_venv_dir(user_id)
+        print(f"venv {user_id}: {elapsed:7.2f}s, {len(result['installed'])} distributions, ok={result['ok']}, "
+              f"own disk {_extra_disk(venv_dir) / 1024 / 1024:6.1f} MB")
+    store_size = sum(os.lstat(os.path.join(root, name)).st_blocks * 512
+                     for root, _, files in os.walk(bot.PACKAGE_STORE_DIR) for name in files)
+    print(f"store: {store_size / 1024 / 1024:.1f} MB shared by all venvs")
+
+
+def _db_ops(mode, db_path, lock):
+    """write(i) and read(i) for one storage mode: the old connect-per-operation pattern or the pooled connections."""
+    insert = 'INSERT OR REPLACE INTO user_files (user_id, file_name, file_type) VALUES (?, ?, ?)'
+    select = 'SELECT file_name, file_type FROM user_files WHERE user_id = ?'
+    if mode == 'connect':
+        def write(i):
+            with lock:
+                conn = sqlite3.connect(db_path, check_same_thread=False)
+                conn.execute(insert, (i % 1000, f'bot_{i}.py', 'py'))
+                conn.commit()
+                conn.close()
+
+        def read(i):
+            conn = sqlite3.connect(db_path, check_same_thread=False)
+            conn.execute(select, (i % 1000,)).fetchall()
+            conn.close()
+    else:
+        def write(i):
+            with bot.db_writer() as conn:
+                conn.execute(insert, (i % 1000, f'bot_{i}.py', 'py'))
+                conn.commit()
+
+        def read(i):
+            with bot.db_reader() as conn:
+                conn.execute(select, (i % 1000,)).fetchall()
+    return write, read
+
+
+def bench_db(count=2000, readers=4):
+    """SQLite ops/sec: connect/commit/close per operation (rollback journal) vs pooled WAL connections."""
+    work_dir = tempfile.mkdtemp(prefix='bench_db_')
+    print(f"{count} writes; then {count} writes with {readers} reader threads running")
+    for mode in ('connect', 'pooled'):
+        db_path = os.path.join(work_dir, f'{mode}.db')
+        bot.close_db_connections()
+        bot.DATABASE_PATH = db_path
+        if mode == 'connect':
+            conn = sqlite3.connect(db_path)
+            conn.execute('CREATE TABLE user_files (user_id INTEGER, file_name TEXT, file_type TEXT, PRIMARY KEY (user_id, file_name))')
+            conn.close()
+        else:
+            bot.init_db()
+        write, read = _db_ops(mode, db_path, threading.Lock())
+
+        started = time.time()
+        for i in range(count):
+            write(i)
+        write_rate = count / (time.time() - started)
+
+        stop = threading.Event()
+        reads = [0] * readers
+
+        def reader(slot):
+            i = 0
+            while not stop.is_set():
+                read(i)
+                i += 1
+            reads[slot] = i
+        threads = [threading.Thread(target=reader, args=(n,)) for n in range(readers)]
+        for thread in threads:
+            thread.start()
+        started = time.time()
+        for i in range(count):
+            write(count + i)
+        elapsed = time.time() - started
+        stop.set()
+        for thread in threads:
+            thread.join()
+        print(f"{mode:>8}: writes {write_rate:8.0f}/s alone, {count / elapsed:8.0f}/s with readers; "
+              f"reads {sum(reads) / elapsed:8.0f}/s")
+    bot.close_db_connections()
+
+
+def bench_db_writes(count=5000, threads=8):
+    """Handler-side cost of add_active_user/save_user_file from N threads: DB_WRITE_MODE sync vs batched."""
+    work_dir = tempfile.mkdtemp(prefix='bench_db_writes_')
+    bot.logger.setLevel('WARNING')
+    print(f"{count} writes from {threads} threads (half repeats of the same rows)")
+    for mode in ('sync', 'batched'):
+        bot.close_db_connections()
+        bot.DATABASE_PATH = os.path.join(work_dir, f'{mode}.db')
+        bot.DB_WRITE_MODE = mode
+        bot.init_db()
+        bot.active_users.clear()
+
+        def worker(offset):
+            for i in range(offset, count, threads):
+                bot.save_user_file(i % (count // 2), 'bot.py')
+                bot.active_users.discard(i)  # force the write path every time
+                bot.add_active_user(i)
+        started = time.time()
+        workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        handler_time = time.time() - started
+        bot.flush_db_writes()
+        total = time.time() - started
+        stats = dict(bot.db_write_stats)
+        print(f"{mode:>8}: {2 * count / handler_time:8.0f} writes/s seen by handlers, {total:6.2f}s until durable; "
+              f"{stats['batches']} batches, {stats['coalesced']} coalesced")
+        for key in stats:
+            bot.db_write_stats[key] = 0
+    bot.close_db_connections()
+
+
+def _make_state_db(path, users):
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE subscriptions (user_id INTEGER PRIMARY KEY, expiry TEXT);
+        CREATE TABLE user_files (user_id INTEGER, file_name TEXT, file_type TEXT, PRIMARY KEY (user_id, file_name));
+        CREATE TABLE active_users (user_id INTEGER PRIMARY KEY);
+    """)
+    base = 5_000_000_000
+    conn.executemany('INSERT INTO active_users VALUES (?)', ((base + i,) for i in range(users)))
+    conn.executemany('INSERT INTO user_files VALUES (?, ?, ?)',
+                     ((base + i, f'bot_{j}.py', 'py') for i in range(0, users, 2) for j in range(3)))
+    conn.executemany('INSERT INTO subscriptions VALUES (?, ?)',
+                     ((base + i, '2030-01-01T00:00:00') for i in range(0, users, 10)))
+    conn.commit()
+    conn.close()
+
+
+def _startup_child(mode, db_path):
+    """Runs in a fresh interpreter: load user state the old way (everything) or the lazy way, print JSON."""
+    process = psutil.Process()
+    rss_before = process.memory_info().rss
+    started = time.time()
+    if mode == 'eager':
+        conn = sqlite3.connect(db_path)
+        subscriptions, files, users = {}, {}, set()
+        for user_id, expiry in conn.execute('SELECT user_id, expiry FROM subscriptions'):
+            subscriptions[user_id] = {'expiry': bot.datetime.fromisoformat(expiry)}
+        for user_id, file_name, file_type in conn.execute('SELECT user_id, file_name, file_type FROM user_files'):
+            files.setdefault(user_id, []).append((file_name, file_type))
+        users.update(user_id for (user_id,) in conn.execute('SELECT user_id FROM active_users'))
+        totals = (len(users), sum(len(f) for f in files.values()))
+    else:
+        bot.close_db_connections()
+        bot.DATABASE_PATH = db_path
+        for state in (bot.user_files, bot.user_subscriptions, bot.active_users):
+            state.reset()
+        bot.init_db()
+        bot.load_data()
+        totals = (len(bot.active_users), bot.user_files.total_records)  # what /statistics needs
+    startup = time.time() - started
+    print(json.dumps({'startup': startup, 'rss': process.memory_info().rss - rss_before, 'totals': totals}))
+
+
+def bench_startup():
+    """State load time and RSS at 10k/100k/1M synthetic users: eager load_data() vs lazy paging."""
+    work_dir = tempfile.mkdtemp(prefix='bench_startup_')
+    for users in (10_000, 100_000, 1_000_000):
+        db_path = os.path.join(work_dir, f'{users}.db')
+        _make_state_db(db_path, users)
+        for mode in ('eager', 'lazy'):
+            code = f"import benchmarks; benchmarks._startup_child({mode!r}, {db_path!r})"
+            out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                                 cwd=os.path.dirname(os.path.abspath(__file__)))
+            result = json.loads(out.stdout.strip().splitlines()[-1])
+            print(f"{users:>9} users {mode:>6}: {result['startup'] * 1000:9.1f} ms, "
+                  f"+{result['rss'] / 1024 / 1024:7.1f} MB RSS, totals {result['totals']}")
+
+
+def bench_state(users=1_000_000):
+    """Memory and lookup cost of active users and file records: set/dict of lists vs UserIdSet/UserFileIndex."""
+    import random
+    import tracemalloc
+    work_dir = tempfile.mkdtemp(prefix='bench_state_')
+    db_path = os.path.join(work_dir, 'state.db')
+    _make_state_db(db_path, users)
+    bot.close_db_connections()
+    bot.DATABASE_PATH = db_path
+    bot.init_db()
+    for state in (bot.user_files, bot.active_users):
+        state.reset()
+    conn = sqlite3.connect(db_path)
+    tracemalloc.start()
+
+    def measure(build):
+        before = tracemalloc.get_traced_memory()[0]
+        value = build()
+        return value, tracemalloc.get_traced_memory()[0] - before
+
+    old_users, old_users_bytes = measure(lambda: {user_id for (user_id,) in conn.execute('SELECT user_id FROM active_users')})
+
+    def new_users_build():
+        0 in bot.active_users  # the first membership test loads the array
+        return bot.active_users
+    new_users, new_users_bytes = measure(new_users_build)
+
+    def old_files_build():
+        files = {}
+        for user_id, file_name, file_type in conn.execute('SELECT user_id, file_name, file_type FROM user_files ORDER BY rowid'):
+            files.setdefault(user_id, []).append((file_name, file_type))
+        return files
+    old_files, old_files_bytes = measure(old_files_build)
+    new_files, new_files_bytes = measure(bot._load_all_user_files)
+    tracemalloc.stop()
+    records = sum(len(f) for f in old_files.values())
+    print(f"{users} active users: set {old_users_bytes / 1024 / 1024:7.1f} MB, "
+          f"UserIdSet {new_users_bytes / 1024 / 1024:7.1f} MB")
+    print(f"{records} file records: dict of lists {old_files_bytes / 1024 / 1024:7.1f} MB, "
+          f"dict of dicts {new_files_bytes / 1024 / 1024:7.1f} MB (only STATE_CACHE_USERS of them are resident)")
+
+    base = 5_000_000_000
+    probes = [(base + 2 * random.randrange(min(users, 2 * bot.STATE_CACHE_USERS) // 2), f'bot_{random.randrange(4)}.py')
+              for _ in range(100_000)]
+    for user_id, _ in probes:
+        bot.user_files.get(user_id)  # warm the LRU so both sides are in-memory lookups
+    timings = {}
+    started = time.perf_counter()
+    for user_id, file_name in probes:
+        next((f[1] for f in old_files.get(user_id, []) if f[0] == file_name), None)
+    timings['scan'] = time.perf_counter() - started
+    started = time.perf_counter()
+    for user_id, file_name in probes:
+        bot.user_files.file_type(user_id, file_name)
+    timings['index'] = time.perf_counter() - started
+    started = time.perf_counter()
+    for user_id, _ in probes:
+        user_id in old_users
+    timings['set'] = time.perf_counter() - started
+    started = time.perf_counter()
+    for user_id, _ in probes:
+        user_id in new_users
+    timings['bisect'] = time.perf_counter() - started
+    print("per lookup: " + ", ".join(f"{name} {seconds / len(probes) * 1e6:.2f} us" for name, seconds in timings.items()))
+    conn.close()
+    bot.close_db_connections()
+
+
+def bench_backup(rows=300_000):
+    """Writer latency (DB_WRITE_MODE=sync) while idle and during an online backup, per pages-per-step setting."""
+    work_dir = tempfile.mkdtemp(prefix='bench_backup_')
+    bot.logger.setLevel('WARNING')
+    bot.close_db_connections()
+    bot.DATABASE_PATH = os.path.join(work_dir, 'bot_data.db')
+    bot.BACKUP_DIR = os.path.join(work_dir, 'backups')
+    os.makedirs(bot.BACKUP_DIR)
+    bot.DB_WRITE_MODE = 'sync'
+    bot.init_db()
+    with bot.db_writer() as conn:
+        conn.executemany('INSERT INTO user_files VALUES (?, ?, ?)',
+                         ((i, f'bot_{j}.py', 'py') for i in range(rows // 3) for j in range(3)))
+        conn.commit()
+    print(f"{os.path.getsize(bot.DATABASE_PATH) / 1024 / 1024:.1f} MB database, {rows} rows")
+
+    def write_latencies(during):
+        latencies, stop = [], threading.Event()
+
+        def writer():
+            i = 0
+            while not stop.is_set():
+                started = time.perf_counter()
+                bot.save_user_file(10_000_000 + i, 'bot.py')
+                latencies.append(time.perf_counter() - started)
+                i += 1
+        thread = threading.Thread(target=writer)
+        thread.start()
+        result = during()
+        stop.set()
+        thread.join()
+        latencies.sort()
+        return result, latencies
+
+    def describe(latencies):
+        return (f"{len(latencies):6} writes, p50 {latencies[len(latencies) // 2] * 1000:6.2f} ms, "
+                f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:6.2f} ms, max {latencies[-1] * 1000:6.2f} ms")
+
+    _, latencies = write_latencies(lambda: time.sleep(1))
+    print(f"{'idle':>24}: {describe(latencies)}")
+    for pages in (64, 256, -1):
+        bot.BACKUP_PAGES_PER_STEP = pages
+        metrics, latencies = write_latencies(lambda: bot.backup_database('bench'))
+        label = f"backup, {pages if pages > 0 else 'all'} pages/step"
+        print(f"{label:>24}: {describe(latencies)}; backup {metrics['duration_ms']:6.0f} ms, "
+              f"{metrics['steps']} steps, longest {metrics['max_step_ms']:6.1f} ms")
+    bot.close_db_connections()
+
+
+def _importable(module_name):
+    try:
+        __import__(module_name)
+        return True
+    except ImportError:
+        return False
+
+
+BENCHMARKS = {
+    'zygote': bench_zygote,
+    'shutdown': bench_shutdown,
+    'requirements': bench_requirements,
+    'venv': bench_venv,
+    'db': bench_db,
+    'dbwrites': bench_db_writes,
+    'startup': bench_startup,
+    'state': bench_state,
+    'backup': bench_backup,
+}
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print(__doc__)
+        for name, func in BENCHMARKS.items():
+            print(f"  {name:<12} {func.__doc__}")
+        sys.exit(1)
+    args = [int(a) for a in sys.argv[2:]]
+    BENCHMARKS[sys.argv[1]](*args)
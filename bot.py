@@ -8,14 +8,44 @@ import shutil
 from telebot import types
 import time
 from datetime import datetime, timedelta
+from collections import deque, OrderedDict
+from collections.abc import MutableMapping, MutableSet
+from array import array
+from bisect import bisect_left
 import psutil
 import sqlite3
 import logging
 import threading
 import re
+import random
+import heapq
+import itertools
+import selectors
 import sys
 import atexit
+import contextlib
 import requests
+import functools
+import signal
+import socket
+import json
+import ast
+import urllib.parse
+import concurrent.futures
+import io
+import base64
+import importlib
+import importlib.util
+import importlib.metadata
+import importlib.machinery
+import hashlib
+import sysconfig
+import venv
+from packaging.requirements import Requirement, InvalidRequirement
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
 
 # --- Flask Keep Alive ---
 from flask import Flask
@@ -50,6 +80,22 @@ BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 UPLOAD_BOTS_DIR = os.path.join(BASE_DIR, 'upload_bots')
 IROTECH_DIR = os.path.join(BASE_DIR, 'inf')
 DATABASE_PATH = os.path.join(IROTECH_DIR, 'bot_data.db')
+# Online snapshots of the database (see Database Backup); BACKUP_INTERVAL_HOURS=0 disables scheduled ones
+BACKUP_DIR = os.path.join(IROTECH_DIR, 'backups')
+BACKUP_INTERVAL_HOURS = float(os.environ.get('BACKUP_INTERVAL_HOURS', '6'))
+BACKUP_KEEP = int(os.environ.get('BACKUP_KEEP', '8'))
+BACKUP_PAGES_PER_STEP = 256  # pages copied per backup step (1 MB with the default page size)
+BACKUP_STEP_SLEEP = 0.005  # pause between steps, in seconds
+# Local wheelhouse tried before PyPI for every install (OFFLINE_INSTALLS=1: never contact PyPI)
+WHEELHOUSE_ENABLED = os.environ.get('WHEELHOUSE', '1') == '1'
+WHEELHOUSE_DIR = os.path.join(BASE_DIR, 'wheelhouse')
+WHEELHOUSE_MAX_MB = int(os.environ.get('WHEELHOUSE_MAX_MB', '2048'))
+WHEELHOUSE_PREWARM = [p for p in os.environ.get('WHEELHOUSE_PREWARM', 'pyTelegramBotAPI,aiogram,requests').split(',') if p]
+OFFLINE_INSTALLS = os.environ.get('OFFLINE_INSTALLS', '0') == '1'
+# Per-user virtual environments, linked from a shared content-addressed package store
+USER_VENVS_ENABLED = os.environ.get('USER_VENVS', '1') == '1'
+VENVS_DIR = os.path.join(BASE_DIR, 'venvs')
+PACKAGE_STORE_DIR = os.path.join(BASE_DIR, 'package_store')
 
 # File upload limits
 FREE_USER_LIMIT = 10
@@ -57,20 +103,394 @@ SUBSCRIBED_USER_LIMIT = 30
 ADMIN_LIMIT = 999
 OWNER_LIMIT = float('inf')
 
+# Per-tier resource limits for hosted scripts (None = unlimited).
+# cpu: share of one core, memory_mb: RSS cap, pids: processes+threads, open_files: fd cap.
+# 'nice' is only used when cgroups v2 is unavailable and CPU share cannot be enforced.
+TIER_RESOURCE_LIMITS = {
+    'free': {'cpu': 0.25, 'memory_mb': 256, 'pids': 64, 'open_files': 256, 'nice': 10},
+    'subscribed': {'cpu': 1.0, 'memory_mb': 512, 'pids': 256, 'open_files': 1024, 'nice': 5},
+    'admin': {'cpu': 2.0, 'memory_mb': 1024, 'pids': 512, 'open_files': 4096, 'nice': 0},
+    'owner': {'cpu': None, 'memory_mb': None, 'pids': None, 'open_files': None, 'nice': 0},
+}
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+# Optional fork server: scripts fork from a warm interpreter with common libraries preloaded
+ZYGOTE_ENABLED = os.environ.get('ZYGOTE_ENABLED', '0') == '1'
+ZYGOTE_PRELOAD_MODULES = ['telebot', 'requests', 'aiohttp', 'pyrogram']
+
+# Worker agents (worker_agent.py) that can host scripts: "name=http://host:port,name2=...".
+# Empty means every script runs on this host, as before.
+WORKER_NODES = dict(item.split('=', 1) for item in os.environ.get('WORKER_NODES', '').split(',') if '=' in item)
+WORKER_TOKEN = os.environ.get('WORKER_TOKEN', '')
+RUN_SCRIPTS_LOCALLY = os.environ.get('RUN_SCRIPTS_LOCALLY', '1') == '1'
+WORKER_POLL_INTERVAL = 10  # seconds between /status polls of each worker
+WORKER_OFFLINE_AFTER = 60  # scripts on a worker silent this long are treated as lost
+LOCAL_NODE = 'local'
+
+# Background resource sampling of hosted scripts
+RESOURCE_SAMPLE_INTERVAL = 5  # seconds
+RESOURCE_SAMPLE_HISTORY = 60  # samples kept per script (ring buffer size)
+
+# Restart policy for crashed scripts ('never', 'on-failure', 'always')
+RESTART_POLICIES = ('never', 'on-failure', 'always')
+DEFAULT_RESTART_POLICY = 'on-failure'
+RESTART_BACKOFF_BASE = 5  # seconds before the first automatic restart
+RESTART_BACKOFF_MAX = 600
+RESTART_RESET_AFTER = 300  # a run at least this long clears the backoff
+CRASH_LOOP_MAX_FAILURES = 5  # failures within CRASH_LOOP_WINDOW that park a script
+CRASH_LOOP_WINDOW = 600
+RESTART_HISTORY_SIZE = 10
+
+# Grace period between SIGTERM and SIGKILL when stopping scripts (shared by all scripts in a bulk stop)
+SHUTDOWN_GRACE_SECONDS = 5
+
+# Health probes (configured per script with /health)
+HEALTH_PROBE_DEFAULT_TIMEOUTS = {'heartbeat': 120, 'log': 600, 'cpu': 300, 'http': 60}
+HEALTH_CHECK_INTERVAL = 15  # seconds between probe rounds
+CPU_STUCK_PERCENT = 95  # a 'cpu' probe fails when every sample in its window is at least this
+HEALTH_HTTP_TIMEOUT = 3
+
+# Orphan sweep: look for leaked processes running from user folders
+ORPHAN_SWEEP_INTERVAL = 300
+ORPHAN_MIN_AGE = 60
+
+# Admission control for script starts
+MAX_CONCURRENT_SCRIPTS = 300  # hosted processes allowed at once
+MAX_CONCURRENT_LAUNCHES = 4  # run_script calls in flight at once
+MIN_FREE_MEMORY_MB = 256  # memory headroom required to admit another script
+TIER_START_PRIORITY = {'owner': 0, 'admin': 1, 'subscribed': 2, 'free': 3}
+
+# Warm resume of scripts that were running before a restart/redeploy
+RESUME_STAGGER_SECONDS = 0.5
+RESUME_REPORT_TIMEOUT = 180
+
+# Subscription expiry: users are warned this many days ahead and downgraded at expiry.
+# Events due within EXPIRY_BATCH_SECONDS of each other are handled (and reported) together.
+SUBSCRIPTION_NOTICE_DAYS = 3
+EXPIRY_BATCH_SECONDS = 30
+EXPIRY_WINDOW_HOURS = 24  # only events this close are held in the expiry heap
+
 # Create necessary directories
 os.makedirs(UPLOAD_BOTS_DIR, exist_ok=True)
 os.makedirs(IROTECH_DIR, exist_ok=True)
+os.makedirs(VENVS_DIR, exist_ok=True)
+os.makedirs(PACKAGE_STORE_DIR, exist_ok=True)
+os.makedirs(WHEELHOUSE_DIR, exist_ok=True)
+os.makedirs(BACKUP_DIR, exist_ok=True)
+ZYGOTE_SOCKET_PATH = os.path.join(IROTECH_DIR, 'zygote.sock')
 
 # Initialize bot
 bot = telebot.TeleBot(TOKEN)
 
+# --- Lazy User State ---
+# Per-user records (files, subscriptions) are not loaded at startup. Each map
+# pages a user's rows in from SQLite on first access and keeps the
+# STATE_CACHE_USERS most recently used users (misses are cached too, so tier
+# checks for users without a subscription stay in memory). The maps only
+# hold state: the Database Operations functions still persist every change,
+# reading the current value before queueing the write so the counters see the
+# old value rather than a row that was just flushed.
+# Aggregates (users, file records) are counted once with SQL and then kept up
+# to date by the maps, so /statistics never needs every user in memory.
+# Files are indexed by (user, file name) so the button callbacks find one in
+# O(1). Active users are only ever tested for membership or iterated for a
+# broadcast, so they are a sorted int64 array (UserIdSet) rather than an LRU.
+STATE_CACHE_USERS = int(os.environ.get('STATE_CACHE_USERS', '10000'))
+_MISSING = object()
+
+def _read_state(query, params=()):
+    if _db_pending:
+        flush_db_writes()  # a queued write must not be shadowed by an older row
+    with db_reader() as conn:
+        return conn.execute(query, params).fetchall()
+
+class LazyUserMap(MutableMapping):
+    """dict-like {user_id: value} over a per-user table, paged in on demand with an LRU bound."""
+
+    def __init__(self, load_one, load_all, count_query, size=lambda value: 1):
+        self._load_one = load_one  # user_id -> value or _MISSING
+        self._load_all = load_all  # () -> {user_id: value}
+        self._count_query = count_query  # SELECT <users>, <records>
+        self._size = size
+        self._cache = OrderedDict()
+        self._lock = threading.RLock()
+        self._users = self._records = None
+        self.hits = self.misses = 0
+
+    def _lookup(self, user_id):
+        value = self._cache.get(user_id)
+        if value is not None:  # hit: lock-free, single OrderedDict calls are atomic under the GIL
+            try:
+                self._cache.move_to_end(user_id)
+            except KeyError:  # evicted by another thread in between
+                pass
+            self.hits += 1
+            return value
+        with self._lock:
+            value = self._cache.get(user_id)
+            if value is not None:
+                return value
+            self.misses += 1
+            value = self._load_one(user_id)
+            self._remember(user_id, value)
+            return value
+
+    def _remember(self, user_id, value):
+        self._cache[user_id] = value
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > STATE_CACHE_USERS:
+            self._cache.popitem(last=False)
+
+    def load_counts(self):
+        """Count users and records with SQL; from then on the counters are maintained in memory."""
+        with self._lock:
+            self._users, self._records = _read_state(self._count_query)[0]
+
+    def _ensure_counts(self):
+        if self._users is None:
+            self.load_counts()
+
+    def __getitem__(self, user_id):
+        value = self._lookup(user_id)
+        if value is _MISSING:
+            raise KeyError(user_id)
+        return value
+
+    def __setitem__(self, user_id, value):
+        with self._lock:
+            self._ensure_counts()
+            old = self._lookup(user_id)
+            if old is _MISSING:
+                self._users += 1
+            else:
+                self._records -= self._size(old)
+            self._records += self._size(value)
+            self._remember(user_id, value)
+
+    def __delitem__(self, user_id):
+        with self._lock:
+            self._ensure_counts()
+            old = self._lookup(user_id)
+            if old is _MISSING:
+                raise KeyError(user_id)
+            self._users -= 1
+            self._records -= self._size(old)
+            self._remember(user_id, _MISSING)
+
+    def __contains__(self, user_id):
+        return self._lookup(user_id) is not _MISSING
+
+    def __iter__(self):
+        return iter(self.snapshot())
+
+    def __len__(self):
+        with self._lock:
+            self._ensure_counts()
+            return self._users
+
+    @property
+    def total_records(self):
+        with self._lock:
+            self._ensure_counts()
+            return self._records
+
+    def snapshot(self):
+        """Every user's value, read straight from the DB (the LRU is left alone)."""
+        return self._load_all()
+
+    def reset(self):
+        with self._lock:
+            self._cache.clear()
+            self._users = self._records = None
+
+class UserFileIndex(LazyUserMap):
+    """user_files: {user_id: {file_name: file_type}} in upload order, so a (user, file) lookup or save is O(1).
+
+    The per-user dicts returned by get()/[] are the cached ones; change them only through set_file/remove_file.
+    """
+
+    def __init__(self):
+        super().__init__(_load_user_files, _load_all_user_files,
+                         'SELECT COUNT(DISTINCT user_id), COUNT(*) FROM user_files', size=len)
+
+    def file_type(self, user_id, file_name):
+        files = self._lookup(user_id)
+        return None if files is _MISSING else files.get(file_name)
+
+    def has_file(self, user_id, file_name):
+        return self.file_type(user_id, file_name) is not None
+
+    def set_file(self, user_id, file_name, file_type):
+        with self._lock:
+            self._ensure_counts()
+            files = self._lookup(user_id)
+            if files is _MISSING:
+                files = {}
+                self._users += 1
+                self._remember(user_id, files)
+            if files.pop(file_name, None) is None:  # a re-upload moves to the end, like a fresh one
+                self._records += 1
+            files[file_name] = file_type
+
+    def remove_file(self, user_id, file_name):
+        with self._lock:
+            self._ensure_counts()
+            files = self._lookup(user_id)
+            if files is _MISSING or files.pop(file_name, None) is None:
+                return False
+            self._records -= 1
+            if not files:
+                self._users -= 1
+                self._remember(user_id, _MISSING)
+            return True
+
+class UserIdSet(MutableSet):
+    """Set of user ids stored as a sorted array('q') plus a small buffer of recent inserts.
+
+    8 bytes per id instead of the ~60 of a set of ints, and membership is a bisect, so
+    /start never goes to the DB. The ids are read from `table` on first use; until then
+    len() answers from a SQL count. With `expires_column`, rows whose ISO timestamp in that
+    column has already passed are left out.
+    """
+    MERGE_AT = 4096  # buffered inserts before they are merged into the array
+
+    def __init__(self, table, expires_column=None):
+        self._table = table
+        self._expires_column = expires_column
+        self._ids = None
+        self._added = set()
+        self._count = None
+        self._lock = threading.RLock()
+
+    def _load(self):
+        if self._ids is None:
+            if _db_pending:
+                flush_db_writes()
+            ids = array('q')
+            where, params = self._where()
+            with db_reader() as conn:
+                cursor = conn.execute(f'SELECT user_id FROM {self._table}{where} ORDER BY user_id', params)
+                for rows in iter(lambda: cursor.fetchmany(10000), []):
+                    ids.extend(user_id for (user_id,) in rows)
+            self._ids = ids
+        return self._ids
+
+    def _where(self):
+        if self._expires_column is None:
+            return '', ()
+        return f' WHERE {self._expires_column} > ?', (datetime.now().isoformat(),)
+
+    def _index(self, user_id):
+        ids = self._ids
+        if ids is None:
+            with self._lock:
+                ids = self._load()
+        i = bisect_left(ids, user_id)
+        return i if i < len(ids) and ids[i] == user_id else -1
+
+    def __contains__(self, user_id):
+        # No lock: writers never change an array in place. They swap in a new one (merged before the buffer
+        # is cleared, so an id is always in one of them), and readers bisect whichever array they fetched.
+        return user_id in self._added or self._index(user_id) >= 0
+
+    def add(self, user_id):
+        with self._lock:
+            if user_id in self:
+                return
+            self._added.add(user_id)
+            if len(self._added) >= self.MERGE_AT:
+                self._ids = array('q', heapq.merge(self._ids, sorted(self._added)))
+                self._added.clear()
+
+    def discard(self, user_id):
+        with self._lock:
+            if user_id in self._added:
+                self._added.discard(user_id)
+            else:
+                i = self._index(user_id)
+                if i >= 0:
+                    self._ids = self._ids[:i] + self._ids[i + 1:]
+
+    def clear(self):
+        with self._lock:
+            self._ids = array('q')
+            self._added.clear()
+
+    def __len__(self):
+        with self._lock:
+            if self._ids is None:
+                if self._count is None:
+                    self.load_counts()
+                return self._count
+            return len(self._ids) + len(self._added)
+
+    def snapshot(self):
+        """All ids as a new sorted array('q'); safe to iterate while users keep arriving."""
+        with self._lock:
+            return array('q', heapq.merge(self._load(), sorted(self._added)))
+
+    def __iter__(self):
+        return iter(self.snapshot())
+
+    def nbytes(self):
+        with self._lock:
+            return (0 if self._ids is None else self._ids.buffer_info()[1] * self._ids.itemsize) + sys.getsizeof(self._added)
+
+    def load_counts(self):
+        with self._lock:
+            if self._ids is None:
+                where, params = self._where()
+                self._count = _read_state(f'SELECT COUNT(*) FROM {self._table}{where}', params)[0][0]
+
+    def reset(self):
+        with self._lock:
+            self._ids = self._count = None
+            self._added.clear()
+
+def _load_user_files(user_id):
+    rows = _read_state('SELECT file_name, file_type FROM user_files WHERE user_id = ? ORDER BY rowid', (user_id,))
+    return dict(rows) or _MISSING
+
+def _load_all_user_files():
+    files = {}
+    for user_id, file_name, file_type in _read_state('SELECT user_id, file_name, file_type FROM user_files ORDER BY rowid'):
+        files.setdefault(user_id, {})[file_name] = file_type
+    return files
+
+def _parse_subscription(user_id, expiry):
+    try:
+        return {'expiry': datetime.fromisoformat(expiry)}
+    except ValueError:
+        logger.warning(f"⚠️ Invalid expiry date format for user {user_id}: {expiry}. Skipping.")
+        return _MISSING
+
+def _load_subscription(user_id):
+    rows = _read_state('SELECT expiry FROM subscriptions WHERE user_id = ?', (user_id,))
+    return _parse_subscription(user_id, rows[0][0]) if rows else _MISSING
+
+def _load_all_subscriptions():
+    subscriptions = {}
+    for user_id, expiry in _read_state('SELECT user_id, expiry FROM subscriptions'):
+        value = _parse_subscription(user_id, expiry)
+        if value is not _MISSING:
+            subscriptions[user_id] = value
+    return subscriptions
+# --- End Lazy User State ---
+
 # --- Data structures ---
 bot_scripts = {}
-user_subscriptions = {}
-user_files = {}
-active_users = set()
+user_subscriptions = LazyUserMap(_load_subscription, _load_all_subscriptions, 'SELECT COUNT(*), COUNT(*) FROM subscriptions')
+# Precomputed tier: the expiry scheduler deletes rows when they expire. Rows that expired while the bot
+# was down are skipped at load, so they never count as subscribed before the scheduler catches up.
+subscribed_users = UserIdSet('subscriptions', expires_column='expiry')
+user_files = UserFileIndex()
+active_users = UserIdSet('active_users')
 admin_ids = {ADMIN_ID, OWNER_ID}
+script_restart_policies = {}
+script_restart_state = {}
+script_health_probes = {}
 bot_locked = False
+shutting_down = False
 
 # --- Logging Setup ---
 logging.basicConfig(level=logging.INFO,
@@ -93,26 +513,200 @@ ADMIN_COMMAND_BUTTONS_LAYOUT_USER_SPEC = [
     ["👑 Admin Panel", "📞 Contact Owner"]
 ]
 
+# --- Database Connections ---
+# One long-lived writer connection (writes are serialized by DB_LOCK, as
+# SQLite allows a single writer anyway) and a small pool of read-only
+# connections. In WAL mode readers never wait for the writer. Reusing
+# connections keeps the schema parsed and the statement cache warm, and with
+# synchronous=NORMAL a commit appends to the WAL without an fsync; the WAL is
+# fsynced at checkpoints, so a power loss can drop the last commits but never
+# corrupts the database.
+DB_LOCK = threading.Lock()
+DB_READ_POOL_SIZE = 4
+DB_CACHED_STATEMENTS = 256
+DB_PRAGMAS = ('PRAGMA synchronous = NORMAL', 'PRAGMA cache_size = -8000', 'PRAGMA temp_store = MEMORY',
+              'PRAGMA mmap_size = 67108864', 'PRAGMA busy_timeout = 5000')
+_db_writer = None
+_db_readers = []
+_db_readers_lock = threading.Lock()
+
+def _open_db_connection(read_only=False):
+    conn = sqlite3.connect(DATABASE_PATH, check_same_thread=False, timeout=5, cached_statements=DB_CACHED_STATEMENTS)
+    if not read_only:
+        conn.execute('PRAGMA journal_mode = WAL')
+    for pragma in DB_PRAGMAS:
+        conn.execute(pragma)
+    if read_only:
+        conn.execute('PRAGMA query_only = 1')
+    return conn
+
+@contextlib.contextmanager
+def db_writer():
+    """The shared writer connection, held under DB_LOCK, with queued writes already applied.
+    A transaction left open by a failed statement is rolled back."""
+    global _db_writer
+    with DB_LOCK:
+        if _db_writer is None:
+            _db_writer = _open_db_connection()
+        _apply_pending_writes(_db_writer)
+        try:
+            yield _db_writer
+        finally:
+            if _db_writer.in_transaction:
+                _db_writer.rollback()
+
+@contextlib.contextmanager
+def db_reader():
+    """A pooled read-only connection; reads run concurrently with each other and with the writer."""
+    with _db_readers_lock:
+        conn = _db_readers.pop() if _db_readers else None
+    if conn is None:
+        conn = _open_db_connection(read_only=True)
+    try:
+        yield conn
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        with _db_readers_lock:
+            if len(_db_readers) < DB_READ_POOL_SIZE:
+                _db_readers.append(conn)
+                conn = None
+        if conn is not None:
+            conn.close()
+
+def close_db_connections():
+    """Flush queued writes, checkpoint the WAL and close every connection (they reopen on next use)."""
+    global _db_writer
+    flush_db_writes()
+    with _db_readers_lock:
+        readers, _db_readers[:] = list(_db_readers), []
+    for conn in readers:
+        conn.close()
+    with DB_LOCK:
+        if _db_writer is not None:
+            try:
+                _db_writer.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            except sqlite3.Error as e:
+                logger.warning(f"WAL checkpoint on close failed: {e}")
+            _db_writer.close()
+            _db_writer = None
+
+atexit.register(close_db_connections)  # registered before cleanup(), so it runs after it
+# --- End Database Connections ---
+
+# --- Write-Behind ---
+# Bookkeeping writes (active users, file records, policies, subscriptions) are
+# queued instead of committed by the calling handler thread. A flusher thread
+# commits whatever accumulated every DB_FLUSH_INTERVAL in one transaction.
+# Each queued write is keyed by the row(s) it determines and a newer write for
+# the same key replaces the pending one, so a burst of identical updates costs
+# one statement. Every statement fully determines its row (INSERT OR REPLACE,
+# INSERT OR IGNORE, DELETE), which keeps last-write-wins correct. Synchronous
+# db_writer() users apply the queue first, so they always see earlier writes.
+# DB_WRITE_MODE=sync commits each write before returning (nothing is lost if
+# the process is killed); 'batched' can lose up to DB_FLUSH_INTERVAL of writes.
+DB_WRITE_MODE = os.environ.get('DB_WRITE_MODE', 'batched')
+DB_FLUSH_INTERVAL = float(os.environ.get('DB_FLUSH_INTERVAL', '0.2'))
+_db_pending = OrderedDict()  # key -> statements
+_db_pending_lock = threading.Lock()
+_db_pending_event = threading.Event()
+_db_flusher = None
+db_write_stats = {'queued': 0, 'coalesced': 0, 'batches': 0, 'statements': 0, 'failed': 0}
+
+def db_execute(key, *statements):
+    """Persist `statements` [(sql, params)] that determine the row(s) identified by `key`.
+    In sync mode sqlite3 errors reach the caller; in batched mode the flusher logs them."""
+    if DB_WRITE_MODE == 'sync':
+        with db_writer() as conn:
+            for sql, params in statements:
+                conn.execute(sql, params)
+            conn.commit()
+        return
+    global _db_flusher
+    with _db_pending_lock:
+        db_write_stats['queued'] += 1
+        if _db_pending.pop(key, None) is not None:
+            db_write_stats['coalesced'] += 1
+        _db_pending[key] = statements
+        if _db_flusher is None:
+            _db_flusher = threading.Thread(target=_db_flush_loop, name='db-writer', daemon=True)
+            _db_flusher.start()
+    _db_pending_event.set()
+
+def _apply_pending_writes(conn):
+    """Commit everything queued in one transaction. Must hold DB_LOCK (called from db_writer)."""
+    with _db_pending_lock:
+        if not _db_pending:
+            return
+        batch = list(_db_pending.values())
+        _db_pending.clear()
+    try:
+        for statements in batch:
+            for sql, params in statements:
+                conn.execute(sql, params)
+        conn.commit()
+    except sqlite3.Error as e:
+        conn.rollback()
+        logger.error(f"❌ Batched DB write of {len(batch)} rows failed ({e}); retrying one by one.")
+        for statements in batch:
+            try:
+                for sql, params in statements:
+                    conn.execute(sql, params)
+                conn.commit()
+            except sqlite3.Error as e:
+                conn.rollback()
+                db_write_stats['failed'] += 1
+                logger.error(f"❌ SQLite error writing {statements}: {e}")
+    db_write_stats['batches'] += 1
+    db_write_stats['statements'] += sum(len(statements) for statements in batch)
+
+def flush_db_writes():
+    """Commit all queued writes now."""
+    with db_writer():
+        pass
+
+def _db_flush_loop():
+    while True:
+        _db_pending_event.wait()
+        time.sleep(DB_FLUSH_INTERVAL)  # let the batch fill up
+        _db_pending_event.clear()
+        try:
+            flush_db_writes()
+        except Exception as e:
+            logger.error(f"❌ DB write-behind flush failed: {e}", exc_info=True)
+# --- End Write-Behind ---
+
 # --- Database Setup ---
 def init_db():
     logger.info(f"Initializing database at: {DATABASE_PATH}")
     try:
-        conn = sqlite3.connect(DATABASE_PATH, check_same_thread=False)
-        c = conn.cursor()
-        c.execute('''CREATE TABLE IF NOT EXISTS subscriptions
-                     (user_id INTEGER PRIMARY KEY, expiry TEXT)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS user_files
-                     (user_id INTEGER, file_name TEXT, file_type TEXT,
-                      PRIMARY KEY (user_id, file_name))''')
-        c.execute('''CREATE TABLE IF NOT EXISTS active_users
-                     (user_id INTEGER PRIMARY KEY)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS admins
-                     (user_id INTEGER PRIMARY KEY)''')
-        c.execute('INSERT OR IGNORE INTO admins (user_id) VALUES (?)', (OWNER_ID,))
-        if ADMIN_ID != OWNER_ID:
-            c.execute('INSERT OR IGNORE INTO admins (user_id) VALUES (?)', (ADMIN_ID,))
-        conn.commit()
-        conn.close()
+        with db_writer() as conn:
+            c = conn.cursor()
+            c.execute('''CREATE TABLE IF NOT EXISTS subscriptions
+                         (user_id INTEGER PRIMARY KEY, expiry TEXT)''')
+            c.execute('CREATE INDEX IF NOT EXISTS idx_subscriptions_expiry ON subscriptions (expiry)')
+            c.execute('''CREATE TABLE IF NOT EXISTS subscription_notices
+                         (user_id INTEGER PRIMARY KEY, expiry TEXT)''')
+            c.execute('''CREATE TABLE IF NOT EXISTS user_files
+                         (user_id INTEGER, file_name TEXT, file_type TEXT,
+                          PRIMARY KEY (user_id, file_name))''')
+            c.execute('''CREATE TABLE IF NOT EXISTS active_users
+                         (user_id INTEGER PRIMARY KEY)''')
+            c.execute('''CREATE TABLE IF NOT EXISTS admins
+                         (user_id INTEGER PRIMARY KEY)''')
+            c.execute('''CREATE TABLE IF NOT EXISTS script_policies
+                         (user_id INTEGER, file_name TEXT, restart_policy TEXT,
+                          PRIMARY KEY (user_id, file_name))''')
+            c.execute('''CREATE TABLE IF NOT EXISTS script_health_probes
+                         (user_id INTEGER, file_name TEXT, probe TEXT, target TEXT, timeout INTEGER, auto_restart INTEGER,
+                          PRIMARY KEY (user_id, file_name))''')
+            c.execute('''CREATE TABLE IF NOT EXISTS script_run_state
+                         (user_id INTEGER, file_name TEXT, desired_state TEXT, updated_at TEXT,
+                          PRIMARY KEY (user_id, file_name))''')
+            c.execute('INSERT OR IGNORE INTO admins (user_id) VALUES (?)', (OWNER_ID,))
+            if ADMIN_ID != OWNER_ID:
+                c.execute('INSERT OR IGNORE INTO admins (user_id) VALUES (?)', (ADMIN_ID,))
+            conn.commit()
         logger.info("Database initialized successfully.")
     except Exception as e:
         logger.error(f"❌ Database initialization error: {e}", exc_info=True)
@@ -120,30 +714,28 @@ def init_db():
 def load_data():
     logger.info("Loading data from database...")
     try:
-        conn = sqlite3.connect(DATABASE_PATH, check_same_thread=False)
-        c = conn.cursor()
-
-        c.execute('SELECT user_id, expiry FROM subscriptions')
-        for user_id, expiry in c.fetchall():
-            try:
-                user_subscriptions[user_id] = {'expiry': datetime.fromisoformat(expiry)}
-            except ValueError:
-                logger.warning(f"⚠️ Invalid expiry date format for user {user_id}: {expiry}. Skipping.")
-
-        c.execute('SELECT user_id, file_name, file_type FROM user_files')
-        for user_id, file_name, file_type in c.fetchall():
-            if user_id not in user_files:
-                user_files[user_id] = []
-            user_files[user_id].append((file_name, file_type))
-
-        c.execute('SELECT user_id FROM active_users')
-        active_users.update(user_id for (user_id,) in c.fetchall())
-
-        c.execute('SELECT user_id FROM admins')
-        admin_ids.update(user_id for (user_id,) in c.fetchall())
-
-        conn.close()
-        logger.info(f"Data loaded: {len(active_users)} users, {len(user_subscriptions)} subscriptions, {len(admin_ids)} admins.")
+        with db_reader() as conn:
+            c = conn.cursor()
+
+            c.execute('SELECT user_id FROM admins')
+            admin_ids.update(user_id for (user_id,) in c.fetchall())
+
+            c.execute('SELECT user_id, file_name, restart_policy FROM script_policies')
+            for user_id, file_name, restart_policy in c.fetchall():
+                if restart_policy in RESTART_POLICIES:
+                    script_restart_policies[(user_id, file_name)] = restart_policy
+
+            c.execute('SELECT user_id, file_name, probe, target, timeout, auto_restart FROM script_health_probes')
+            for user_id, file_name, probe, target, timeout, auto_restart in c.fetchall():
+                if probe in HEALTH_PROBE_DEFAULT_TIMEOUTS:
+                    script_health_probes[(user_id, file_name)] = {'probe': probe, 'target': target, 'timeout': timeout,
+                                                                  'auto_restart': bool(auto_restart)}
+
+        # Users, files and subscriptions are paged in on demand (see Lazy User State); only their counts are read now.
+        for state in (user_files, user_subscriptions, active_users):
+            state.load_counts()
+        logger.info(f"Data loaded: {len(admin_ids)} admins, {len(script_restart_policies)} restart policies, "
+                    f"{len(script_health_probes)} health probes.")
     except Exception as e:
         logger.error(f"❌ Error loading data: {e}", exc_info=True)
 
@@ -151,297 +743,2646 @@ init_db()
 load_data()
 # --- End Database Setup ---
 
+# --- Database Backup ---
+# Snapshots are taken with the SQLite online backup API, never by copying the
+# file (a copy taken while the writer commits can be torn). The source is a
+# read-only connection holding one read transaction for the whole copy: in WAL
+# mode that pins a consistent snapshot, so writers keep committing and the
+# copy is never restarted by them. Pages are copied BACKUP_PAGES_PER_STEP at
+# a time with a short sleep in between; each step only holds a shared lock.
+# The only time DB_LOCK is taken is to flush queued writes before the copy
+# starts, and for the whole of a restore, which writes the snapshot back
+# through the writer connection in one step and then reloads in-memory state.
+_backup_lock = threading.Lock()
+backup_stats = {'runs': 0, 'failed': 0, 'restores': 0, 'last': None}
+
+def list_backups():
+    """[(name, size, mtime)] of the snapshots in BACKUP_DIR, newest first."""
+    backups = []
+    for entry in os.scandir(BACKUP_DIR):
+        if entry.name.startswith('bot_data-') and entry.name.endswith('.db'):
+            stat = entry.stat()
+            backups.append((entry.name, stat.st_size, stat.st_mtime))
+    return sorted(backups, key=lambda b: b[2], reverse=True)
+
+def prune_backups(keep=None):
+    keep = BACKUP_KEEP if keep is None else keep
+    removed = 0
+    for name, _, _ in list_backups()[keep:]:
+        with contextlib.suppress(OSError):
+            os.remove(os.path.join(BACKUP_DIR, name))
+            removed += 1
+    for entry in os.scandir(BACKUP_DIR):
+        if entry.name.endswith('.part'):  # left behind by a backup that died mid-copy
+            with contextlib.suppress(OSError):
+                os.remove(entry.path)
+    return removed
+
+def backup_database(reason='scheduled', prune=True):
+    """Write a consistent snapshot of the live database to BACKUP_DIR. Returns its metrics.
+    prune=False keeps every older snapshot (a restore must not rotate out the one it reads)."""
+    with _backup_lock:
+        started = time.perf_counter()
+        flush_db_writes()  # queued writes belong in the snapshot
+        flush_ms = (time.perf_counter() - started) * 1000
+        stamp = f"bot_data-{datetime.now():%Y%m%d-%H%M%S}"
+        name = f"{stamp}-{reason}.db"
+        for n in itertools.count(2):
+            if not os.path.exists(os.path.join(BACKUP_DIR, name)):
+                break
+            name = f"{stamp}-{n}-{reason}.db"
+        path = os.path.join(BACKUP_DIR, name)
+        steps = []
+        step_started = [time.perf_counter()]
+
+        def progress(status, remaining, total):
+            steps.append(time.perf_counter() - step_started[0])  # shared lock held for this long
+            time.sleep(BACKUP_STEP_SLEEP)
+            step_started[0] = time.perf_counter()
+
+        source = _open_db_connection(read_only=True)
+        target = sqlite3.connect(path + '.part')
+        try:
+            source.execute('BEGIN')
+            source.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()  # starts the read transaction
+            source.backup(target, pages=BACKUP_PAGES_PER_STEP, progress=progress)
+            target.execute('PRAGMA journal_mode = DELETE')  # a self-contained file, no -wal next to it
+            check = target.execute('PRAGMA quick_check').fetchone()[0]
+            pages = target.execute('PRAGMA page_count').fetchone()[0]
+        except Exception:
+            backup_stats['failed'] += 1
+            raise
+        finally:
+            target.close()
+            source.rollback()
+            source.close()
+        if check != 'ok':
+            os.remove(path + '.part')
+            backup_stats['failed'] += 1
+            raise sqlite3.DatabaseError(f"snapshot failed its integrity check: {check}")
+        os.replace(path + '.part', path)
+        pruned = prune_backups() if prune else 0
+        metrics = {'name': name, 'reason': reason, 'pages': pages, 'bytes': os.path.getsize(path), 'steps': len(steps),
+                   'duration_ms': (time.perf_counter() - started) * 1000, 'flush_lock_ms': flush_ms,
+                   'max_step_ms': max(steps, default=0) * 1000, 'step_total_ms': sum(steps) * 1000, 'pruned': pruned,
+                   'time': datetime.now()}
+        backup_stats['runs'] += 1
+        backup_stats['last'] = metrics
+        logger.info(f"💾 Backup {name}: {pages} pages in {metrics['duration_ms']:.0f} ms "
+                    f"({len(steps)} steps, longest {metrics['max_step_ms']:.1f} ms, flush {flush_ms:.1f} ms), "
+                    f"{pruned} old snapshots pruned")
+        return metrics
+
+def restore_database(name):
+    """Replace the live database with snapshot `name` (a 'pre-restore' snapshot is taken first).
+    Returns {'pre_restore', 'lock_ms'}. Running scripts are left alone."""
+    path = os.path.join(BACKUP_DIR, os.path.basename(name))
+    if not os.path.isfile(path):
+        raise FileNotFoundError(name)
+    snapshot = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        check = snapshot.execute('PRAGMA quick_check').fetchone()[0]
+        if check != 'ok':
+            raise sqlite3.DatabaseError(f"{name} failed its integrity check: {check}")
+        pre_restore = backup_database('pre-restore', prune=False)
+        with _backup_lock:
+            waited = time.perf_counter()
+            with db_writer() as conn:
+                locked = time.perf_counter()
+                snapshot.backup(conn)  # one step: readers see the old data until it commits
+                lock_ms = (time.perf_counter() - locked) * 1000
+    finally:
+        snapshot.close()
+    logger.warning(f"♻️ Database restored from {name} (DB_LOCK held {lock_ms:.0f} ms, "
+                   f"waited {(locked - waited) * 1000:.0f} ms for it)")
+    init_db()  # snapshots from older versions may lack newer tables
+    admin_ids.intersection_update({ADMIN_ID, OWNER_ID})
+    script_restart_policies.clear()
+    script_health_probes.clear()
+    for state in (user_files, user_subscriptions, active_users, subscribed_users):
+        state.reset()
+    load_data()
+    reset_expiry_index()
+    backup_stats['restores'] += 1
+    return {'pre_restore': pre_restore['name'], 'lock_ms': lock_ms}
+
+def backup_summary():
+    backups = list_backups()
+    lines = [f"💾 Backups: {len(backups)} of {BACKUP_KEEP} kept, "
+             + (f"every {BACKUP_INTERVAL_HOURS:g} h" if BACKUP_INTERVAL_HOURS > 0 else "scheduled backups off")
+             + f" ({backup_stats['runs']} taken, {backup_stats['failed']} failed since start)"]
+    last = backup_stats['last']
+    if last:
+        lines.append(f"Last: `{last['name']}`, {last['bytes'] / 1024 / 1024:.1f} MB in {last['duration_ms']:.0f} ms, "
+                     f"{last['steps']} steps, longest step {last['max_step_ms']:.1f} ms, "
+                     f"DB_LOCK {last['flush_lock_ms']:.1f} ms")
+    for name, size, _ in backups[:10]:
+        lines.append(f"`{name}` ({size / 1024:.0f} KB)")
+    return "\n".join(lines)
+
+def backup_loop():
+    while True:
+        backups = list_backups()
+        newest = backups[0][2] if backups else 0
+        time.sleep(max(60, newest + BACKUP_INTERVAL_HOURS * 3600 - time.time()))
+        try:
+            backup_database()
+        except Exception as e:
+            logger.error(f"❌ Scheduled backup failed: {e}", exc_info=True)
+# --- End Database Backup ---
+
 # --- Helper Functions ---
 def get_user_folder(user_id):
     user_folder = os.path.join(UPLOAD_BOTS_DIR, str(user_id))
     os.makedirs(user_folder, exist_ok=True)
     return user_folder
 
+def get_user_tier(user_id):
+    if user_id == OWNER_ID: return 'owner'
+    if user_id in admin_ids: return 'admin'
+    if user_id in subscribed_users:  # kept current by the expiry scheduler, no clock or DB lookup
+        return 'subscribed'
+    return 'free'
+
 def get_user_file_limit(user_id):
-    if user_id == OWNER_ID: return OWNER_LIMIT
-    if user_id in admin_ids: return ADMIN_LIMIT
-    if user_id in user_subscriptions and user_subscriptions[user_id]['expiry'] > datetime.now():
-        return SUBSCRIBED_USER_LIMIT
-    return FREE_USER_LIMIT
+    return {'owner': OWNER_LIMIT, 'admin': ADMIN_LIMIT, 'subscribed': SUBSCRIBED_USER_LIMIT,
+            'free': FREE_USER_LIMIT}[get_user_tier(user_id)]
 
 def get_user_file_count(user_id):
-    return len(user_files.get(user_id, []))
+    return len(user_files.get(user_id, ()))
+
+def reply_or_notify(message, text, chat_id=None, **kwargs):
+    """Reply to `message`; background starts have no message and go to `chat_id` (or only the log)."""
+    if message is not None:
+        return bot.reply_to(message, text, **kwargs)
+    if chat_id is not None:
+        return bot.send_message(chat_id, text, **kwargs)
+    logger.info(f"(no chat to notify) {text}")
+
+# --- Resource Limits ---
+# Limits are applied at spawn time. With a delegated cgroup v2 hierarchy every
+# script gets its own cgroup (cpu.max, memory.max, pids.max); otherwise we fall
+# back to setrlimit (RLIMIT_DATA for memory) and nice for CPU. Open files are
+# always capped with RLIMIT_NOFILE since cgroups have no fd controller.
+_cgroup_lock = threading.Lock()
+_cgroup_scripts_dir = None
+_cgroup_checked = False
+
+def _write_cgroup_file(path, value):
+    with open(path, 'w') as f:
+        f.write(value)
+
+def _init_cgroups():
+    """Prepare <own cgroup>/scripts for per-script cgroups. Returns its path or None."""
+    global _cgroup_scripts_dir, _cgroup_checked
+    with _cgroup_lock:
+        if _cgroup_checked:
+            return _cgroup_scripts_dir
+        _cgroup_checked = True
+        try:
+            if os.name == 'nt' or not os.path.exists(os.path.join(CGROUP_ROOT, 'cgroup.controllers')):
+                logger.info("cgroups v2 not available. Using setrlimit/nice for script limits.")
+                return None
+            with open('/proc/self/cgroup') as f:
+                own_path = next(line.strip()[3:] for line in f if line.startswith('0::'))
+            own_dir = os.path.join(CGROUP_ROOT, own_path.lstrip('/'))
+            with open(os.path.join(own_dir, 'cgroup.controllers')) as f:
+                available = set(f.read().split())
+            controllers = ' '.join(f'+{c}' for c in ('cpu', 'memory', 'pids') if c in available)
+            if not controllers:
+                logger.info("No cpu/memory/pids cgroup controllers delegated. Using setrlimit/nice.")
+                return None
+            # cgroup v2 forbids processes in inner nodes, so move the bot into a leaf first.
+            bot_dir = os.path.join(own_dir, 'bot')
+            scripts_dir = os.path.join(own_dir, 'scripts')
+            os.makedirs(bot_dir, exist_ok=True)
+            os.makedirs(scripts_dir, exist_ok=True)
+            _write_cgroup_file(os.path.join(bot_dir, 'cgroup.procs'), str(os.getpid()))
+            _write_cgroup_file(os.path.join(own_dir, 'cgroup.subtree_control'), controllers)
+            _write_cgroup_file(os.path.join(scripts_dir, 'cgroup.subtree_control'), controllers)
+            _cgroup_scripts_dir = scripts_dir
+            logger.info(f"cgroups v2 enabled for hosted scripts at {scripts_dir} ({controllers}).")
+        except Exception as e:
+            logger.warning(f"Could not set up cgroups v2 ({e}). Using setrlimit/nice for script limits.")
+            _cgroup_scripts_dir = None
+        return _cgroup_scripts_dir
+
+def create_script_cgroup(script_key, limits):
+    scripts_dir = _init_cgroups()
+    if not scripts_dir:
+        return None
+    cgroup_dir = None
+    try:
+        # Unique per start: the previous run's cgroup may still be torn down after a quick restart.
+        cgroup_dir = tempfile.mkdtemp(prefix=re.sub(r'[^A-Za-z0-9_.-]', '_', script_key) + '-', dir=scripts_dir)
+        if limits.get('cpu'):
+            _write_cgroup_file(os.path.join(cgroup_dir, 'cpu.max'), f"{int(limits['cpu'] * 100000)} 100000")
+        if limits.get('memory_mb'):
+            _write_cgroup_file(os.path.join(cgroup_dir, 'memory.max'), str(limits['memory_mb'] * 1024 * 1024))
+            try:
+                _write_cgroup_file(os.path.join(cgroup_dir, 'memory.swap.max'), '0')
+            except OSError:
+                pass
+        if limits.get('pids'):
+            _write_cgroup_file(os.path.join(cgroup_dir, 'pids.max'), str(limits['pids']))
+        return cgroup_dir
+    except Exception as e:
+        logger.error(f"Failed to create cgroup for {script_key}: {e}. Falling back to setrlimit.")
+        if cgroup_dir:
+            with contextlib.suppress(OSError):
+                os.rmdir(cgroup_dir)
+        return None
+
+def remove_script_cgroup(cgroup_dir):
+    if cgroup_dir:
+        # The script is gone; anything still in its cgroup escaped its session.
+        kill_file = os.path.join(cgroup_dir, 'cgroup.kill')
+        try:
+            with open(os.path.join(cgroup_dir, 'cgroup.procs')) as f:
+                leftover = f.read().split()
+            if leftover and os.path.exists(kill_file):
+                logger.warning(f"Killing {len(leftover)} leftover processes in {cgroup_dir}: {leftover}")
+                _write_cgroup_file(kill_file, '1')
+                deadline = time.time() + 1
+                while time.time() < deadline:
+                    with open(os.path.join(cgroup_dir, 'cgroup.procs')) as f:
+                        if not f.read().strip():
+                            break
+                    time.sleep(0.02)
+        except OSError:
+            pass
+        try:
+            os.rmdir(cgroup_dir)
+        except OSError as e:
+            logger.warning(f"Could not remove cgroup {cgroup_dir}: {e}")
+
+def _apply_script_limits(limits, cgroup_dir):
+    # Runs in the forked child before exec: no logging, no locks.
+    if cgroup_dir:
+        _write_cgroup_file(os.path.join(cgroup_dir, 'cgroup.procs'), '0')
+    if limits.get('open_files'):
+        hard = resource.getrlimit(resource.RLIMIT_NOFILE)[1]
+        n = limits['open_files'] if hard == resource.RLIM_INFINITY else min(limits['open_files'], hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (n, n))
+    if not cgroup_dir:
+        if limits.get('memory_mb'):
+            limit_bytes = limits['memory_mb'] * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_DATA, (limit_bytes, limit_bytes))
+        if limits.get('nice'):
+            os.nice(limits['nice'])
+
+def get_script_preexec(limits, cgroup_dir):
+    """preexec_fn for Popen that enforces `limits`, or None where limits are unsupported."""
+    if resource is None or not any(limits.get(k) for k in ('cpu', 'memory_mb', 'pids', 'open_files', 'nice')):
+        return None
+    return functools.partial(_apply_script_limits, limits, cgroup_dir)
+
+def describe_script_exit(script_info, returncode):
+    """Human readable exit reason, pointing at the resource limit when one was hit."""
+    limits = script_info.get('limits') or {}
+    cgroup_dir = script_info.get('cgroup_dir')
+    if script_info.get('exit_reason'):
+        return script_info['exit_reason']
+    if script_info.get('stopping'):
+        return f"stopped by the host (code {returncode})"
+    if cgroup_dir:
+        try:
+            with open(os.path.join(cgroup_dir, 'memory.events')) as f:
+                events = dict(line.split() for line in f if line.strip())
+            if int(events.get('oom_kill', 0)) > 0:
+                return f"killed by the OOM killer: memory limit of {limits.get('memory_mb')} MB exceeded"
+        except (OSError, ValueError):
+            pass
+        try:
+            with open(os.path.join(cgroup_dir, 'pids.events')) as f:
+                events = dict(line.split() for line in f if line.strip())
+            if int(events.get('max', 0)) > 0 and returncode != 0:
+                return f"exited with code {returncode} after hitting the process/thread limit of {limits.get('pids')}"
+        except (OSError, ValueError):
+            pass
+    if returncode and script_info.get('log_path'):
+        try:
+            with open(script_info['log_path'], 'rb') as f:
+                f.seek(0, os.SEEK_END)
+                f.seek(max(0, f.tell() - 4096))
+                log_tail = f.read().decode('utf-8', errors='ignore')
+            if 'MemoryError' in log_tail and limits.get('memory_mb'):
+                return f"ran out of memory: limit of {limits['memory_mb']} MB exceeded (MemoryError)"
+            if 'Too many open files' in log_tail and limits.get('open_files'):
+                return f"exited with code {returncode} after hitting the open files limit of {limits['open_files']}"
+        except OSError:
+            pass
+    if returncode is not None and returncode < 0:
+        signum = -returncode
+        if signum == signal.SIGKILL and limits.get('memory_mb'):
+            return f"killed by SIGKILL, most likely out of memory (limit {limits['memory_mb']} MB)"
+        try:
+            return f"killed by signal {signal.Signals(signum).name}"
+        except ValueError:
+            return f"killed by signal {signum}"
+    return f"exited with code {returncode}"
+# --- End Resource Limits ---
+
+# --- Zygote (Fork Server) ---
+# zygote.py keeps a warm interpreter with ZYGOTE_PRELOAD_MODULES imported and
+# forks hosted scripts from it. Those scripts are children of the zygote, not of
+# the bot, so exit codes arrive over the zygote's event connection.
+_zygote_lock = threading.Lock()
+_zygote_process = None
+_zygote_handles = {}
+_zygote_early_exits = {}
+
+class ZygoteProcess:
+    """Popen-like handle (pid, poll, wait, terminate, kill) for a script forked by the zygote."""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.returncode = None
+        self._exited = threading.Event()
+
+    def _set_exit(self, returncode):
+        self.returncode = returncode
+        self._exited.set()
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._exited.wait(0.5):
+            if not zygote_available() and not psutil.pid_exists(self.pid):
+                # Zygote died, nobody will report the exit code anymore.
+                self._set_exit(None)
+            elif deadline is not None and time.monotonic() >= deadline:
+                raise subprocess.TimeoutExpired(f"zygote child {self.pid}", timeout)
+        return self.returncode
+
+    def send_signal(self, signum):
+        if self.returncode is None:
+            try:
+                os.kill(self.pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+def _zygote_request(payload, timeout=10):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(ZYGOTE_SOCKET_PATH)
+        sock.sendall((json.dumps(payload) + '\n').encode('utf-8'))
+        buf = b''
+        while not buf.endswith(b'\n'):
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            buf += chunk
+        return json.loads(buf.decode('utf-8'))
+    finally:
+        sock.close()
+
+def _zygote_events_loop(sock):
+    buf = b''
+    while True:
+        try:
+            chunk = sock.recv(65536)
+        except OSError:
+            chunk = b''
+        if not chunk:
+            break
+        buf += chunk
+        while b'\n' in buf:
+            line, buf = buf.split(b'\n', 1)
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            with _zygote_lock:
+                handle = _zygote_handles.pop(event['pid'], None)
+                if handle is None:
+                    _zygote_early_exits[event['pid']] = event['returncode']
+            if handle:
+                handle._set_exit(event['returncode'])
+    logger.error("Zygote event connection closed. Falling back to plain Popen for new scripts.")
+
+def zygote_available():
+    return _zygote_process is not None and _zygote_process.poll() is None
+
+def start_zygote(timeout=60):
+    """Start zygote.py and subscribe to its exit events. Returns True when it is ready."""
+    global _zygote_process
+    if os.name == 'nt' or not hasattr(os, 'fork'):
+        logger.warning("Zygote mode needs fork(). Using plain Popen.")
+        return False
+    if zygote_available():
+        return True
+    _zygote_process = subprocess.Popen([sys.executable, os.path.join(BASE_DIR, 'zygote.py'), ZYGOTE_SOCKET_PATH] + ZYGOTE_PRELOAD_MODULES,
+                                       cwd=BASE_DIR, stdin=subprocess.DEVNULL)
+    deadline = time.time() + timeout
+    while time.time() < deadline and zygote_available():
+        try:
+            reply = _zygote_request({'cmd': 'ping'}, timeout=2)
+            if reply.get('ok'):
+                break
+        except OSError:
+            time.sleep(0.2)
+    else:
+        logger.error("Zygote did not become ready. Using plain Popen.")
+        if zygote_available():
+            _zygote_process.kill()
+        _zygote_process = None
+        return False
+    events_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    events_sock.connect(ZYGOTE_SOCKET_PATH)
+    events_sock.sendall(b'{"cmd": "events"}\n')
+    threading.Thread(target=_zygote_events_loop, args=(events_sock,), name='zygote-events', daemon=True).start()
+    logger.info(f"Zygote ready (PID: {_zygote_process.pid}), preloaded: {reply.get('preloaded')}")
+    return True
+
+def zygote_spawn(script_path, user_folder, log_path, limits, cgroup_dir):
+    reply = _zygote_request({'cmd': 'spawn', 'script': script_path, 'cwd': user_folder, 'log': log_path,
+                             'limits': limits, 'cgroup_dir': cgroup_dir})
+    if 'pid' not in reply:
+        raise OSError(reply.get('error', 'zygote spawn failed'))
+    handle = ZygoteProcess(reply['pid'])
+    with _zygote_lock:
+        if handle.pid in _zygote_early_exits:
+            handle._set_exit(_zygote_early_exits.pop(handle.pid))
+        else:
+            _zygote_handles[handle.pid] = handle
+    return handle
+
+def stop_zygote():
+    if zygote_available():
+        _zygote_process.terminate()
+# --- End Zygote (Fork Server) ---
+
+# --- Task Scheduler ---
+# One heap-driven thread for delayed work (automatic restarts and other timers)
+# instead of a threading.Timer per pending action. Tasks must return quickly.
+_task_heap = []
+_task_cv = threading.Condition()
+_task_seq = itertools.count()
+_task_thread = None
+
+def _task_loop():
+    while True:
+        with _task_cv:
+            while not _task_heap or _task_heap[0][0] > time.monotonic():
+                _task_cv.wait(_task_heap[0][0] - time.monotonic() if _task_heap else None)
+            task = heapq.heappop(_task_heap)
+        if task[4]:
+            continue
+        try:
+            task[2](*task[3])
+        except Exception as e:
+            logger.error(f"Scheduled task {getattr(task[2], '__name__', task[2])} failed: {e}", exc_info=True)
+
+def schedule_task(delay, func, *args):
+    """Run func(*args) on the scheduler thread after `delay` seconds. Returns a handle for cancel_task."""
+    global _task_thread
+    task = [time.monotonic() + delay, next(_task_seq), func, args, False]
+    with _task_cv:
+        heapq.heappush(_task_heap, task)
+        if _task_thread is None:
+            _task_thread = threading.Thread(target=_task_loop, name='task-scheduler', daemon=True)
+            _task_thread.start()
+        _task_cv.notify()
+    return task
+
+def cancel_task(task):
+    if task:
+        task[4] = True
+# --- End Task Scheduler ---
+
+# --- Script Supervisor ---
+# bot_scripts only ever holds live processes: the supervisor thread is told about
+# every child exit (pidfd on Linux, a blocking waiter thread elsewhere) and drops
+# the entry right away, so status checks never have to touch the process table.
+SCRIPT_STATE_LOCK = threading.RLock()
+script_exit_info = {}
+_supervisor_lock = threading.Lock()
+_supervisor_pending = []
+_supervisor_wakeup = None
+_supervisor_thread = None
+
+def _close_script_log(script_info, script_key):
+    log_file = script_info.get('log_file')
+    if log_file and hasattr(log_file, 'close') and not log_file.closed:
+        try:
+            log_file.close()
+        except Exception as log_e:
+            logger.error(f"Error closing log file for exited script {script_key}: {log_e}")
+
+def _handle_script_exit(script_key, process):
+    try:
+        returncode = process.wait()
+    except Exception as e:
+        logger.error(f"Error collecting exit status for {script_key} (PID: {process.pid}): {e}")
+        returncode = None
+    reason = None
+    with SCRIPT_STATE_LOCK:
+        script_info = bot_scripts.get(script_key)
+        owned = script_info is not None and script_info.get('process') is process
+        if owned:
+            del bot_scripts[script_key]
+            reason = describe_script_exit(script_info, returncode)
+            _close_script_log(script_info, script_key)
+            if script_info.get('log_path'):
+                try:
+                    with open(script_info['log_path'], 'a', encoding='utf-8') as log_f:
+                        log_f.write(f"\n[host] {datetime.now():%Y-%m-%d %H:%M:%S} Script {reason}\n")
+                except OSError as e:
+                    logger.error(f"Could not write exit reason to log of {script_key}: {e}")
+        script_exit_info[script_key] = {'pid': process.pid, 'returncode': returncode, 'exit_time': datetime.now(), 'reason': reason}
+    logger.info(f"Script {script_key} (PID: {process.pid}) exited with code {returncode}." + (f" Reason: {reason}" if reason else ""))
+    notify_start_scheduler()
+    if owned:
+        threading.Thread(target=_finish_script_exit, args=(script_key, script_info, returncode),
+                         name=f"exit-{script_key}", daemon=True).start()
+
+def _finish_script_exit(script_key, script_info, returncode):
+    """The slow part of an exit, kept off the supervisor thread and SCRIPT_STATE_LOCK: cgroup teardown
+    waits for escaped children to die and the restart policy may message the owner."""
+    try:
+        remove_script_cgroup(script_info.get('cgroup_dir'))
+        if not script_info.get('stopping'):
+            apply_restart_policy(script_key, script_info, returncode)
+    except Exception as e:
+        logger.error(f"Error finishing exit of {script_key}: {e}", exc_info=True)
+
+def _supervisor_loop():
+    selector = selectors.DefaultSelector()
+    selector.register(_supervisor_wakeup[0], selectors.EVENT_READ, None)
+    while True:
+        for key, _ in selector.select():
+            if key.data is None:
+                os.read(_supervisor_wakeup[0], 4096)
+                with _supervisor_lock:
+                    pending = _supervisor_pending[:]
+                    _supervisor_pending.clear()
+                for pidfd, script_key, process in pending:
+                    selector.register(pidfd, selectors.EVENT_READ, (script_key, process))
+                continue
+            script_key, process = key.data
+            selector.unregister(key.fd)
+            os.close(key.fd)
+            try:
+                _handle_script_exit(script_key, process)
+            except Exception as e:
+                logger.error(f"Supervisor error handling exit of {script_key}: {e}", exc_info=True)
+
+def _start_supervisor():
+    global _supervisor_thread, _supervisor_wakeup
+    with _supervisor_lock:
+        if _supervisor_thread is not None:
+            return
+        _supervisor_wakeup = os.pipe()
+        _supervisor_thread = threading.Thread(target=_supervisor_loop, name='script-supervisor', daemon=True)
+        _supervisor_thread.start()
+        logger.info("Script supervisor started (pidfd mode).")
+
+def supervise_script_process(script_key, process):
+    """Watch a hosted script's process and drop it from bot_scripts when it exits."""
+    if not hasattr(os, 'pidfd_open'):
+        threading.Thread(target=_handle_script_exit, args=(script_key, process), daemon=True).start()
+        return
+    try:
+        pidfd = os.pidfd_open(process.pid)
+    except ProcessLookupError:
+        _handle_script_exit(script_key, process)
+        return
+    except OSError as e:
+        logger.warning(f"pidfd_open failed for {script_key} ({e}). Falling back to waiter thread.")
+        threading.Thread(target=_handle_script_exit, args=(script_key, process), daemon=True).start()
+        return
+    _start_supervisor()
+    with _supervisor_lock:
+        _supervisor_pending.append((pidfd, script_key, process))
+    os.write(_supervisor_wakeup[1], b'\0')
 
 def is_bot_running(script_owner_id, file_name):
-    script_key = f"{script_owner_id}_{file_name}"
+    return f"{script_owner_id}_{file_name}" in bot_scripts
+# --- End Script Supervisor ---
+
+# --- Restart Policies ---
+def get_restart_policy(script_owner_id, file_name):
+    return script_restart_policies.get((script_owner_id, file_name), DEFAULT_RESTART_POLICY)
+
+def _get_restart_state(script_key):
+    state = script_restart_state.get(script_key)
+    if state is None:
+        state = {'failures': deque(), 'consecutive': 0, 'parked': False, 'pending': None,
+                 'history': deque(maxlen=RESTART_HISTORY_SIZE)}
+        script_restart_state[script_key] = state
+    return state
+
+def apply_restart_policy(script_key, script_info, returncode):
+    """Decide what happens after a hosted script exits on its own."""
+    if shutting_down:
+        return
+    script_owner_id = script_info['script_owner_id']
+    file_name = script_info['file_name']
+    policy = get_restart_policy(script_owner_id, file_name)
+    failed = returncode != 0
+    now = time.time()
+    parked = False
+    with SCRIPT_STATE_LOCK:
+        state = _get_restart_state(script_key)
+        if failed:
+            state['failures'].append(now)
+        while state['failures'] and now - state['failures'][0] > CRASH_LOOP_WINDOW:
+            state['failures'].popleft()
+        if (datetime.now() - script_info['start_time']).total_seconds() >= RESTART_RESET_AFTER:
+            state['consecutive'] = 0
+
+        restart = policy == 'always' or (policy == 'on-failure' and failed)
+        if not restart:
+            state['history'].append((datetime.now(), returncode, 'not restarted'))
+        elif len(state['failures']) >= CRASH_LOOP_MAX_FAILURES:
+            state['parked'] = True
+            state['history'].append((datetime.now(), returncode, 'parked (crash loop)'))
+            parked = True
+        else:
+            state['consecutive'] += 1
+            delay = min(RESTART_BACKOFF_MAX, RESTART_BACKOFF_BASE * 2 ** (state['consecutive'] - 1))
+            delay = random.uniform(delay / 2, delay)
+            cancel_task(state['pending'])
+            state['pending'] = schedule_task(delay, _auto_restart_script, script_key, script_owner_id,
+                                             file_name, script_info.get('message'))
+            state['history'].append((datetime.now(), returncode, f'restart in {delay:.0f}s'))
+            logger.warning(f"Script {script_key} exited with code {returncode}. Policy '{policy}': restarting in {delay:.1f}s.")
+
+    if not restart or parked:
+        set_script_desired_state(script_owner_id, file_name, 'stopped')
+    if parked:
+        logger.error(f"Script {script_key} parked: {len(state['failures'])} failures in {CRASH_LOOP_WINDOW}s.")
+        try:
+            bot.send_message(script_info['chat_id'],
+                             f"⏸️ Script '{file_name}' crashed {len(state['failures'])} times in "
+                             f"{CRASH_LOOP_WINDOW // 60} min and was parked. Check logs, fix it and press Start.")
+        except Exception as e:
+            logger.error(f"Failed to notify about parked script {script_key}: {e}")
+
+def _auto_restart_script(script_key, script_owner_id, file_name, message_obj_for_reply):
+    with SCRIPT_STATE_LOCK:
+        state = script_restart_state.get(script_key)
+        if not state or state['parked'] or state['pending'] is None:
+            return
+        state['pending'] = None
+    if shutting_down or is_bot_running(script_owner_id, file_name):
+        return
+    if not user_files.has_file(script_owner_id, file_name):
+        logger.info(f"Auto-restart of {script_key} skipped: file no longer registered.")
+        return
+    user_folder = get_user_folder(script_owner_id)
+    file_path = os.path.join(user_folder, file_name)
+    if not os.path.exists(file_path):
+        logger.warning(f"Auto-restart of {script_key} skipped: {file_path} missing.")
+        return
+    logger.info(f"Auto-restarting {script_key}...")
+    request_script_start(file_path, script_owner_id, user_folder, file_name, message_obj_for_reply)
+
+def cancel_pending_restart(script_key):
+    with SCRIPT_STATE_LOCK:
+        state = script_restart_state.get(script_key)
+        if state and state['pending']:
+            cancel_task(state['pending'])
+            state['pending'] = None
+
+def reset_restart_state(script_key):
+    """Clear backoff and crash-loop parking after a manual start."""
+    with SCRIPT_STATE_LOCK:
+        state = script_restart_state.get(script_key)
+        if state:
+            cancel_task(state['pending'])
+            state['pending'] = None
+            state['parked'] = False
+            state['failures'].clear()
+            state['consecutive'] = 0
+
+def format_restart_history(script_key, limit=3):
+    state = script_restart_state.get(script_key)
+    if not state:
+        return ""
+    text = ""
+    if state['parked']:
+        text += "\n⏸️ Parked after crash loop (press Start to resume)"
+    if state['history']:
+        lines = [f"  {ts:%m-%d %H:%M:%S} exit {rc} → {action}" for ts, rc, action in list(state['history'])[-limit:]]
+        text += "\n📈 Restart history:\n" + "\n".join(lines)
+    return text
+# --- End Restart Policies ---
+
+# --- Health Probes ---
+# A running pid does not mean a working bot. Scripts can opt into one probe:
+#   heartbeat  the script touches a file; unhealthy when its mtime is older than the timeout
+#   log        unhealthy when the log has not been written for the timeout
+#   cpu        unhealthy when CPU stayed >= CPU_STUCK_PERCENT for the timeout (busy loop)
+#   http       GET http://host:port/path must answer (< 500) within the timeout
+# A recurring scheduler task starts each round on its own thread, since a round
+# waits on HTTP timeouts and Telegram sends and scheduler tasks must return
+# quickly; rounds never overlap. HTTP probes are fanned out to a small shared
+# pool so a dead port cannot stall the round.
+script_health = {}
+_health_pool = None
+_health_round_lock = threading.Lock()  # held while a round runs
+
+def describe_health_probe(probe):
+    target = f" {probe['target']}" if probe.get('target') else ''
+    return f"{probe['probe']}{target}, {probe['timeout']}s{', auto-restart' if probe['auto_restart'] else ''}"
+
+def _health_age_reason(path, script_info, timeout, what):
+    try:
+        age = time.time() - os.path.getmtime(path)
+    except (OSError, TypeError):
+        age = (datetime.now() - script_info['start_time']).total_seconds()
+    return f"no {what} for {age:.0f}s" if age > timeout else None
+
+def _probe_script(script_info, probe):
+    """Current failure reason for a non-HTTP probe, or None when healthy."""
+    kind, timeout = probe['probe'], probe['timeout']
+    if kind == 'heartbeat':
+        if script_info.get('node'):
+            return None  # File probes need the script's filesystem; workers only report CPU/memory.
+        return _health_age_reason(os.path.join(script_info['user_folder'], probe['target']), script_info, timeout, 'heartbeat')
+    if kind == 'log':
+        if script_info.get('node'):
+            return None
+        return _health_age_reason(script_info.get('log_path'), script_info, timeout, 'log output')
+    if kind == 'cpu':
+        needed = min(RESOURCE_SAMPLE_HISTORY, max(1, int(timeout // RESOURCE_SAMPLE_INTERVAL)))
+        series = get_sample_series(script_info['script_key'], 'cpu')[-needed:]
+        if len(series) >= needed and min(series) >= CPU_STUCK_PERCENT:
+            return f"CPU stuck at {min(series):.0f}%+ for {needed * RESOURCE_SAMPLE_INTERVAL}s"
+    return None
+
+def _http_probe(script_info, probe):
+    host = '127.0.0.1'
+    if script_info.get('node') in worker_nodes:
+        host = urllib.parse.urlparse(worker_nodes[script_info['node']]['url']).hostname
+    port, _, path = probe['target'].partition('/')
+    url = f"http://{host}:{port}/{path}"
+    try:
+        response = requests.get(url, timeout=HEALTH_HTTP_TIMEOUT)
+        return f"{url} returned HTTP {response.status_code}" if response.status_code >= 500 else None
+    except requests.exceptions.RequestException as e:
+        return f"{url} unreachable ({type(e).__name__})"
+
+def _record_health(script_key, script_info, probe, reason):
+    now = time.time()
+    state = script_health.get(script_key)
+    pid = script_info['process'].pid
+    if state is None or state['pid'] != pid:
+        state = {'pid': pid, 'healthy': True, 'reason': None, 'since': datetime.now(), 'failing_since': None}
+        script_health[script_key] = state
+    if probe['probe'] == 'http':
+        # One failed request is not a hang; the port has to stay dead for the whole timeout.
+        if reason:
+            state['failing_since'] = state['failing_since'] or now
+            if now - state['failing_since'] < probe['timeout']:
+                reason = None
+            else:
+                reason += f" for {now - state['failing_since']:.0f}s"
+        else:
+            state['failing_since'] = None
+    if reason and state['healthy']:
+        state.update(healthy=False, reason=reason, since=datetime.now())
+        logger.warning(f"Script {script_key} is unhealthy: {reason}")
+        action = "Restarting it." if probe['auto_restart'] else "Check its logs."
+        try:
+            bot.send_message(script_info['chat_id'], f"🟡 Script '{script_info['file_name']}' looks unhealthy: {reason}. {action}")
+        except Exception as e:
+            logger.error(f"Failed to notify about unhealthy script {script_key}: {e}")
+        if probe['auto_restart']:
+            threading.Thread(target=_restart_unhealthy_script, args=(script_key, script_info, reason), daemon=True).start()
+    elif not reason and not state['healthy']:
+        logger.info(f"Script {script_key} recovered (was: {state['reason']}).")
+        state.update(healthy=True, reason=None, since=datetime.now())
+
+def _restart_unhealthy_script(script_key, script_info, reason):
+    script_owner_id, file_name = script_info['script_owner_id'], script_info['file_name']
+    with SCRIPT_STATE_LOCK:
+        if bot_scripts.get(script_key) is not script_info:
+            return
+        state = _get_restart_state(script_key)
+        now = time.time()
+        state['failures'].append(now)
+        while state['failures'] and now - state['failures'][0] > CRASH_LOOP_WINDOW:
+            state['failures'].popleft()
+        parked = len(state['failures']) >= CRASH_LOOP_MAX_FAILURES
+        state['parked'] = state['parked'] or parked
+        state['history'].append((datetime.now(), 'unhealthy', 'parked (crash loop)' if parked else 'restarted'))
+    script_info['exit_reason'] = f"stopped by health check: {reason}"
+    kill_process_tree(script_info)
+    with SCRIPT_STATE_LOCK:
+        if bot_scripts.get(script_key) is script_info:
+            bot_scripts.pop(script_key, None)
+    if parked:
+        set_script_desired_state(script_owner_id, file_name, 'stopped')
+        logger.error(f"Script {script_key} parked: unhealthy {len(state['failures'])} times in {CRASH_LOOP_WINDOW}s.")
+        return
+    user_folder = get_user_folder(script_owner_id)
+    request_script_start(os.path.join(user_folder, file_name), script_owner_id, user_folder, file_name, script_info.get('message'))
+
+def run_health_checks():
+    global _health_pool
+    with SCRIPT_STATE_LOCK:
+        running = list(bot_scripts.items())
+    for script_key in list(script_health):
+        if script_key not in bot_scripts:
+            script_health.pop(script_key, None)
+    checks = []
+    for script_key, script_info in running:
+        probe = script_health_probes.get((script_info['script_owner_id'], script_info['file_name']))
+        if not probe:
+            script_health.pop(script_key, None)
+        elif (datetime.now() - script_info['start_time']).total_seconds() >= probe['timeout']:
+            checks.append((script_key, script_info, probe))
+    http_checks = [c for c in checks if c[2]['probe'] == 'http']
+    http_results = {}
+    if http_checks:
+        if _health_pool is None:
+            _health_pool = concurrent.futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix='health-http')
+        futures = {key: _health_pool.submit(_http_probe, info, probe) for key, info, probe in http_checks}
+        for key, future in futures.items():
+            try:
+                http_results[key] = future.result(timeout=HEALTH_HTTP_TIMEOUT + 2)
+            except Exception as e:
+                http_results[key] = f"probe error: {e}"
+    for script_key, script_info, probe in checks:
+        reason = http_results.get(script_key) if probe['probe'] == 'http' else _probe_script(script_info, probe)
+        _record_health(script_key, script_info, probe, reason)
+
+def _health_round():
+    try:
+        run_health_checks()
+    except Exception as e:
+        logger.error(f"Health check round failed: {e}", exc_info=True)
+    finally:
+        _health_round_lock.release()
+
+def _health_check_tick():
+    if shutting_down:
+        return
+    if _health_round_lock.acquire(blocking=False):
+        threading.Thread(target=_health_round, name='health-round', daemon=True).start()
+    else:
+        logger.warning("Previous health check round is still running; skipping this one.")
+    schedule_task(HEALTH_CHECK_INTERVAL, _health_check_tick)
+
+def _current_health(script_key):
+    # Ignore state left over from a previous run of the script until the next probe round.
+    state = script_health.get(script_key)
     script_info = bot_scripts.get(script_key)
-    if script_info and script_info.get('process'):
+    if state and script_info and script_info['process'].pid == state['pid']:
+        return state
+    return None
+
+def script_status_label(script_owner_id, file_name):
+    script_key = f"{script_owner_id}_{file_name}"
+    if not is_bot_running(script_owner_id, file_name):
+        return "🔴 Stopped"
+    state = _current_health(script_key)
+    return "🟡 Unhealthy" if state and not state['healthy'] else "🟢 Running"
+
+def format_health(script_owner_id, file_name):
+    probe = script_health_probes.get((script_owner_id, file_name))
+    if not probe:
+        return ""
+    state = _current_health(f"{script_owner_id}_{file_name}")
+    text = f"\n🩺 Health probe: {describe_health_probe(probe)}"
+    if state and not state['healthy']:
+        text += f"\n🟡 Unhealthy since {state['since']:%H:%M:%S}: {state['reason']}"
+    return text
+# --- End Health Probes ---
+
+# --- Resource Sampler ---
+# One background thread samples every hosted script; handlers only read the
+# ring buffers below and never call psutil themselves.
+SPARK_CHARS = '▁▂▃▄▅▆▇█'
+script_samples = {}
+
+def _new_sample_entry(pid, remote=False):
+    size = RESOURCE_SAMPLE_HISTORY
+    return {'pid': pid, 'proc': None if remote else psutil.Process(pid), 'pos': 0, 'count': 0,
+            'cpu': array('f', bytes(4 * size)), 'rss': array('d', bytes(8 * size)),
+            'io': array('d', bytes(8 * size)), 'threads': array('H', bytes(2 * size))}
+
+def _take_sample(entry):
+    proc = entry['proc']
+    with proc.oneshot():
+        cpu = proc.cpu_percent(None)
+        rss = proc.memory_info().rss
+        threads = proc.num_threads()
         try:
-            proc = psutil.Process(script_info['process'].pid)
-            is_running = proc.is_running() and proc.status() != psutil.STATUS_ZOMBIE
-            if not is_running:
-                logger.warning(f"Process {script_info['process'].pid} for {script_key} found in memory but not running/zombie. Cleaning up.")
-                if 'log_file' in script_info and hasattr(script_info['log_file'], 'close') and not script_info['log_file'].closed:
-                    try:
-                        script_info['log_file'].close()
-                    except Exception as log_e:
-                        logger.error(f"Error closing log file during zombie cleanup {script_key}: {log_e}")
-                if script_key in bot_scripts:
-                    del bot_scripts[script_key]
-            return is_running
-        except psutil.NoSuchProcess:
-            logger.warning(f"Process for {script_key} not found (NoSuchProcess). Cleaning up.")
-            if 'log_file' in script_info and hasattr(script_info['log_file'], 'close') and not script_info['log_file'].closed:
-                try:
-                    script_info['log_file'].close()
-                except Exception as log_e:
-                    logger.error(f"Error closing log file during cleanup of non-existent process {script_key}: {log_e}")
-            if script_key in bot_scripts:
-                del bot_scripts[script_key]
+            io = proc.io_counters()
+            io_bytes = io.read_bytes + io.write_bytes
+        except (psutil.AccessDenied, AttributeError):
+            io_bytes = 0
+    _store_sample(entry, cpu, rss, io_bytes, threads)
+
+def _store_sample(entry, cpu, rss, io_bytes, threads):
+    pos = entry['pos']
+    entry['cpu'][pos] = cpu
+    entry['rss'][pos] = rss
+    entry['io'][pos] = io_bytes
+    entry['threads'][pos] = min(threads, 65535)
+    entry['pos'] = (pos + 1) % RESOURCE_SAMPLE_HISTORY
+    entry['count'] = min(entry['count'] + 1, RESOURCE_SAMPLE_HISTORY)
+
+def resource_sampler_loop():
+    while True:
+        started = time.monotonic()
+        live_keys = set()
+        for script_key, script_info in list(bot_scripts.items()):
+            process = script_info.get('process')
+            if not process:
+                continue
+            live_keys.add(script_key)
+            entry = script_samples.get(script_key)
+            try:
+                if entry is None or entry['pid'] != process.pid:
+                    entry = _new_sample_entry(process.pid, remote=bool(script_info.get('node')))
+                    script_samples[script_key] = entry
+                if entry['proc'] is not None:
+                    _take_sample(entry)
+                elif process.stats:
+                    # Remote script: the latest numbers its worker reported to the poller.
+                    stats = process.stats
+                    _store_sample(entry, stats.get('cpu', 0), stats.get('rss', 0), stats.get('io', 0), stats.get('threads', 0))
+            except psutil.NoSuchProcess:
+                script_samples.pop(script_key, None)
+            except Exception as e:
+                logger.error(f"Resource sampler error for {script_key}: {e}")
+        for script_key in list(script_samples):
+            if script_key not in live_keys:
+                script_samples.pop(script_key, None)
+        time.sleep(max(0.5, RESOURCE_SAMPLE_INTERVAL - (time.monotonic() - started)))
+
+def get_sample_series(script_key, metric):
+    """Oldest-to-newest samples of `metric` ('cpu', 'rss', 'io', 'threads')."""
+    entry = script_samples.get(script_key)
+    if not entry or not entry['count']:
+        return []
+    buf, pos, count = entry[metric], entry['pos'], entry['count']
+    ordered = buf[pos:] + buf[:pos] if count == RESOURCE_SAMPLE_HISTORY else buf[:count]
+    return list(ordered)
+
+def get_latest_sample(script_key):
+    entry = script_samples.get(script_key)
+    if not entry or not entry['count']:
+        return None
+    last = (entry['pos'] - 1) % RESOURCE_SAMPLE_HISTORY
+    return {'pid': entry['pid'], 'cpu': entry['cpu'][last], 'rss': entry['rss'][last],
+            'io': entry['io'][last], 'threads': entry['threads'][last]}
+
+def make_sparkline(values, width=20):
+    values = values[-width:]
+    if not values:
+        return ''
+    top = max(values) or 1
+    return ''.join(SPARK_CHARS[min(len(SPARK_CHARS) - 1, int(v / top * (len(SPARK_CHARS) - 1)))] for v in values)
+
+def format_resource_usage(script_key):
+    latest = get_latest_sample(script_key)
+    if not latest:
+        return ""
+    rss_series = [v / 1024 / 1024 for v in get_sample_series(script_key, 'rss')]
+    return (f"\n📈 CPU {make_sparkline(get_sample_series(script_key, 'cpu'))} {latest['cpu']:.1f}%"
+            f"\n💾 RAM {make_sparkline(rss_series)} {latest['rss'] / 1024 / 1024:.1f} MB"
+            f" | 🧵 {latest['threads']} threads")
+# --- End Resource Sampler ---
+
+def _script_alive(target):
+    """Whether a script or anything left in its session is still running. Popen.poll() may reap the
+    child before the supervisor does; the supervisor collects the exit through the same Popen object,
+    whose wait() then returns the stored returncode."""
+    script_key, process, pgid, proc = target
+    if process is not None and process.poll() is None:
+        return True
+    if pgid:
+        try:
+            os.killpg(pgid, 0)
+            return True
+        except ProcessLookupError:
             return False
-        except Exception as e:
-            logger.error(f"Error checking process status for {script_key}: {e}", exc_info=True)
+        except PermissionError:
+            return True
+    if proc is not None:
+        try:
+            return proc.status() != psutil.STATUS_ZOMBIE
+        except psutil.NoSuchProcess:
             return False
     return False
 
-def kill_process_tree(process_info):
-    pid = None
-    log_file_closed = False
-    script_key = process_info.get('script_key', 'N/A')
-
+def _signal_script(target, kill=False):
+    script_key, process, pgid, proc = target
     try:
-        if 'log_file' in process_info and hasattr(process_info['log_file'], 'close') and not process_info['log_file'].closed:
-            try:
-                process_info['log_file'].close()
-                log_file_closed = True
-                logger.info(f"Closed log file for {script_key} (PID: {process_info.get('process', {}).get('pid', 'N/A')})")
-            except Exception as log_e:
-                logger.error(f"Error closing log file during kill for {script_key}: {log_e}")
+        if pgid:
+            os.killpg(pgid, signal.SIGKILL if kill else signal.SIGTERM)
+        elif kill:
+            (process or proc).kill()
+        else:
+            (process or proc).terminate()
+        return True
+    except (psutil.NoSuchProcess, ProcessLookupError):
+        return False
+    except Exception as e:
+        logger.error(f"Error sending {'SIGKILL' if kill else 'SIGTERM'} for {script_key}: {e}")
+        return False
 
+def terminate_scripts(process_infos, timeout=SHUTDOWN_GRACE_SECONDS):
+    """Stop many scripts at once against a single deadline.
+    Every script runs in its own session, so one killpg() per script reaches all
+    of its descendants. SIGTERM goes to every group up front, then we wait on
+    all of them together; groups still alive at the deadline get SIGKILL.
+    Returns {'scripts', 'killed', 'elapsed'}."""
+    started = time.time()
+    targets = []
+    for process_info in process_infos:
+        if not process_info:
+            continue
+        script_key = process_info.get('script_key', 'N/A')
+        process_info['stopping'] = True
+        log_file = process_info.get('log_file')
+        if log_file is not None and hasattr(log_file, 'close') and not log_file.closed:
+            try:
+                log_file.close()
+            except Exception as e:
+                logger.error(f"Error closing log file during kill for {script_key}: {e}")
         process = process_info.get('process')
-        if process and hasattr(process, 'pid'):
-            pid = process.pid
-            if pid:
-                try:
-                    parent = psutil.Process(pid)
-                    children = parent.children(recursive=True)
-                    logger.info(f"Attempting to kill process tree for {script_key} (PID: {pid}, Children: {[c.pid for c in children]})")
-
-                    for child in children:
-                        try:
-                            child.terminate()
-                            logger.info(f"Terminated child process {child.pid} for {script_key}")
-                        except psutil.NoSuchProcess:
-                            logger.warning(f"Child process {child.pid} for {script_key} already gone.")
-                        except Exception as e:
-                            logger.error(f"Error terminating child {child.pid} for {script_key}: {e}. Trying kill...")
-                            try:
-                                child.kill()
-                                logger.info(f"Killed child process {child.pid} for {script_key}")
-                            except Exception as e2:
-                                logger.error(f"Failed to kill child {child.pid} for {script_key}: {e2}")
-
-                    gone, alive = psutil.wait_procs(children, timeout=1)
-                    for p in alive:
-                        logger.warning(f"Child process {p.pid} for {script_key} still alive. Killing.")
-                        try:
-                            p.kill()
-                        except Exception as e:
-                            logger.error(f"Failed to kill child {p.pid} for {script_key} after wait: {e}")
+        pgid = process_info.get('pgid')
+        if pgid or process_info.get('node'):
+            # Remote scripts: the worker agent signals the group on its side.
+            targets.append((script_key, process, pgid, None))
+        elif getattr(process, 'pid', None):
+            # No process group (Windows): fall back to walking the tree.
+            try:
+                descendants = psutil.Process(process.pid).children(recursive=True)
+            except psutil.Error:
+                descendants = []
+            targets.append((script_key, process, None, None))
+            targets.extend((script_key, None, None, child) for child in descendants)
+        else:
+            logger.warning(f"No process to stop for {script_key}.")
+
+    for target in targets:
+        _signal_script(target)
+
+    deadline = started + timeout
+    alive = targets
+    while alive and time.time() < deadline:
+        alive = [t for t in alive if _script_alive(t)]
+        if alive:
+            time.sleep(0.05)
+
+    killed = set()
+    for target in alive:
+        logger.warning(f"{target[0]} ignored SIGTERM for {timeout}s. Killing.")
+        if _signal_script(target, kill=True):
+            killed.add(target[0])
+    kill_deadline = time.time() + 2
+    while alive and time.time() < kill_deadline:
+        alive = [t for t in alive if _script_alive(t)]
+        if alive:
+            time.sleep(0.02)
+    for target in alive:
+        logger.error(f"{target[0]} survived SIGKILL.")
+
+    stats = {'scripts': len({t[0] for t in targets}), 'killed': len(killed), 'elapsed': time.time() - started}
+    if stats['scripts'] > 1:
+        logger.info(f"Stopped {stats['scripts']} scripts ({stats['killed']} needed SIGKILL) in {stats['elapsed']:.2f}s")
+    return stats
+
+# --- Orphan Sweep ---
+# Anything whose cwd is inside upload_bots but which is not in the session of a
+# script we are hosting (e.g. a double-forked daemon, or a child that outlived
+# its script) is a leak. Only processes older than ORPHAN_MIN_AGE are
+# considered so a script that is still being registered is never touched.
+orphan_sweep_stats = {'runs': 0, 'reaped': 0, 'last_run': None}
+
+def _tracked_script_sessions():
+    with SCRIPT_STATE_LOCK:
+        infos = list(bot_scripts.values())
+    sessions, cgroups = set(), set()
+    for info in infos:
+        if info.get('pgid'):
+            sessions.add(info['pgid'])
+        if info.get('cgroup_dir'):
+            cgroups.add(info['cgroup_dir'])
+    return sessions, cgroups
+
+def _process_cgroup_dir(pid):
+    try:
+        with open(f"/proc/{pid}/cgroup") as f:
+            for line in f:
+                if line.startswith('0::'):
+                    return os.path.join(CGROUP_ROOT, line[3:].strip().lstrip('/'))
+    except OSError:
+        pass
+    return None
+
+def find_orphan_processes():
+    """Processes running from a user folder that no hosted script owns."""
+    sessions, cgroups = _tracked_script_sessions()
+    upload_root = os.path.abspath(UPLOAD_BOTS_DIR) + os.sep
+    skip_pids = {os.getpid()}
+    if _zygote_process is not None:
+        skip_pids.add(_zygote_process.pid)
+    cutoff = time.time() - ORPHAN_MIN_AGE
+    orphans = []
+    for proc in psutil.process_iter(['pid', 'cwd', 'create_time']):
+        try:
+            cwd = proc.info.get('cwd')
+            if not cwd or not (cwd + os.sep).startswith(upload_root) or proc.info['pid'] in skip_pids:
+                continue
+            if proc.info['create_time'] > cutoff or proc.status() == psutil.STATUS_ZOMBIE:
+                continue
+            if os.getsid(proc.pid) in sessions or _process_cgroup_dir(proc.pid) in cgroups:
+                continue
+            orphans.append(proc)
+        except (psutil.Error, OSError):
+            continue
+    return orphans
 
-                    try:
-                        parent.terminate()
-                        logger.info(f"Terminated parent process {pid} for {script_key}")
-                        try:
-                            parent.wait(timeout=1)
-                        except psutil.TimeoutExpired:
-                            logger.warning(f"Parent process {pid} for {script_key} did not terminate. Killing.")
-                            parent.kill()
-                            logger.info(f"Killed parent process {pid} for {script_key}")
-                    except psutil.NoSuchProcess:
-                        logger.warning(f"Parent process {pid} for {script_key} already gone.")
-                    except Exception as e:
-                        logger.error(f"Error terminating parent {pid} for {script_key}: {e}. Trying kill...")
-                        try:
-                            parent.kill()
-                            logger.info(f"Killed parent process {pid} for {script_key}")
-                        except Exception as e2:
-                            logger.error(f"Failed to kill parent {pid} for {script_key}: {e2}")
-
-                except psutil.NoSuchProcess:
-                    logger.warning(f"Process {pid or 'N/A'} for {script_key} not found during kill. Already terminated?")
+def _kill_surviving_orphans(procs):
+    for proc in procs:
+        try:
+            if proc.is_running() and proc.status() != psutil.STATUS_ZOMBIE:
+                proc.kill()
+                logger.warning(f"Orphan sweep: PID {proc.pid} ignored SIGTERM, killed.")
+        except psutil.Error:
+            pass
+
+def sweep_orphan_processes():
+    """Terminate leaked script descendants; survivors are SIGKILLed on a later tick."""
+    orphans = find_orphan_processes()
+    orphan_sweep_stats['runs'] += 1
+    orphan_sweep_stats['last_run'] = datetime.now()
+    for proc in orphans:
+        try:
+            cmdline = ' '.join(proc.cmdline())[:200]
+            user_dir = os.path.relpath(proc.info['cwd'], UPLOAD_BOTS_DIR).split(os.sep)[0]
+            logger.warning(f"Orphan sweep: terminating PID {proc.pid} (user folder {user_dir}, "
+                           f"RSS {proc.memory_info().rss / 1024 / 1024:.1f} MB): {cmdline}")
+            proc.terminate()
+        except psutil.Error:
+            pass
+    if orphans:
+        orphan_sweep_stats['reaped'] += len(orphans)
+        schedule_task(SHUTDOWN_GRACE_SECONDS, _kill_surviving_orphans, orphans)
+    return len(orphans)
+
+def _orphan_sweep_tick():
+    if shutting_down:
+        return
+    try:
+        sweep_orphan_processes()
+    except Exception as e:
+        logger.error(f"Orphan sweep failed: {e}", exc_info=True)
+    schedule_task(ORPHAN_SWEEP_INTERVAL, _orphan_sweep_tick)
+# --- End Orphan Sweep ---
+
+# --- Worker Nodes ---
+# Scripts can be placed on worker agents instead of this host. A remote script
+# gets a RemoteScriptProcess in bot_scripts, so stop/restart, the restart
+# policies and bulk stops work unchanged; a poller thread reads each agent's
+# /status (in parallel, so a dead node only delays itself) and hands the result
+# to the task scheduler to pick up exits, capacity and resource samples.
+worker_nodes = {name: {'url': url.rstrip('/'), 'status': None, 'last_seen': 0, 'error': None,
+                       'reserved_mb': 0, 'reserved_cpu': 0.0}
+                for name, url in WORKER_NODES.items()}
+script_placements = {}
+
+class WorkerNodeError(Exception):
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+def _quote_key(script_key):
+    """Script keys contain the user's file name; quote it whole so '#', '?', '%' or '/' stay in the path segment."""
+    return urllib.parse.quote(script_key, safe='')
+
+def _worker_call(node_name, method, path, timeout=10, **kwargs):
+    node = worker_nodes[node_name]
+    try:
+        response = requests.request(method, node['url'] + path, headers={'X-Worker-Token': WORKER_TOKEN},
+                                    timeout=timeout, **kwargs)
+    except requests.exceptions.RequestException as e:
+        raise WorkerNodeError(f"worker {node_name} unreachable: {e}")
+    try:
+        payload = response.json()
+    except ValueError:
+        payload = {'error': response.text[:500]}
+    if response.status_code >= 400:
+        raise WorkerNodeError(payload.get('error') or f"HTTP {response.status_code}", response.status_code)
+    return payload
+
+class RemoteScriptProcess:
+    """Popen-like handle for a script running on a worker agent."""
+
+    def __init__(self, node_name, script_key, pid):
+        self.node = node_name
+        self.script_key = script_key
+        self.pid = pid
+        self.returncode = None
+        self.stats = None
+        self._exited = threading.Event()
+        self._last_check = 0
+
+    def _set_exit(self, returncode):
+        if not self._exited.is_set():
+            self.returncode = returncode
+            self._exited.set()
+
+    def poll(self):
+        # Rate-limited so a bulk stop polling many scripts stays cheap.
+        if not self._exited.is_set() and time.monotonic() - self._last_check > 0.5:
+            self._last_check = time.monotonic()
+            try:
+                state = _worker_call(self.node, 'GET', f'/scripts/{_quote_key(self.script_key)}', timeout=5)
+                if state.get('pid') != self.pid:
+                    self._set_exit(None)
+                elif not state.get('running'):
+                    self._set_exit(state.get('returncode'))
+            except WorkerNodeError as e:
+                if e.status_code == 404:
+                    self._set_exit(None)
+        return self.returncode
+
+    def wait(self, timeout=None):
+        if not self._exited.wait(timeout):
+            raise subprocess.TimeoutExpired(f"{self.node}:{self.script_key}", timeout)
+        return self.returncode
+
+    def _stop(self, grace):
+        try:
+            _worker_call(self.node, 'POST', f'/scripts/{_quote_key(self.script_key)}/stop', json={'grace': grace})
+        except WorkerNodeError as e:
+            if e.status_code != 404:
+                raise
+            self._set_exit(None)
+
+    def send_signal(self, signum):
+        self._stop(0 if signum == getattr(signal, 'SIGKILL', None) else SHUTDOWN_GRACE_SECONDS)
+
+    def terminate(self):
+        self._stop(SHUTDOWN_GRACE_SECONDS)
+
+    def kill(self):
+        self._stop(0)
+
+def _node_headroom(free_mb, free_cpu, limits):
+    """How many more scripts with `limits` fit, or None when the node is out of memory."""
+    need_mb = max(limits.get('memory_mb') or 0, 64)
+    need_cpu = max(limits.get('cpu') or 0, 0.1)
+    if free_mb - need_mb < MIN_FREE_MEMORY_MB:
+        return None
+    return min((free_mb - MIN_FREE_MEMORY_MB) / need_mb, max(free_cpu, 0) / need_cpu)
+
+def pick_script_node(limits=None):
+    """Node with the most headroom for a script: LOCAL_NODE, a worker name, or None when all are full."""
+    limits = limits or {}
+    candidates = []
+    if RUN_SCRIPTS_LOCALLY or not worker_nodes:
+        free_mb = psutil.virtual_memory().available // (1024 * 1024)
+        cpu_count = os.cpu_count() or 1
+        free_cpu = cpu_count - os.getloadavg()[0] if hasattr(os, 'getloadavg') else cpu_count
+        headroom = _node_headroom(free_mb, free_cpu, limits)
+        if headroom is not None:
+            candidates.append((headroom, free_mb, LOCAL_NODE))
+    now = time.time()
+    for name, node in list(worker_nodes.items()):
+        status = node['status']
+        if not status or now - node['last_seen'] > WORKER_OFFLINE_AFTER:
+            continue
+        free_mb = status['mem_free_mb'] - node['reserved_mb']
+        headroom = _node_headroom(free_mb, status['cpu_free'] - node['reserved_cpu'], limits)
+        if headroom is not None:
+            candidates.append((headroom, free_mb, name))
+    return max(candidates)[2] if candidates else None
+
+def _reserve_on_node(node_name, limits):
+    # Capacity only refreshes every WORKER_POLL_INTERVAL; account for starts placed in between.
+    node = worker_nodes.get(node_name)
+    if node:
+        node['reserved_mb'] += max(limits.get('memory_mb') or 0, 64)
+        node['reserved_cpu'] += max(limits.get('cpu') or 0, 0.1)
+
+def _bundle_user_folder(user_folder):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as bundle:
+        for root, dirs, files in os.walk(user_folder):
+            dirs[:] = [d for d in dirs if d != '__pycache__']
+            for name in files:
+                if name.endswith(('.log', '.pyc')):
+                    continue
+                path = os.path.join(root, name)
+                bundle.write(path, os.path.relpath(path, user_folder))
+    return base64.b64encode(buffer.getvalue()).decode('ascii')
+
+def _remote_script_entry(node_name, script_key, pid, script_owner_id, file_name, message, tier, limits, start_time):
+    return {'process': RemoteScriptProcess(node_name, script_key, pid), 'log_file': None, 'log_path': None,
+            'file_name': file_name, 'chat_id': message.chat.id if message else script_owner_id,
+            'script_owner_id': script_owner_id, 'start_time': start_time,
+            'user_folder': get_user_folder(script_owner_id), 'type': 'py', 'script_key': script_key,
+            'message': message, 'tier': tier, 'limits': limits, 'cgroup_dir': None, 'pgid': None, 'node': node_name}
+
+def start_script_on_worker(node_name, script_owner_id, user_folder, file_name, message_obj_for_reply, tier, limits, requirements):
+    script_key = f"{script_owner_id}_{file_name}"
+    try:
+        reply = _worker_call(node_name, 'POST', '/scripts/start', timeout=120 + 60 * len(requirements), json={
+            'script_key': script_key, 'user_id': script_owner_id, 'file_name': file_name,
+            'bundle': _bundle_user_folder(user_folder), 'requirements': requirements, 'limits': limits})
+    except Exception as e:
+        logger.error(f"Failed to start {script_key} on worker {node_name}: {e}")
+        reply_or_notify(message_obj_for_reply, f"❌ Error starting Python script '{file_name}' on worker `{node_name}`: {e}",
+                        chat_id=script_owner_id)
+        return
+    _reserve_on_node(node_name, limits)
+    with SCRIPT_STATE_LOCK:
+        bot_scripts[script_key] = _remote_script_entry(node_name, script_key, reply['pid'], script_owner_id, file_name,
+                                                       message_obj_for_reply, tier, limits, datetime.now())
+        script_placements[script_key] = node_name
+    set_script_desired_state(script_owner_id, file_name, 'running')
+    logger.info(f"Started {script_key} on worker {node_name} (remote PID {reply['pid']}, tier: {tier})")
+    reply_or_notify(message_obj_for_reply, f"✅ Python script '{file_name}' started on worker `{node_name}`! "
+                                           f"(PID: {reply['pid']}) (For User: {script_owner_id})")
+
+def _mark_node_lost(node_name):
+    node = worker_nodes[node_name]
+    logger.error(f"Worker {node_name} unreachable for {WORKER_OFFLINE_AFTER}s ({node['error']}). Its scripts are treated as lost.")
+    node['status'] = None
+    with SCRIPT_STATE_LOCK:
+        lost = [(key, info) for key, info in bot_scripts.items() if info.get('node') == node_name]
+    for script_key, info in lost:
+        info['exit_reason'] = f"lost: worker {node_name} stopped responding"
+        info['process']._set_exit(None)
+        _handle_script_exit(script_key, info['process'])
+
+def _fetch_worker_statuses():
+    """{node name: /status payload or WorkerNodeError}, all nodes queried at once."""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(worker_nodes)), thread_name_prefix='worker-status') as pool:
+        futures = {node_name: pool.submit(_worker_call, node_name, 'GET', '/status', timeout=5) for node_name in worker_nodes}
+    statuses = {}
+    for node_name, future in futures.items():
+        try:
+            statuses[node_name] = future.result()
+        except WorkerNodeError as e:
+            statuses[node_name] = e
+    return statuses
+
+def refresh_worker_nodes(adopt=False):
+    """Poll every worker's /status and apply it (blocks for up to the request timeout)."""
+    apply_worker_statuses(_fetch_worker_statuses(), adopt)
+
+def apply_worker_statuses(statuses, adopt=False):
+    """Pick up exits and capacity from polled statuses. With adopt=True, scripts the workers
+    are already running (e.g. after a bot restart) are taken back into bot_scripts."""
+    for node_name, status in statuses.items():
+        node = worker_nodes[node_name]
+        if isinstance(status, WorkerNodeError):
+            node['error'] = str(status)
+            if node['status'] is not None and time.time() - node['last_seen'] > WORKER_OFFLINE_AFTER:
+                _mark_node_lost(node_name)
+            continue
+        node.update(status=status, last_seen=time.time(), error=None, reserved_mb=0, reserved_cpu=0.0)
+        remote_scripts = status.get('scripts', {})
+        with SCRIPT_STATE_LOCK:
+            ours = [(key, info) for key, info in bot_scripts.items() if info.get('node') == node_name]
+        for script_key, info in ours:
+            process = info['process']
+            state = remote_scripts.get(script_key)
+            if state and state.get('pid') == process.pid and state.get('running'):
+                process.stats = state
+                continue
+            if state and state.get('pid') == process.pid:
+                process._set_exit(state.get('returncode'))
             else:
-                logger.error(f"Process PID is None for {script_key}.")
-        elif log_file_closed:
-            logger.warning(f"Process object missing for {script_key}, but log file closed.")
-        else:
-            logger.error(f"Process object missing for {script_key}, and no log file. Cannot kill.")
+                info['exit_reason'] = f"lost: no longer running on worker {node_name}"
+                process._set_exit(None)
+            _handle_script_exit(script_key, process)
+        if adopt:
+            for script_key, state in remote_scripts.items():
+                if not state.get('running') or script_key in bot_scripts:
+                    continue
+                owner_id = state['user_id']
+                tier = get_user_tier(owner_id)
+                with SCRIPT_STATE_LOCK:
+                    bot_scripts[script_key] = _remote_script_entry(
+                        node_name, script_key, state['pid'], owner_id, state['file_name'], None, tier,
+                        TIER_RESOURCE_LIMITS.get(tier, {}), datetime.fromtimestamp(state['started']))
+                    script_placements[script_key] = node_name
+                logger.info(f"Adopted {script_key} already running on worker {node_name} (remote PID {state['pid']}).")
+
+def _apply_worker_poll(statuses):
+    if shutting_down:
+        return
+    try:
+        apply_worker_statuses(statuses)
+    except Exception as e:
+        logger.error(f"Worker poll failed: {e}", exc_info=True)
+    notify_start_scheduler()
+
+def worker_poll_loop():
+    # The HTTP requests run here; only applying the results happens on the task scheduler.
+    while not shutting_down:
+        time.sleep(WORKER_POLL_INTERVAL)
+        try:
+            schedule_task(0, _apply_worker_poll, _fetch_worker_statuses())
+        except Exception as e:
+            logger.error(f"Worker poll failed: {e}", exc_info=True)
+
+def read_script_log_tail(script_owner_id, file_name, max_bytes):
+    """(total size, last max_bytes of the log as text) from wherever the script last ran, or None."""
+    script_key = f"{script_owner_id}_{file_name}"
+    node_name = script_placements.get(script_key)
+    if node_name in worker_nodes:
+        try:
+            payload = _worker_call(node_name, 'GET', f'/scripts/{_quote_key(script_key)}/logs', params={'bytes': max_bytes})
+            return payload['size'], payload['log']
+        except WorkerNodeError as e:
+            logger.warning(f"Could not fetch log of {script_key} from worker {node_name}: {e}")
+            return None
+    log_path = os.path.join(get_user_folder(script_owner_id), f"{os.path.splitext(file_name)[0]}.log")
+    if not os.path.exists(log_path):
+        return None
+    with open(log_path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(0, size - max_bytes))
+        return size, f.read().decode('utf-8', errors='ignore')
+
+def format_script_node(script_key):
+    node_name = script_placements.get(script_key)
+    return f" @ {node_name}" if node_name in worker_nodes else ''
+# --- End Worker Nodes ---
+
+def kill_process_tree(process_info):
+    try:
+        terminate_scripts([process_info])
     except Exception as e:
-        logger.error(f"❌ Unexpected error killing process tree for PID {pid or 'N/A'} ({script_key}): {e}", exc_info=True)
+        logger.error(f"❌ Unexpected error killing process tree for {process_info.get('script_key', 'N/A')}: {e}", exc_info=True)
 
 # --- Automatic Package Installation & Script Running ---
-def check_package_installed(package_name):
+# Installed distributions, normalized name -> version, per environment (None
+# is the bot's own interpreter, a user id is that user's venv). Built once from
+# importlib.metadata on first use and patched after each install, so checking
+# a requirement never forks `pip show`.
+_installed_indexes = {}
+_installed_index_generations = {}  # bumped whenever an environment's index changes
+_installed_dists_lock = threading.Lock()
+
+def normalize_dist_name(name):
+    """PEP 503 name normalization: 'Foo_Bar.baz' -> 'foo-bar-baz'."""
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+def _build_installed_index(user_id=None):
+    index = {}
+    if user_id is None:
+        dists = importlib.metadata.distributions()
+    else:
+        dists = importlib.metadata.distributions(path=[get_venv_site_packages(get_user_venv_dir(user_id))])
+    for dist in dists:
+        name = dist.metadata['Name']
+        if name:
+            index.setdefault(normalize_dist_name(name), dist.version)
+    return index
+
+def get_installed_index(user_id=None):
+    index = _installed_indexes.get(user_id)
+    if index is None:
+        with _installed_dists_lock:
+            index = _installed_indexes.get(user_id)
+            if index is None:
+                started = time.time()
+                index = _installed_indexes[user_id] = _build_installed_index(user_id)
+                logger.info(f"Indexed {len(index)} installed distributions"
+                            f"{f' in venv of user {user_id}' if user_id is not None else ''} in {(time.time() - started) * 1000:.1f} ms")
+    return index
+
+def installed_version(package_name, user_id=None):
+    """Installed version of a distribution (extras ignored), or None."""
+    return get_installed_index(user_id).get(normalize_dist_name(package_name.split('[', 1)[0].strip()))
+
+def invalidate_installed_index(user_id=None):
+    with _installed_dists_lock:
+        _installed_indexes.pop(user_id, None)
+        _installed_index_generations[user_id] = _installed_index_generations.get(user_id, 0) + 1
+
+def update_installed_index(pip_output, user_id=None, installed=None):
+    """Apply pip's 'Successfully installed a-1.0 b-2.0' line (or an {name: version} dict) to the index;
+    rebuild lazily when neither is available."""
+    importlib.invalidate_caches()
+    if user_id is None:
+        invalidate_import_resolver()
+    if installed is None:
+        match = re.search(r'^Successfully installed (.+)$', pip_output or '', re.MULTILINE)
+        if not match:
+            invalidate_installed_index(user_id)
+            return
+        installed = {}
+        for item in match.group(1).split():
+            name, _, version = item.rpartition('-')
+            if name:
+                installed[name] = version
+    with _installed_dists_lock:
+        _installed_index_generations[user_id] = _installed_index_generations.get(user_id, 0) + 1
+        index = _installed_indexes.get(user_id)
+        if index is not None:
+            for name, version in installed.items():
+                index[normalize_dist_name(name)] = version
+
+def check_package_installed(package_name, user_id=None):
     """Check if a package is already installed"""
+    return installed_version(package_name, user_id) is not None
+
+class ProgressMessage:
+    """One chat message that is edited as a long operation advances, instead of a reply per step."""
+
+    def __init__(self, message, text, chat_id=None, min_interval=2):
+        self.text = text
+        self.min_interval = min_interval
+        self._last_edit = time.time()
+        try:
+            self.sent = reply_or_notify(message, text, chat_id=chat_id)
+        except Exception as e:
+            logger.error(f"Could not send progress message: {e}")
+            self.sent = None
+
+    def update(self, text, force=False):
+        # Telegram rate-limits edits, so intermediate states are dropped unless enough time has passed.
+        if text == self.text or (not force and time.time() - self._last_edit < self.min_interval):
+            return
+        self.text = text
+        self._last_edit = time.time()
+        if self.sent is None:
+            logger.info(f"(progress) {text}")
+            return
+        try:
+            bot.edit_message_text(text[:4096], self.sent.chat.id, self.sent.message_id)
+        except Exception as e:
+            if "message is not modified" not in str(e):
+                logger.warning(f"Could not edit progress message: {e}")
+
+    def finish(self, text):
+        self.update(text, force=True)
+
+def requirement_name(requirement):
+    match = re.match(r'\s*([A-Za-z0-9][A-Za-z0-9._-]*)', requirement)
+    return match.group(1) if match else requirement.strip()
+
+_PIP_PROGRESS_PATTERNS = [
+    (re.compile(r'^Collecting (\S+)'), 'Collecting'),
+    (re.compile(r'^\s*Downloading (\S+)'), 'Downloading'),
+    (re.compile(r'^Building wheels? for (\S+)'), 'Building'),
+    (re.compile(r'^Installing collected packages: (.+)'), 'Installing'),
+]
+
+def _record_pip_error(line, result):
+    if line.startswith('ERROR: '):
+        failed = re.search(r'(?:satisfies the requirement|distribution found for) (\S+)', line)
+        if failed:
+            result['failed'][normalize_dist_name(requirement_name(failed.group(1)))] = line[7:]
+
+# --- Wheelhouse ---
+# Installs resolve against a local directory of wheels first (--no-index
+# --find-links), so popular packages are downloaded once per host instead of
+# once per install, and installs keep working without egress. A miss fills the
+# wheelhouse with `pip wheel` (which also builds sdists into wheels) and
+# retries locally. Wheels are evicted least-recently-used first once the
+# wheelhouse is larger than WHEELHOUSE_MAX_MB; use refreshes a wheel's mtime.
+# Install jobs are queued per environment, so ten users asking for the same
+# packages at once still reach this point ten times: a fill (and a store
+# unpack, below) already in flight for the same key is joined, not repeated.
+_wheelhouse_lock = threading.Lock()
+_wheelhouse_fill_lock = threading.Lock()  # fills from different environments write the same directory
+_shared_work_lock = threading.Lock()
+_wheelhouse_fills = {}  # fill key -> Future of the running fill
+WHEELHOUSE_STATS_FILE = 'stats.json'
+_wheelhouse_stats = None
+
+def _wheelhouse_counters():
+    global _wheelhouse_stats
+    if _wheelhouse_stats is None:
+        try:
+            with open(os.path.join(WHEELHOUSE_DIR, WHEELHOUSE_STATS_FILE)) as f:
+                _wheelhouse_stats = json.load(f)
+        except (OSError, ValueError):
+            _wheelhouse_stats = {}
+        for key in ('hits', 'misses', 'downloaded', 'evicted', 'evicted_bytes'):
+            _wheelhouse_stats.setdefault(key, 0)
+    return _wheelhouse_stats
+
+def _save_wheelhouse_counters():
+    path = os.path.join(WHEELHOUSE_DIR, WHEELHOUSE_STATS_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(_wheelhouse_stats, f)
+    os.replace(path + '.tmp', path)
+
+def wheelhouse_index_args():
+    return ['--no-index', '--find-links', WHEELHOUSE_DIR]
+
+def list_wheelhouse():
+    """[(path, size, mtime)] of every wheel, oldest use first."""
+    wheels = []
+    for entry in os.scandir(WHEELHOUSE_DIR):
+        if entry.name.endswith('.whl') and entry.is_file():
+            st = entry.stat()
+            wheels.append((entry.path, st.st_size, st.st_mtime))
+    wheels.sort(key=lambda w: w[2])
+    return wheels
+
+def evict_wheelhouse(max_bytes=None):
+    """Drop least recently used wheels until the wheelhouse fits in max_bytes. Returns (count, bytes) removed."""
+    max_bytes = WHEELHOUSE_MAX_MB * 1024 * 1024 if max_bytes is None else max_bytes
+    with _wheelhouse_lock:
+        wheels = list_wheelhouse()
+        total = sum(size for _, size, _ in wheels)
+        removed = freed = 0
+        for path, size, _ in wheels:
+            if total <= max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+            freed += size
+        if removed:
+            counters = _wheelhouse_counters()
+            counters['evicted'] += removed
+            counters['evicted_bytes'] += freed
+            _save_wheelhouse_counters()
+            logger.info(f"Wheelhouse: evicted {removed} wheels ({freed / 1024 / 1024:.1f} MB)")
+    return removed, freed
+
+def record_wheelhouse_use(hit, wheels, downloaded=0):
+    """Count an install as a hit (served entirely from the wheelhouse) or a miss, and mark its wheels as used."""
+    now = time.time()
+    for name in wheels:
+        try:
+            os.utime(os.path.join(WHEELHOUSE_DIR, name), (now, now))
+        except OSError:
+            pass
+    with _wheelhouse_lock:
+        counters = _wheelhouse_counters()
+        counters['hits' if hit else 'misses'] += 1
+        counters['downloaded'] += downloaded
+        _save_wheelhouse_counters()
+
+def _run_shared(inflight, key, func, *args):
+    """Run func(*args) once per key among concurrent callers. Returns (result, joined): callers that
+    arrive while it runs wait for the first one and get its result (or exception) with joined=True."""
+    with _shared_work_lock:
+        future = inflight.get(key)
+        joined = future is not None
+        if not joined:
+            future = inflight[key] = concurrent.futures.Future()
+    if joined:
+        return future.result(), True
     try:
-        result = subprocess.run([sys.executable, '-m', 'pip', 'show', package_name], 
-                              capture_output=True, text=True, check=False)
-        return result.returncode == 0
-    except Exception:
-        return False
+        future.set_result(func(*args))
+    except BaseException as e:
+        future.set_exception(e)
+    finally:
+        with _shared_work_lock:
+            inflight.pop(key, None)
+    return future.result(), False
 
-def install_missing_requirements(req_path, message):
-    """Install only missing requirements from requirements.txt"""
+def _fill_key(requirements, constraints):
+    digest = hashlib.sha256()
+    for constraint_path in constraints:  # per-user paths; only the pinned contents matter
+        try:
+            with open(constraint_path, 'rb') as f:
+                digest.update(hashlib.sha256(f.read()).digest())
+        except OSError:
+            digest.update(constraint_path.encode())
+    return tuple(sorted(requirements)), digest.hexdigest()
+
+def fill_wheelhouse(requirements, constraints=(), progress=None):
+    """Download/build wheels for `requirements` and their dependencies. Returns {'ok', 'downloaded', 'output'}.
+    A fill of the same requirements already running for another environment is joined instead of repeated."""
+    if progress:
+        progress.update(f"{progress.text.split(chr(10))[0]}\n⏳ Downloading {len(requirements)} requirements to the wheelhouse",
+                        force=True)
+    result, joined = _run_shared(_wheelhouse_fills, _fill_key(requirements, constraints), _fill_wheelhouse,
+                                 requirements, constraints)
+    if joined:
+        logger.info(f"Wheelhouse: joined a running fill for {len(requirements)} requirements")
+        return dict(result, downloaded=0)  # counted once, by the install that ran it
+    return result
+
+def _fill_wheelhouse(requirements, constraints):
+    command = [sys.executable, '-m', 'pip', 'wheel', '--progress-bar', 'off', '--wheel-dir', WHEELHOUSE_DIR,
+               '--find-links', WHEELHOUSE_DIR] + list(requirements)
+    for constraint_path in constraints:
+        command += ['-c', constraint_path]
+    with _wheelhouse_fill_lock:
+        before = {os.path.basename(path) for path, _, _ in list_wheelhouse()}
+        started = time.time()
+        try:
+            proc = subprocess.run(command, capture_output=True, text=True, encoding='utf-8', errors='ignore',
+                                  timeout=120 + 60 * len(requirements))
+            ok, output = proc.returncode == 0, proc.stdout + proc.stderr
+        except subprocess.TimeoutExpired:
+            ok, output = False, "pip wheel timed out"
+        downloaded = [path for path, _, _ in list_wheelhouse() if os.path.basename(path) not in before]
+    logger.info(f"Wheelhouse: fetched {len(downloaded)} wheels for {len(requirements)} requirements "
+                f"in {time.time() - started:.1f}s (ok={ok})")
+    evict_wheelhouse()
+    return {'ok': ok, 'downloaded': len(downloaded), 'output': output}
+
+def prewarm_wheelhouse(requirements=None):
+    """Fetch wheels for the packages most scripts use, so their first install is already local."""
+    requirements = WHEELHOUSE_PREWARM if requirements is None else requirements
+    if not requirements or OFFLINE_INSTALLS:
+        return None
+    result = fill_wheelhouse(requirements)
+    if not result['ok']:
+        logger.warning(f"Wheelhouse pre-warm incomplete:\n{result['output'][-1000:]}")
+    return result
+
+def wheelhouse_summary():
+    with _wheelhouse_lock:
+        counters = dict(_wheelhouse_counters())
+        wheels = list_wheelhouse()
+    lookups = counters['hits'] + counters['misses']
+    hit_rate = f"{counters['hits'] / lookups * 100:.0f}%" if lookups else "n/a"
+    size_mb = sum(size for _, size, _ in wheels) / 1024 / 1024
+    return (f"📦 Wheelhouse{' (offline mode)' if OFFLINE_INSTALLS else ''}: {len(wheels)} wheels, "
+            f"{size_mb:.1f}/{WHEELHOUSE_MAX_MB} MB\n"
+            f"Installs: {lookups}, hit rate {hit_rate} ({counters['hits']} hits, {counters['misses']} misses)\n"
+            f"Wheels downloaded: {counters['downloaded']}, evicted: {counters['evicted']} "
+            f"({counters['evicted_bytes'] / 1024 / 1024:.1f} MB)")
+# --- End Wheelhouse ---
+
+def run_pip_install(requirements, progress=None, constraints=(), timeout=None, index_args=()):
+    """Resolve and install all `requirements` in a single pip run, streaming progress.
+    Returns {'ok', 'installed' {name: version}, 'satisfied' set, 'failed' {name: reason}, 'output'}."""
+    command = [sys.executable, '-m', 'pip', 'install', '--progress-bar', 'off'] + list(index_args) + list(requirements)
+    for constraint_path in constraints:
+        command += ['-c', constraint_path]
+    timeout = timeout or 120 + 60 * len(requirements)
+    result = {'ok': False, 'installed': {}, 'satisfied': set(), 'failed': {}, 'output': '', 'wheels': []}
+    logger.info(f"Running install: {' '.join(command)}")
+    started = time.time()
+    output = []
     try:
-        with open(req_path, 'r', encoding='utf-8') as f:
-            requirements = [line.strip() for line in f if line.strip() and not line.startswith('#')]
-        
-        missing_packages = []
-        installed_packages = []
-        
-        # Check which packages are already installed
-        for req in requirements:
-            package_name = req.split('==')[0].split('>=')[0].split('<=')[0].strip()
-            if not check_package_installed(package_name):
-                missing_packages.append(req)
+        proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+                                encoding='utf-8', errors='ignore')
+    except Exception as e:
+        result['failed'] = {requirement_name(r): str(e) for r in requirements}
+        return result
+    timer = threading.Timer(timeout, proc.kill)
+    timer.start()
+    try:
+        for line in proc.stdout:
+            line = line.rstrip()
+            output.append(line)
+            if line.startswith('Requirement already satisfied: '):
+                result['satisfied'].add(normalize_dist_name(requirement_name(line.split(': ', 1)[1])))
+            elif line.startswith('Successfully installed '):
+                for item in line.split()[2:]:
+                    name, _, version = item.rpartition('-')
+                    result['installed'][normalize_dist_name(name)] = version
+            elif line.startswith('Processing ') and line.endswith('.whl'):
+                result['wheels'].append(os.path.basename(line.split()[1]))
             else:
-                installed_packages.append(package_name)
-        
-        if not missing_packages:
-            bot.reply_to(message, f"✅ All packages already installed: {', '.join(installed_packages)}")
-            return True
-        
-        # Install only missing packages
-        bot.reply_to(message, f"🔄 Installing {len(missing_packages)} missing packages...")
-        
-        for package in missing_packages:
-            try:
-                command = [sys.executable, '-m', 'pip', 'install', package]
-                result = subprocess.run(command, capture_output=True, text=True, check=True, 
-                                      encoding='utf-8', errors='ignore', timeout=120)
-                logger.info(f"Installed {package}: {result.stdout}")
-            except subprocess.TimeoutExpired:
-                logger.error(f"Timeout installing {package}")
-                bot.reply_to(message, f"❌ Timeout installing {package}")
-                return False
-            except subprocess.CalledProcessError as e:
-                logger.error(f"Failed to install {package}: {e.stderr}")
-                bot.reply_to(message, f"❌ Failed to install {package}")
+                _record_pip_error(line, result)
+            if progress:
+                for pattern, phase in _PIP_PROGRESS_PATTERNS:
+                    match = pattern.search(line)
+                    if match:
+                        progress.update(f"{progress.text.split(chr(10))[0]}\n⏳ {phase} {match.group(1)[:200]} "
+                                        f"({time.time() - started:.0f}s)")
+                        break
+        proc.wait()
+    finally:
+        timer.cancel()
+    result['output'] = '\n'.join(output)
+    result['ok'] = proc.returncode == 0
+    if proc.returncode == -signal.SIGKILL and time.time() - started >= timeout:
+        result['output'] += f"\n(pip killed after {timeout}s timeout)"
+    update_installed_index(result['output'])
+    logger.info(f"pip finished with code {proc.returncode} in {time.time() - started:.1f}s. Installed: {result['installed']}")
+    return result
+
+def format_pip_result(requirements, result, title):
+    """Per-package summary of a run_pip_install result."""
+    lines = [title]
+    for requirement in requirements:
+        name = normalize_dist_name(requirement_name(requirement))
+        if name in result['installed']:
+            lines.append(f"✅ {requirement} ({result['installed'][name]})")
+        elif name in result['failed']:
+            lines.append(f"❌ {requirement}: {result['failed'][name][:200]}")
+        elif name in result['satisfied'] or result['ok']:
+            lines.append(f"☑️ {requirement} (already satisfied)")
+        else:
+            lines.append(f"⚠️ {requirement} (not installed)")
+    if not result['ok']:
+        errors = [line for line in result['output'].splitlines() if line.startswith('ERROR')]
+        tail = '\n'.join(errors[-5:] or result['output'].splitlines()[-10:])
+        lines.append(f"\npip failed:\n{tail[-1500:]}")
+    return '\n'.join(lines)
+
+# --- User Environments ---
+# Each user gets a venv under VENVS_DIR and their scripts run with its python,
+# so tenants cannot break each other or the bot. Packages are never pip
+# installed into a venv: pip only resolves the set (--dry-run --report), each
+# distribution is unpacked once into PACKAGE_STORE_DIR under a content address
+# (name, version, interpreter tag, archive hash) and its files are hardlinked
+# into the venv's site-packages. A new venv with common deps is then mostly
+# link() calls and costs almost no extra disk. Store files are made read-only
+# against accidental writes only: every script runs under the bot's uid, so a
+# script can chmod a linked file and change that package in every venv that
+# shares it. Venvs separate dependency sets, not tenants.
+_venv_locks = {}
+_venv_locks_guard = threading.Lock()
+VENV_MANIFEST = 'store-links.json'
+_store_unpacks = {}  # store path -> Future of the running unpack
+
+def _venv_lock(user_id):
+    with _venv_locks_guard:
+        return _venv_locks.setdefault(user_id, threading.Lock())
+
+def get_user_venv_dir(user_id):
+    return os.path.join(VENVS_DIR, str(user_id))
+
+def get_venv_python(venv_dir):
+    return os.path.join(venv_dir, 'Scripts', 'python.exe') if os.name == 'nt' else os.path.join(venv_dir, 'bin', 'python')
+
+def get_venv_site_packages(venv_dir):
+    return sysconfig.get_path('purelib', vars={'base': venv_dir, 'platbase': venv_dir})
+
+def ensure_user_venv(user_id):
+    venv_dir = get_user_venv_dir(user_id)
+    if not os.path.exists(get_venv_python(venv_dir)):
+        with _venv_lock(user_id):
+            if not os.path.exists(get_venv_python(venv_dir)):
+                started = time.time()
+                venv.EnvBuilder(symlinks=os.name != 'nt', with_pip=False, clear=True).create(venv_dir)
+                invalidate_installed_index(user_id)
+                logger.info(f"Created venv for user {user_id} in {(time.time() - started) * 1000:.0f} ms")
+    return venv_dir
+
+def get_script_python(user_id):
+    """Interpreter for a user's scripts: their venv, or the bot's own when venvs are off or broken."""
+    if not USER_VENVS_ENABLED:
+        return sys.executable
+    try:
+        return get_venv_python(ensure_user_venv(user_id))
+    except Exception as e:
+        logger.error(f"Could not create venv for user {user_id}: {e}. Using the bot's interpreter.", exc_info=True)
+        return sys.executable
+
+def module_available(module_name, user_id=None):
+    """Whether a (dotted) module is importable by the user's scripts. Nothing is imported:
+    each package's search locations are walked, which also works for namespace packages."""
+    if USER_VENVS_ENABLED and user_id is not None:
+        search_path = [get_venv_site_packages(get_user_venv_dir(user_id))]
+    else:
+        search_path = None
+    parts = module_name.split('.')
+    try:
+        for depth, part in enumerate(parts):
+            spec = importlib.machinery.PathFinder.find_spec(part, search_path)
+            if spec is None and depth == 0 and search_path is None:
+                spec = importlib.util.find_spec(part)  # built-in and frozen top-level modules
+            if spec is None:
                 return False
-        
-        bot.reply_to(message, f"✅ Successfully installed {len(missing_packages)} packages")
+            search_path = spec.submodule_search_locations
+            if search_path is None:
+                return depth == len(parts) - 1
         return True
-        
+    except (ImportError, ValueError):
+        return False
+
+def _store_key(item):
+    info = item['download_info']
+    archive_hash = (info.get('archive_info') or {}).get('hash') or ''
+    digest = archive_hash.split('=', 1)[-1] if archive_hash else hashlib.sha256(info['url'].encode()).hexdigest()
+    metadata = item['metadata']
+    return f"{normalize_dist_name(metadata['name'])}-{metadata['version']}-{sys.implementation.cache_tag}-{digest[:16]}"
+
+def _ensure_in_store(item):
+    """Unpack one resolved distribution into the store (once) and return its directory.
+    Venvs linking the same distribution at the same time wait for a single unpack."""
+    store_path = os.path.join(PACKAGE_STORE_DIR, _store_key(item))
+    if os.path.isdir(store_path):
+        return store_path
+    return _run_shared(_store_unpacks, store_path, _unpack_into_store, item, store_path)[0]
+
+def _unpack_into_store(item, store_path):
+    if os.path.isdir(store_path):
+        return store_path  # finished between the caller's check and taking the key
+    staging = tempfile.mkdtemp(prefix='.staging-', dir=PACKAGE_STORE_DIR)
+    try:
+        command = [sys.executable, '-m', 'pip', 'install', '--no-deps', '--no-warn-script-location', '--progress-bar', 'off',
+                   '--target', staging, item['download_info']['url']]
+        result = subprocess.run(command, capture_output=True, text=True, encoding='utf-8', errors='ignore', timeout=600)
+        if result.returncode != 0:
+            raise RuntimeError((result.stderr or result.stdout)[-1000:])
+        for root, _, files in os.walk(staging):
+            for name in files:
+                path = os.path.join(root, name)
+                os.chmod(path, os.stat(path).st_mode & ~0o222)
+        try:
+            os.rename(staging, store_path)
+        except OSError:
+            if not os.path.isdir(store_path):
+                raise
+            shutil.rmtree(staging, ignore_errors=True)  # Another install stored it first.
+        return store_path
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+def _link_into(store_path, site_packages):
+    """Hardlink a stored distribution into site-packages (symlink/copy across filesystems). Returns relpaths."""
+    linked = []
+    for root, dirs, files in os.walk(store_path):
+        rel_root = os.path.relpath(root, store_path)
+        if rel_root == '.':
+            dirs[:] = [d for d in dirs if d != 'bin']  # console scripts carry the bot's interpreter in their shebang
+        os.makedirs(os.path.join(site_packages, rel_root), exist_ok=True)
+        for name in files:
+            rel = os.path.normpath(os.path.join(rel_root, name))
+            src, dst = os.path.join(root, name), os.path.join(site_packages, rel)
+            if os.path.lexists(dst):
+                os.unlink(dst)
+            try:
+                os.link(src, dst)
+            except OSError:
+                try:
+                    os.symlink(src, dst)
+                except OSError:
+                    shutil.copy2(src, dst)
+            linked.append(rel)
+    return linked
+
+def _unlink_from(site_packages, files):
+    dirs = set()
+    for rel in files:
+        path = os.path.join(site_packages, rel)
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        dirs.add(os.path.dirname(path))
+    for directory in sorted(dirs, key=len, reverse=True):
+        while directory.startswith(site_packages + os.sep):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                break
+            directory = os.path.dirname(directory)
+
+def install_into_venv(user_id, requirements, progress=None, constraints=(), index_args=()):
+    """Resolve `requirements` against the user's venv and link every needed distribution in from the store.
+    Returns the same shape as run_pip_install."""
+    result = {'ok': False, 'installed': {}, 'satisfied': set(), 'failed': {}, 'output': '', 'wheels': []}
+    venv_dir = ensure_user_venv(user_id)
+    site_packages = get_venv_site_packages(venv_dir)
+    command = [sys.executable, '-m', 'pip', '--python', get_venv_python(venv_dir), 'install', '--dry-run', '--quiet',
+               '--report', '-', '--progress-bar', 'off'] + list(index_args) + list(requirements)
+    for constraint_path in constraints:
+        command += ['-c', constraint_path]
+    started = time.time()
+    with _venv_lock(user_id):
+        if progress:
+            progress.update(f"{progress.text.split(chr(10))[0]}\n⏳ Resolving {len(requirements)} requirements", force=True)
+        try:
+            resolved = subprocess.run(command, capture_output=True, text=True, encoding='utf-8', errors='ignore',
+                                      timeout=120 + 60 * len(requirements))
+        except subprocess.TimeoutExpired:
+            result['output'] = "pip timed out while resolving"
+            return result
+        result['output'] = resolved.stderr
+        if resolved.returncode != 0:
+            for line in resolved.stderr.splitlines():
+                _record_pip_error(line, result)
+            return result
+        items = json.loads(resolved.stdout)['install']
+        result['wheels'] = [os.path.basename(item['download_info']['url']) for item in items]
+        manifest_path = os.path.join(venv_dir, VENV_MANIFEST)
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = {}
+        name = None
+        try:
+            for n, item in enumerate(items, 1):
+                name = normalize_dist_name(item['metadata']['name'])
+                version = item['metadata']['version']
+                if progress:
+                    progress.update(f"{progress.text.split(chr(10))[0]}\n⏳ Linking {name} {version} ({n}/{len(items)}, "
+                                    f"{time.time() - started:.0f}s)")
+                store_path = _ensure_in_store(item)
+                if name in manifest:
+                    _unlink_from(site_packages, manifest[name]['files'])
+                manifest[name] = {'key': os.path.basename(store_path), 'version': version,
+                                  'files': _link_into(store_path, site_packages)}
+                result['installed'][name] = version
+        except Exception as e:
+            name = name or ', '.join(requirements)  # failed before the first distribution was named
+            result['failed'][name] = str(e)
+            logger.error(f"Linking {name} into venv of user {user_id} failed: {e}", exc_info=True)
+        finally:
+            with open(manifest_path, 'w') as f:
+                json.dump(manifest, f)
+            update_installed_index(None, user_id, result['installed'])
+        result['ok'] = not result['failed']
+    logger.info(f"Venv of user {user_id}: linked {len(result['installed'])} distributions in {time.time() - started:.1f}s")
+    return result
+
+def _install_now(requirements, progress=None, constraints=(), user_id=None):
+    """Install into the user's venv when venvs are on, else into the bot's interpreter.
+    The local wheelhouse is tried first; PyPI is only contacted to fill it on a miss.
+    Callers go through install_packages, which serializes this per environment."""
+    if USER_VENVS_ENABLED and user_id is not None:
+        install = functools.partial(install_into_venv, user_id)
+    else:
+        install = run_pip_install
+    if not WHEELHOUSE_ENABLED:
+        return install(requirements, progress, constraints)
+    result = install(requirements, progress, constraints, index_args=wheelhouse_index_args())
+    if result['ok'] or OFFLINE_INSTALLS:
+        record_wheelhouse_use(result['ok'], result['wheels'])
+        return result
+    fill = fill_wheelhouse(requirements, constraints, progress)
+    if fill['ok']:
+        result = install(requirements, progress, constraints, index_args=wheelhouse_index_args())
+    else:
+        # Some requirement cannot be built into a wheel here (or resolution failed); let pip handle it directly.
+        logger.warning(f"Wheelhouse fill failed; installing from the index instead:\n{fill['output'][-1000:]}")
+        result = install(requirements, progress, constraints)
+    record_wheelhouse_use(False, result['wheels'], fill['downloaded'])
+    return result
+# --- End User Environments ---
+
+# --- Install Queue ---
+# Concurrent pip runs against one environment race on site-packages, and
+# run_all can start dozens of installs at once. Every install is a job in a
+# per-environment FIFO drained by one worker thread, so writes to an
+# environment never overlap while different venvs still install in parallel.
+# A request identical to a queued or running job joins it instead of queueing
+# another pip run; all requesters see its progress and get its result.
+INSTALL_METRICS_HISTORY = 200
+
+class InstallJob:
+    def __init__(self, key, requirements, constraints, user_id):
+        self.key = key
+        self.requirements = list(requirements)
+        self.constraints = list(constraints)
+        self.user_id = user_id
+        self.waiters = []
+        self.enqueued = time.time()
+        self.started = self.finished = None
+        self.result = self.error = None
+        self.done = threading.Event()
+        self.text = ''  # progress interface: detail lines are fanned out under each requester's own header
+
+    def update(self, text, force=False):
+        detail = text.split('\n', 1)[-1]
+        for waiter in list(self.waiters):
+            waiter.update(f"{waiter.text.split(chr(10))[0]}\n{detail}", force)
+
+_install_queue_lock = threading.Lock()
+_install_queues = {}  # environment -> deque of pending jobs
+_install_jobs = {}  # job key -> pending or running job
+_install_running = {}  # environment -> running job
+install_metrics = {'requests': 0, 'merged': 0, 'jobs': 0, 'failed': 0,
+                   'wait': deque(maxlen=INSTALL_METRICS_HISTORY), 'duration': deque(maxlen=INSTALL_METRICS_HISTORY)}
+
+def install_environment(user_id=None):
+    return user_id if USER_VENVS_ENABLED and user_id is not None else None
+
+def install_packages(requirements, progress=None, constraints=(), user_id=None):
+    """Queue an install and wait for it. Same arguments and result as _install_now."""
+    env = install_environment(user_id)
+    key = (env, tuple(sorted(requirements)), tuple(constraints))
+    with _install_queue_lock:
+        install_metrics['requests'] += 1
+        job = _install_jobs.get(key)
+        if job is not None:
+            install_metrics['merged'] += 1
+        else:
+            job = _install_jobs[key] = InstallJob(key, requirements, constraints, env)
+            queue = _install_queues.setdefault(env, deque())
+            queue.append(job)
+            if env not in _install_running:
+                _install_running[env] = None
+                threading.Thread(target=_install_worker, args=(env,), name=f"install-{env or 'bot'}", daemon=True).start()
+        if progress:
+            job.waiters.append(progress)
+        ahead = len(_install_queues.get(env, ())) - 1 + (_install_running.get(env) is not None)
+    if progress and job.started is None and ahead > 0:
+        progress.update(f"{progress.text.split(chr(10))[0]}\n⏳ Queued behind {ahead} install job(s)", force=True)
+    job.done.wait()
+    if job.error:
+        raise job.error
+    return job.result
+
+def _install_worker(env):
+    while True:
+        with _install_queue_lock:
+            queue = _install_queues.get(env)
+            if not queue:
+                _install_queues.pop(env, None)
+                _install_running.pop(env, None)
+                return
+            job = _install_running[env] = queue.popleft()
+        job.started = time.time()
+        try:
+            job.result = _install_now(job.requirements, job, job.constraints, job.user_id)
+        except Exception as e:
+            logger.error(f"Install job {job.requirements} failed: {e}", exc_info=True)
+            job.error = e
+        job.finished = time.time()
+        with _install_queue_lock:
+            _install_jobs.pop(job.key, None)
+            _install_running[env] = None
+            install_metrics['jobs'] += 1
+            install_metrics['failed'] += not (job.result and job.result['ok'])
+            install_metrics['wait'].append(job.started - job.enqueued)
+            install_metrics['duration'].append(job.finished - job.started)
+        logger.info(f"Install job for {env or 'bot interpreter'} ({len(job.requirements)} requirements, "
+                    f"{len(job.waiters)} requester(s)): waited {job.started - job.enqueued:.1f}s, "
+                    f"ran {job.finished - job.started:.1f}s")
+        job.done.set()
+
+def _percentiles(values):
+    ordered = sorted(values)
+    if not ordered:
+        return "-"
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+    return f"p50 {pick(0.5):.1f}s, p95 {pick(0.95):.1f}s, max {ordered[-1]:.1f}s"
+
+def install_queue_summary():
+    with _install_queue_lock:
+        queued = {env: len(queue) for env, queue in _install_queues.items()}
+        running = {env: job for env, job in _install_running.items() if job is not None}
+        metrics = dict(install_metrics, wait=list(install_metrics['wait']), duration=list(install_metrics['duration']))
+    lines = [f"📥 Install queue: {sum(queued.values())} queued, {len(running)} running",
+             f"Requests: {metrics['requests']} ({metrics['merged']} merged into another job), "
+             f"jobs: {metrics['jobs']} ({metrics['failed']} failed)",
+             f"Queue wait: {_percentiles(metrics['wait'])}",
+             f"Install time: {_percentiles(metrics['duration'])}"]
+    for env, job in running.items():
+        lines.append(f"▶️ {env or 'bot'}: {', '.join(job.requirements)[:200]} "
+                     f"({time.time() - job.started:.0f}s, {len(job.waiters)} waiting, {queued.get(env, 0)} queued)")
+    return '\n'.join(lines)
+# --- End Install Queue ---
+
+# --- Requirements Files ---
+# requirements.txt is parsed with `packaging`, so specifiers (~=, !=, ranges),
+# extras and environment markers are evaluated against the installed index
+# exactly as pip would, and only requirements that are really unsatisfied
+# reach the installer. Lines that cannot be checked locally (URLs, paths,
+# editables) are always handed to pip, which decides for itself.
+_REQUIREMENT_OPTION = re.compile(r'^(-r|--requirement|-c|--constraint|-e|--editable)(?:\s+|=)(.+)$')
+# (env, fingerprint) of recent checks that found nothing to install, most recent last. Bundles are
+# unpacked to a fresh temp dir per upload, so the fingerprint covers contents, not where they live.
+_satisfied_requirement_files = OrderedDict()
+_satisfied_requirement_files_lock = threading.Lock()  # install threads check and record concurrently
+SATISFIED_REQUIREMENTS_CACHE_SIZE = 512
+
+def parse_requirements_file(req_path, _seen=None):
+    """Parse a requirements file, following -r includes.
+    Returns {'requirements': {name: Requirement}, 'direct': [pip args], 'constraints': {name: Requirement},
+    'constraint_files': [paths], 'files': [paths read], 'pre': bool}."""
+    parsed = {'requirements': {}, 'direct': [], 'constraints': {}, 'constraint_files': [], 'files': [], 'pre': False}
+    _parse_requirements_into(os.path.abspath(req_path), parsed, _seen if _seen is not None else set(), constraint=False)
+    return parsed
+
+def _merge_requirement(target, req):
+    name = normalize_dist_name(req.name)
+    existing = target.get(name)
+    if existing is None:
+        target[name] = req
+        return
+    # psutil and psutil==5.9.8 in the same file: pip needs both to hold.
+    existing.specifier &= req.specifier
+    existing.extras |= req.extras
+    existing.url = existing.url or req.url
+
+def _parse_requirements_into(path, parsed, seen, constraint):
+    if path in seen:
+        return
+    seen.add(path)
+    parsed['files'].append(path)
+    base_dir = os.path.dirname(path)
+    with open(path, 'r', encoding='utf-8') as f:
+        text = re.sub(r'\\\r?\n', ' ', f.read())
+    for raw_line in text.splitlines():
+        line = re.sub(r'(^|\s)#.*$', '', raw_line).strip()
+        if not line:
+            continue
+        option = _REQUIREMENT_OPTION.match(line)
+        if option:
+            flag, value = option.group(1), option.group(2).strip()
+            if flag in ('-r', '--requirement'):
+                _parse_requirements_into(os.path.join(base_dir, value), parsed, seen, constraint)
+            elif flag in ('-c', '--constraint'):
+                constraint_path = os.path.join(base_dir, value)
+                parsed['constraint_files'].append(constraint_path)
+                _parse_requirements_into(constraint_path, parsed, seen, constraint=True)
+            elif not constraint:
+                # Packages are linked from a shared store, so editable installs become regular ones.
+                logger.info(f"Installing editable requirement {value} as a regular install")
+                parsed['direct'].append(_resolve_requirement_path(value, base_dir))
+            continue
+        if line == '--pre':
+            parsed['pre'] = True
+            continue
+        if line.startswith('-'):
+            logger.info(f"Ignoring requirements option line: {line}")
+            continue
+        try:
+            req = Requirement(line)
+        except InvalidRequirement:
+            # A bare URL, archive or directory: pip can install it, but it has no name to check.
+            if not constraint:
+                parsed['direct'].append(_resolve_requirement_path(line, base_dir))
+            continue
+        if req.marker is not None and not req.marker.evaluate({'extra': ''}):
+            continue
+        _merge_requirement(parsed['constraints' if constraint else 'requirements'], req)
+
+def _resolve_requirement_path(value, base_dir):
+    if re.match(r'^[a-zA-Z][a-zA-Z0-9+.-]*://', value):
+        return value
+    candidate = os.path.join(base_dir, value)
+    return candidate if os.path.exists(candidate) else value
+
+def _installed_distribution(name, env_id):
+    try:
+        if env_id is None:
+            return importlib.metadata.distribution(name)
+        site_packages = get_venv_site_packages(get_user_venv_dir(env_id))
+        return next(iter(importlib.metadata.distributions(name=name, path=[site_packages])), None)
+    except importlib.metadata.PackageNotFoundError:
+        return None
+
+def requirement_unsatisfied(req, env_id=None, constraint=None, prereleases=False):
+    """Why `req` is not satisfied in the environment, or None if it is."""
+    name = normalize_dist_name(req.name)
+    version = installed_version(name, env_id)
+    if version is None:
+        return "not installed"
+    if req.url:
+        return f"direct URL ({req.url})"
+    specifier = req.specifier & constraint.specifier if constraint is not None else req.specifier
+    # An installed pre-release that matches the specifier is accepted, as pip does.
+    if specifier and not specifier.contains(version, prereleases=True):
+        return f"{version} installed, {specifier} required"
+    if req.extras:
+        dist = _installed_distribution(req.name, env_id)
+        for dependency in (dist.requires or []) if dist else []:
+            dep = Requirement(dependency)
+            if dep.marker is None or not any(dep.marker.evaluate({'extra': extra}) for extra in req.extras):
+                continue
+            if dep.marker.evaluate({'extra': ''}):
+                continue  # not tied to an extra; the base install already handled it
+            reason = requirement_unsatisfied(dep, env_id, prereleases=prereleases)
+            if reason:
+                return f"extra dependency {dep.name}: {reason}"
+    return None
+
+def _requirements_fingerprint(parsed, env_id, base_dir):
+    digest = hashlib.sha256()
+    for path in parsed['files']:
+        digest.update(os.path.relpath(path, base_dir).encode())
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    digest.update(repr((env_id, _installed_index_generations.get(env_id, 0))).encode())
+    return digest.hexdigest()
+
+def unsatisfied_requirements(parsed, env_id=None):
+    """[(pip argument, reason)] for every requirement in a parsed file that needs installing."""
+    missing = []
+    for name, req in parsed['requirements'].items():
+        reason = requirement_unsatisfied(req, env_id, parsed['constraints'].get(name), parsed['pre'])
+        if reason:
+            missing.append((str(req), reason))
+    missing += [(direct, "cannot be checked locally") for direct in parsed['direct']]
+    return missing
+# --- End Requirements Files ---
+
+def install_missing_requirements(req_path, message, user_id=None):
+    """Install only the unsatisfied requirements from requirements.txt, in one pip run"""
+    env_id = user_id if USER_VENVS_ENABLED else None
+    try:
+        parsed = parse_requirements_file(req_path)
+        default_constraints = os.path.join(os.path.dirname(os.path.abspath(req_path)), 'constraints.txt')
+        if os.path.exists(default_constraints) and default_constraints not in parsed['constraint_files']:
+            parsed['constraint_files'].append(default_constraints)
+            _parse_requirements_into(default_constraints, parsed, set(parsed['files']), constraint=True)
+        # Fast path: same file contents, same environment as a recent check that found nothing to do.
+        cache_key = (env_id, _requirements_fingerprint(parsed, env_id, os.path.dirname(os.path.abspath(req_path))))
+        with _satisfied_requirement_files_lock:
+            satisfied = cache_key in _satisfied_requirement_files
+            if satisfied:
+                _satisfied_requirement_files.move_to_end(cache_key)
+        if satisfied:
+            logger.info(f"{req_path}: unchanged and already satisfied")
+            return True
+    except Exception as e:
+        logger.error(f"Could not read requirements {req_path}: {e}", exc_info=True)
+        reply_or_notify(message, f"❌ Error processing requirements: {e}")
+        return False
+
+    progress = ProgressMessage(message, "📦 Checking requirements.txt for missing packages...")
+    try:
+        requirements = list(parsed['requirements']) + parsed['direct']
+        constraints = parsed['constraint_files']
+        unsatisfied = unsatisfied_requirements(parsed, env_id)
+        missing_packages = [requirement for requirement, _ in unsatisfied]
+        if not missing_packages:
+            with _satisfied_requirement_files_lock:
+                _satisfied_requirement_files[cache_key] = True
+                while len(_satisfied_requirement_files) > SATISFIED_REQUIREMENTS_CACHE_SIZE:
+                    _satisfied_requirement_files.popitem(last=False)
+            progress.finish(f"✅ All {len(requirements)} requirements already satisfied.")
+            return True
+        for requirement, reason in unsatisfied:
+            logger.info(f"Requirement {requirement}: {reason}")
+
+        progress.update(f"📦 Installing {len(missing_packages)} of {len(requirements)} requirements in one pip run"
+                        f"{f' with {len(constraints)} constraints file(s)' if constraints else ''}...", force=True)
+        result = install_packages(missing_packages, progress, constraints, user_id)
+        if result['ok']:
+            title = f"✅ Installed {len(missing_packages)} missing requirements ({len(requirements) - len(missing_packages)} already satisfied):"
+        else:
+            title = "⚠️ Some requirements failed to install, continuing anyway:"
+        progress.finish(format_pip_result(missing_packages, result, title))
+        return result['ok']
+
     except Exception as e:
         error_msg = f"❌ Error processing requirements: {str(e)}"
         logger.error(error_msg, exc_info=True)
-        bot.reply_to(message, error_msg)
+        progress.finish(error_msg)
         return False
 
-def attempt_install_pip(module_name, message):
-    package_name = TELEGRAM_MODULES.get(module_name.lower(), module_name)
-    if package_name is None:
-        logger.info(f"Module '{module_name}' is core. Skipping pip install.")
-        return True
-    if check_package_installed(package_name):
-        logger.info(f"Package '{package_name}' already installed.")
-        return True
-        
+# Import-name prefixes that never need pip. sys.stdlib_module_names exists on 3.10+.
+STDLIB_MODULES = frozenset(getattr(sys, 'stdlib_module_names', ())) | frozenset(sys.builtin_module_names) | {'__future__'}
+
+# --- Import Name Resolution ---
+# Maps what a script imports to the distribution pip must install, in order:
+# the standard library (never installed), the import-name table (the bundled
+# import_names.json plus admin overrides from /importmap, matched on the
+# longest dotted prefix so google.protobuf and google.cloud.storage differ),
+# then installed distribution metadata, and finally the import name itself.
+# Lookups are cached; the cache is dropped when the table or the installed
+# distributions change.
+IMPORT_NAMES_FILE = os.path.join(BASE_DIR, 'import_names.json')
+IMPORT_NAMES_OVERRIDE_FILE = os.path.join(IROTECH_DIR, 'import_names.json')
+_import_names = None
+_import_names_lock = threading.Lock()
+_packages_distributions = None
+
+def _load_import_names():
+    table = {}
+    for path in (IMPORT_NAMES_FILE, IMPORT_NAMES_OVERRIDE_FILE):
+        try:
+            with open(path, encoding='utf-8') as f:
+                table.update(json.load(f))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.error(f"Could not load import name table {path}: {e}")
+    return table
+
+def get_import_names():
+    global _import_names
+    if _import_names is None:
+        with _import_names_lock:
+            if _import_names is None:
+                _import_names = _load_import_names()
+    return _import_names
+
+def _installed_packages_distributions():
+    global _packages_distributions
+    if _packages_distributions is None:
+        _packages_distributions = importlib.metadata.packages_distributions()
+    return _packages_distributions
+
+def invalidate_import_resolver():
+    global _import_names, _packages_distributions
+    with _import_names_lock:
+        _import_names = None
+        _packages_distributions = None
+    resolve_import.cache_clear()
+
+@functools.lru_cache(maxsize=4096)
+def resolve_import(module_name):
+    """Returns (import prefix that decided it, distribution to install or None for stdlib/never-install)."""
+    top = module_name.split('.', 1)[0]
+    if top in STDLIB_MODULES:
+        return top, None
+    table = get_import_names()
+    parts = module_name.split('.')
+    for end in range(len(parts), 0, -1):
+        prefix = '.'.join(parts[:end])
+        if prefix in table:
+            return prefix, table[prefix]
+    distributions = _installed_packages_distributions().get(top, [])
+    if len(distributions) == 1:
+        return top, distributions[0]
+    return top, top
+
+def set_import_name(module_name, distribution):
+    """Persist an admin override of the table (distribution None: never install)."""
     try:
-        bot.reply_to(message, f"🐍 Module `{module_name}` not found. Installing `{package_name}`...", parse_mode='Markdown')
-        command = [sys.executable, '-m', 'pip', 'install', package_name]
-        logger.info(f"Running install: {' '.join(command)}")
-        result = subprocess.run(command, capture_output=True, text=True, check=False, encoding='utf-8', errors='ignore', timeout=120)
-        if result.returncode == 0:
-            logger.info(f"Installed {package_name}. Output:\n{result.stdout}")
-            bot.reply_to(message, f"✅ Package `{package_name}` (for `{module_name}`) installed.", parse_mode='Markdown')
-            return True
+        with open(IMPORT_NAMES_OVERRIDE_FILE, encoding='utf-8') as f:
+            overrides = json.load(f)
+    except (OSError, ValueError):
+        overrides = {}
+    overrides[module_name] = distribution
+    with open(IMPORT_NAMES_OVERRIDE_FILE + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(overrides, f, indent=4, sort_keys=True)
+    os.replace(IMPORT_NAMES_OVERRIDE_FILE + '.tmp', IMPORT_NAMES_OVERRIDE_FILE)
+    invalidate_import_resolver()
+# --- End Import Name Resolution ---
+
+def _is_import_error_handler(handler):
+    names = []
+    if handler.type is None:
+        return True
+    for node in (handler.type.elts if isinstance(handler.type, ast.Tuple) else [handler.type]):
+        if isinstance(node, ast.Name):
+            names.append(node.id)
+        elif isinstance(node, ast.Attribute):
+            names.append(node.attr)
+    # `except Exception` guards any failure, not a missing module; treating it as optional would skip the install.
+    return any(n in ('ImportError', 'ModuleNotFoundError') for n in names)
+
+def _collect_imports(tree):
+    """Return {dotted module name: optional?} for every absolute import in an AST.
+    Imports inside a try whose handler catches ImportError are optional."""
+    found = {}
+
+    def add(name, optional):
+        if name and not name.startswith('.'):
+            found[name] = found.get(name, True) and optional
+
+    def visit(node, optional):
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                add(alias.name, optional)
+        elif isinstance(node, ast.ImportFrom):
+            if node.level == 0 and node.module:
+                add(node.module, optional)
+        elif isinstance(node, ast.Call) and node.args and isinstance(node.args[0], ast.Constant) \
+                and isinstance(node.args[0].value, str):
+            func = node.func
+            if (isinstance(func, ast.Name) and func.id == '__import__') or \
+                    (isinstance(func, ast.Attribute) and func.attr == 'import_module'):
+                add(node.args[0].value, optional)
+        if isinstance(node, ast.Try):
+            guarded = optional or any(_is_import_error_handler(h) for h in node.handlers)
+            for child in node.body:
+                visit(child, guarded)
+            for child in node.handlers + node.orelse + node.finalbody:
+                visit(child, optional)
+            return
+        for child in ast.iter_child_nodes(node):
+            visit(child, optional)
+
+    visit(tree, False)
+    return found
+
+def _find_local_module(name, search_dirs):
+    for directory in search_dirs:
+        if os.path.isfile(os.path.join(directory, f"{name}.py")):
+            return os.path.join(directory, f"{name}.py")
+        package_dir = os.path.join(directory, name)
+        if os.path.isdir(package_dir):
+            return package_dir
+    return None
+
+def collect_script_requirements(script_path, user_folder):
+    """Statically resolve what a script imports, following local modules.
+    Returns ({third-party module name: optional?}, SyntaxError or None). Names are top-level
+    unless the import-name table maps a longer dotted prefix (e.g. google.protobuf).
+    Nothing is executed, so a script's side effects only ever run once."""
+    search_dirs = [os.path.dirname(os.path.abspath(script_path))]
+    if os.path.abspath(user_folder) not in search_dirs:
+        search_dirs.append(os.path.abspath(user_folder))
+    pending, seen = [os.path.abspath(script_path)], set()
+    required = {}
+    while pending:
+        path = pending.pop()
+        if path in seen:
+            continue
+        seen.add(path)
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                pending.extend(os.path.join(root, f) for f in files if f.endswith('.py'))
+            continue
+        try:
+            with open(path, 'rb') as f:
+                tree = ast.parse(f.read(), filename=path)
+        except SyntaxError as e:
+            return {}, e
+        except (OSError, ValueError) as e:
+            logger.warning(f"Import scan could not read {path}: {e}")
+            continue
+        for dotted_name, optional in _collect_imports(tree).items():
+            name, distribution = resolve_import(dotted_name)
+            if distribution is None:
+                continue
+            local_path = _find_local_module(dotted_name.split('.', 1)[0], search_dirs)
+            if local_path:
+                pending.append(local_path)
+            else:
+                required[name] = required.get(name, True) and optional
+    return required, None
+
+def scan_script_imports(script_path, user_folder, user_id=None):
+    """Returns (third-party module names the script needs that are not importable by it, SyntaxError or None)."""
+    required, syntax_error = collect_script_requirements(script_path, user_folder)
+    if syntax_error:
+        return [], syntax_error
+    missing = []
+    for name, optional in sorted(required.items()):
+        if module_available(name, user_id):
+            continue
+        if optional:
+            logger.info(f"Optional import '{name}' in {script_path} is not installed; skipping.")
         else:
-            error_msg = f"❌ Failed to install `{package_name}` for `{module_name}`.\nLog:\n```\n{result.stderr or result.stdout}\n```"
-            logger.error(error_msg)
-            if len(error_msg) > 4000:
-                error_msg = error_msg[:4000] + "\n... (Log truncated)"
-            bot.reply_to(message, error_msg, parse_mode='Markdown')
-            return False
-    except subprocess.TimeoutExpired:
-        error_msg = f"❌ Timeout installing `{package_name}`"
-        logger.error(error_msg)
-        bot.reply_to(message, error_msg)
-        return False
-    except Exception as e:
-        error_msg = f"❌ Error installing `{package_name}`: {str(e)}"
-        logger.error(error_msg, exc_info=True)
-        bot.reply_to(message, error_msg)
-        return False
-
-def run_script(script_path, script_owner_id, user_folder, file_name, message_obj_for_reply, attempt=1):
-    max_attempts = 2
-    if attempt > max_attempts:
-        bot.reply_to(message_obj_for_reply, f"❌ Failed to run '{file_name}' after {max_attempts} attempts. Check logs.")
-        return
-
+            missing.append(name)
+    return missing, None
+
+def install_missing_modules(module_names, message, chat_id=None, user_id=None):
+    """Install the PyPI packages for all missing import names in one pip run."""
+    packages = sorted({resolve_import(name)[1] or name for name in module_names})
+    progress = ProgressMessage(message, f"🐍 Missing modules: {', '.join(module_names)}. Installing {', '.join(packages)}...",
+                               chat_id=chat_id)
+    result = install_packages(packages, progress, user_id=user_id)
+    title = "✅ Installed missing modules:" if result['ok'] else "❌ Failed to install missing modules:"
+    progress.finish(format_pip_result(packages, result, title))
+    return result['ok']
+
+def run_script(script_path, script_owner_id, user_folder, file_name, message_obj_for_reply):
     script_key = f"{script_owner_id}_{file_name}"
-    logger.info(f"Attempt {attempt} to run Python script: {script_path} (Key: {script_key}) for user {script_owner_id}")
+    logger.info(f"Running Python script: {script_path} (Key: {script_key}) for user {script_owner_id}")
 
     try:
         if not os.path.exists(script_path):
-            bot.reply_to(message_obj_for_reply, f"❌ Error: Script '{file_name}' not found at '{script_path}'!")
+            reply_or_notify(message_obj_for_reply, f"❌ Error: Script '{file_name}' not found at '{script_path}'!", chat_id=script_owner_id)
             logger.error(f"Script not found: {script_path} for user {script_owner_id}")
-            if script_owner_id in user_files:
-                user_files[script_owner_id] = [f for f in user_files.get(script_owner_id, []) if f[0] != file_name]
             remove_user_file_db(script_owner_id, file_name)
             return
 
-        if attempt == 1:
-            check_command = [sys.executable, script_path]
-            logger.info(f"Running Python pre-check: {' '.join(check_command)}")
-            check_proc = None
-            try:
-                check_proc = subprocess.Popen(check_command, cwd=user_folder, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding='utf-8', errors='ignore')
-                stdout, stderr = check_proc.communicate(timeout=10)
-                return_code = check_proc.returncode
-                logger.info(f"Python Pre-check early. RC: {return_code}. Stderr: {stderr[:200]}...")
-                if return_code != 0 and stderr:
-                    match_py = re.search(r"ModuleNotFoundError: No module named '(.+?)'", stderr)
-                    if match_py:
-                        module_name = match_py.group(1).strip().strip("'\"")
-                        logger.info(f"Detected missing Python module: {module_name}")
-                        if attempt_install_pip(module_name, message_obj_for_reply):
-                            logger.info(f"Install OK for {module_name}. Retrying run_script...")
-                            bot.reply_to(message_obj_for_reply, f"🔄 Install successful. Retrying '{file_name}'...")
-                            time.sleep(2)
-                            threading.Thread(target=run_script, args=(script_path, script_owner_id, user_folder, file_name, message_obj_for_reply, attempt + 1)).start()
-                            return
-                        else:
-                            bot.reply_to(message_obj_for_reply, f"❌ Install failed. Cannot run '{file_name}'.")
-                            return
-                    else:
-                        error_summary = stderr[:500]
-                        bot.reply_to(message_obj_for_reply, f"❌ Error in script pre-check for '{file_name}':\n```\n{error_summary}\n```\nFix the script.", parse_mode='Markdown')
-                        return
-            except subprocess.TimeoutExpired:
-                logger.info("Python Pre-check timed out (>10s), imports likely OK. Killing check process.")
-                if check_proc and check_proc.poll() is None:
-                    check_proc.kill()
-                    check_proc.communicate()
-                logger.info("Python Check process killed. Proceeding to long run.")
-            except FileNotFoundError:
-                logger.error(f"Python interpreter not found: {sys.executable}")
-                bot.reply_to(message_obj_for_reply, f"❌ Error: Python interpreter '{sys.executable}' not found.")
-                return
-            except Exception as e:
-                logger.error(f"Error in Python pre-check for {script_key}: {e}", exc_info=True)
-                bot.reply_to(message_obj_for_reply, f"❌ Unexpected error in script pre-check for '{file_name}': {e}")
+        tier = get_user_tier(script_owner_id)
+        limits = TIER_RESOURCE_LIMITS.get(tier, {})
+        node_name = pick_script_node(limits) or LOCAL_NODE
+        scan_started = time.time()
+        if node_name != LOCAL_NODE:
+            required, syntax_error = collect_script_requirements(script_path, user_folder)
+            missing_modules = []
+        else:
+            python_exe = get_script_python(script_owner_id)
+            missing_modules, syntax_error = scan_script_imports(script_path, user_folder, script_owner_id)
+        logger.info(f"Import scan for {script_key} took {(time.time() - scan_started) * 1000:.1f} ms; missing: {missing_modules}")
+        if syntax_error:
+            where = f"{os.path.basename(syntax_error.filename or file_name)} line {syntax_error.lineno}"
+            reply_or_notify(message_obj_for_reply, f"❌ Syntax error in '{file_name}' ({where}):\n```\n{syntax_error.msg}\n```\nFix the script.",
+                            parse_mode='Markdown', chat_id=script_owner_id)
+            return
+        if node_name != LOCAL_NODE:
+            requirements = {name: resolve_import(name)[1] for name, optional in required.items() if not optional}
+            start_script_on_worker(node_name, script_owner_id, user_folder, file_name, message_obj_for_reply, tier, limits, requirements)
+            return
+        if missing_modules:
+            if not install_missing_modules(missing_modules, message_obj_for_reply, chat_id=script_owner_id, user_id=script_owner_id):
+                reply_or_notify(message_obj_for_reply, f"❌ Install failed. Cannot run '{file_name}'.", chat_id=script_owner_id)
                 return
-            finally:
-                if check_proc and check_proc.poll() is None:
-                    logger.warning(f"Python Check process {check_proc.pid} still running. Killing.")
-                    check_proc.kill()
-                    check_proc.communicate()
+            still_missing = [m for m in missing_modules if not module_available(m, script_owner_id)]
+            if still_missing:
+                logger.warning(f"Modules still not importable after install for {script_key}: {still_missing}")
 
         logger.info(f"Starting long-running Python process for {script_key}")
         log_file_path = os.path.join(user_folder, f"{os.path.splitext(file_name)[0]}.log")
         log_file = None
         process = None
+        cgroup_dir = None
         try:
             log_file = open(log_file_path, 'w', encoding='utf-8', errors='ignore')
         except Exception as e:
             logger.error(f"Failed to open log file '{log_file_path}' for {script_key}: {e}", exc_info=True)
-            bot.reply_to(message_obj_for_reply, f"❌ Failed to open log file '{log_file_path}': {e}")
+            reply_or_notify(message_obj_for_reply, f"❌ Failed to open log file '{log_file_path}': {e}", chat_id=script_owner_id)
             return
         try:
             startupinfo = None
@@ -450,234 +3391,313 @@ def run_script(script_path, script_owner_id, user_folder, file_name, message_obj
                 startupinfo = subprocess.STARTUPINFO()
                 startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
                 startupinfo.wShowWindow = subprocess.SW_HIDE
-            process = subprocess.Popen(
-                [sys.executable, script_path], cwd=user_folder, stdout=log_file, stderr=log_file,
-                stdin=subprocess.PIPE, startupinfo=startupinfo, creationflags=creationflags,
-                encoding='utf-8', errors='ignore'
-            )
-            logger.info(f"Started Python process {process.pid} for {script_key}")
+            cgroup_dir = create_script_cgroup(script_key, limits) if os.name != 'nt' else None
+            # The zygote runs the bot's interpreter, so it can only host scripts that use it too.
+            if ZYGOTE_ENABLED and python_exe == sys.executable and zygote_available():
+                try:
+                    process = zygote_spawn(script_path, user_folder, log_file_path, limits, cgroup_dir)
+                except (OSError, ValueError) as e:
+                    logger.warning(f"Zygote spawn failed for {script_key} ({e}). Falling back to Popen.")
+            if process is None:
+                process = subprocess.Popen(
+                    [python_exe, script_path], cwd=user_folder, stdout=log_file, stderr=log_file,
+                    stdin=subprocess.PIPE, startupinfo=startupinfo, creationflags=creationflags,
+                    preexec_fn=get_script_preexec(limits, cgroup_dir) if os.name != 'nt' else None,
+                    start_new_session=os.name != 'nt',
+                    encoding='utf-8', errors='ignore'
+                )
+            logger.info(f"Started Python process {process.pid} for {script_key} (tier: {tier}, limits: {limits}, "
+                        f"{'zygote' if isinstance(process, ZygoteProcess) else 'popen'})")
             bot_scripts[script_key] = {
-                'process': process, 'log_file': log_file, 'file_name': file_name,
-                'chat_id': message_obj_for_reply.chat.id,
+                'process': process, 'log_file': log_file, 'log_path': log_file_path, 'file_name': file_name,
+                'chat_id': message_obj_for_reply.chat.id if message_obj_for_reply else script_owner_id,
                 'script_owner_id': script_owner_id,
-                'start_time': datetime.now(), 'user_folder': user_folder, 'type': 'py', 'script_key': script_key
+                'start_time': datetime.now(), 'user_folder': user_folder, 'type': 'py', 'script_key': script_key,
+                'message': message_obj_for_reply, 'tier': tier, 'limits': limits, 'cgroup_dir': cgroup_dir,
+                # Both spawn paths make the script a session leader, so its pgid is its pid.
+                'pgid': process.pid if os.name != 'nt' else None
             }
-            bot.reply_to(message_obj_for_reply, f"✅ Python script '{file_name}' started! (PID: {process.pid}) (For User: {script_owner_id})")
+            script_placements[script_key] = LOCAL_NODE
+            supervise_script_process(script_key, process)
+            set_script_desired_state(script_owner_id, file_name, 'running')
+            reply_or_notify(message_obj_for_reply, f"✅ Python script '{file_name}' started! (PID: {process.pid}) (For User: {script_owner_id})")
         except FileNotFoundError:
             logger.error(f"Python interpreter {sys.executable} not found for long run {script_key}")
-            bot.reply_to(message_obj_for_reply, f"❌ Error: Python interpreter '{sys.executable}' not found.")
+            reply_or_notify(message_obj_for_reply, f"❌ Error: Python interpreter '{sys.executable}' not found.", chat_id=script_owner_id)
             if log_file and not log_file.closed:
                 log_file.close()
-            if script_key in bot_scripts:
-                del bot_scripts[script_key]
+            remove_script_cgroup(cgroup_dir)
+            bot_scripts.pop(script_key, None)
         except Exception as e:
             if log_file and not log_file.closed:
                 log_file.close()
             error_msg = f"❌ Error starting Python script '{file_name}': {str(e)}"
             logger.error(error_msg, exc_info=True)
-            bot.reply_to(message_obj_for_reply, error_msg)
+            reply_or_notify(message_obj_for_reply, error_msg, chat_id=script_owner_id)
             if process and process.poll() is None:
                 logger.warning(f"Killing potentially started Python process {process.pid} for {script_key}")
-                kill_process_tree({'process': process, 'log_file': log_file, 'script_key': script_key})
-            if script_key in bot_scripts:
-                del bot_scripts[script_key]
+                kill_process_tree({'process': process, 'log_file': log_file, 'script_key': script_key,
+                                   'pgid': process.pid if os.name != 'nt' else None})
+            elif cgroup_dir:
+                remove_script_cgroup(cgroup_dir)
+            bot_scripts.pop(script_key, None)
     except Exception as e:
         error_msg = f"❌ Unexpected error running Python script '{file_name}': {str(e)}"
         logger.error(error_msg, exc_info=True)
-        bot.reply_to(message_obj_for_reply, error_msg)
-        if script_key in bot_scripts:
+        reply_or_notify(message_obj_for_reply, error_msg, chat_id=script_owner_id)
+        script_info = bot_scripts.pop(script_key, None)
+        if script_info:
             logger.warning(f"Cleaning up {script_key} due to error in run_script.")
-            kill_process_tree(bot_scripts[script_key])
-            del bot_scripts[script_key]
+            kill_process_tree(script_info)
 
-# --- Map Telegram import names to actual PyPI package names ---
-TELEGRAM_MODULES = {
-    'telebot': 'pyTelegramBotAPI',
-    'telegram': 'python-telegram-bot',
-    'python_telegram_bot': 'python-telegram-bot',
-    'aiogram': 'aiogram',
-    'pyrogram': 'pyrogram',
-    'telethon': 'telethon',
-    'telethon.sync': 'telethon',
-    'from telethon.sync import telegramclient': 'telethon',
-    'telepot': 'telepot',
-    'pytg': 'pytg',
-    'tgcrypto': 'tgcrypto',
-    'telegram_upload': 'telegram-upload',
-    'telegram_send': 'telegram-send',
-    'telegram_text': 'telegram-text',
-    'mtproto': 'telegram-mtproto',
-    'tl': 'telethon',
-    'telegram_utils': 'telegram-utils',
-    'telegram_logger': 'telegram-logger',
-    'telegram_handlers': 'python-telegram-handlers',
-    'telegram_redis': 'telegram-redis',
-    'telegram_sqlalchemy': 'telegram-sqlalchemy',
-    'telegram_payment': 'telegram-payment',
-    'telegram_shop': 'telegram-shop-sdk',
-    'pytest_telegram': 'pytest-telegram',
-    'telegram_debug': 'telegram-debug',
-    'telegram_scraper': 'telegram-scraper',
-    'telegram_analytics': 'telegram-analytics',
-    'telegram_nlp': 'telegram-nlp-toolkit',
-    'telegram_ai': 'telegram-ai',
-    'telegram_api': 'telegram-api-client',
-    'telegram_web': 'telegram-web-integration',
-    'telegram_games': 'telegram-games',
-    'telegram_quiz': 'telegram-quiz-bot',
-    'telegram_ffmpeg': 'telegram-ffmpeg',
-    'telegram_media': 'telegram-media-utils',
-    'telegram_2fa': 'telegram-twofa',
-    'telegram_crypto': 'telegram-crypto-bot',
-    'telegram_i18n': 'telegram-i18n',
-    'telegram_translate': 'telegram-translate',
-    'bs4': 'beautifulsoup4',
-    'requests': 'requests',
-    'pillow': 'Pillow',
-    'cv2': 'opencv-python',
-    'yaml': 'PyYAML',
-    'dotenv': 'python-dotenv',
-    'dateutil': 'python-dateutil',
-    'pandas': 'pandas',
-    'numpy': 'numpy',
-    'flask': 'Flask',
-    'django': 'Django',
-    'sqlalchemy': 'SQLAlchemy',
-    'asyncio': None,
-    'json': None,
-    'datetime': None,
-    'os': None,
-    'sys': None,
-    're': None,
-    'time': None,
-    'math': None,
-    'random': None,
-    'logging': None,
-    'threading': None,
-    'subprocess': None,
-    'zipfile': None,
-    'tempfile': None,
-    'shutil': None,
-    'sqlite3': None,
-    'psutil': 'psutil',
-    'atexit': None
-}
 # --- End Automatic Package Installation & Script Running ---
 
-# --- Database Operations ---
-DB_LOCK = threading.Lock()
+# --- Start Scheduler ---
+# Every script start goes through this queue. A single dispatcher admits
+# requests while the host has process slots and memory headroom, highest tier
+# first; within a tier, users with fewer scripts running/queued go first.
+_start_queue = []
+_start_cv = threading.Condition()
+_start_seq = itertools.count()
+_queued_starts = {}
+_launching_starts = {}
+_start_dispatcher = None
+
+def _host_has_capacity():
+    if len(bot_scripts) + len(_launching_starts) >= MAX_CONCURRENT_SCRIPTS or len(_launching_starts) >= MAX_CONCURRENT_LAUNCHES:
+        return False
+    try:
+        return pick_script_node() is not None
+    except Exception:
+        return True
+
+def _user_share(script_owner_id):
+    running = sum(1 for info in list(bot_scripts.values()) if info.get('script_owner_id') == script_owner_id)
+    launching = sum(1 for owner_id in _launching_starts.values() if owner_id == script_owner_id)
+    queued = sum(1 for req in _queued_starts.values() if req['script_owner_id'] == script_owner_id)
+    return running + launching + queued
 
+def _queue_position(entry):
+    return 1 + sum(1 for e in _start_queue if e < entry and not e[3]['cancelled'])
+
+def _run_admitted_start(request):
+    try:
+        if shutting_down:
+            return
+        if is_bot_running(request['script_owner_id'], request['file_name']):
+            logger.info(f"Start of {request['script_key']} skipped: already running.")
+        else:
+            run_script(request['script_path'], request['script_owner_id'], request['user_folder'],
+                       request['file_name'], request['message'])
+    except Exception as e:
+        logger.error(f"Error running admitted start {request['script_key']}: {e}", exc_info=True)
+    finally:
+        with _start_cv:
+            _launching_starts.pop(request['script_key'], None)
+            _start_cv.notify_all()
+
+def _start_dispatcher_loop():
+    while True:
+        with _start_cv:
+            while not _start_queue or not _host_has_capacity():
+                # Re-check periodically: memory can free up without any script exiting.
+                _start_cv.wait(5 if _start_queue else None)
+            entry = heapq.heappop(_start_queue)
+            request = entry[3]
+            if request['cancelled']:
+                continue
+            _queued_starts.pop(request['script_key'], None)
+            _launching_starts[request['script_key']] = request['script_owner_id']
+        wait_time = time.time() - request['queued_at']
+        if wait_time > 1:
+            logger.info(f"Admitting {request['script_key']} after {wait_time:.1f}s in queue.")
+        threading.Thread(target=_run_admitted_start, args=(request,), daemon=True).start()
+
+def request_script_start(script_path, script_owner_id, user_folder, file_name, message_obj_for_reply):
+    """Queue a script start. Returns 0 when it is admitted right away, else its 1-based queue position."""
+    global _start_dispatcher
+    script_key = f"{script_owner_id}_{file_name}"
+    with _start_cv:
+        if _start_dispatcher is None:
+            _start_dispatcher = threading.Thread(target=_start_dispatcher_loop, name='start-scheduler', daemon=True)
+            _start_dispatcher.start()
+        existing = _queued_starts.get(script_key)
+        if existing:
+            return _queue_position(existing['entry'])
+        tier = get_user_tier(script_owner_id)
+        request = {'script_key': script_key, 'script_path': script_path, 'script_owner_id': script_owner_id,
+                   'user_folder': user_folder, 'file_name': file_name, 'message': message_obj_for_reply,
+                   'queued_at': time.time(), 'cancelled': False}
+        entry = (TIER_START_PRIORITY.get(tier, len(TIER_START_PRIORITY)), _user_share(script_owner_id), next(_start_seq), request)
+        request['entry'] = entry
+        heapq.heappush(_start_queue, entry)
+        _queued_starts[script_key] = request
+        admitted_now = _host_has_capacity() and _start_queue[0] is entry
+        position = 0 if admitted_now else _queue_position(entry)
+        _start_cv.notify_all()
+    if position:
+        logger.info(f"Start of {script_key} ({tier}) queued at position {position}.")
+    return position
+
+def cancel_queued_start(script_key):
+    with _start_cv:
+        request = _queued_starts.pop(script_key, None)
+        if request:
+            request['cancelled'] = True
+            logger.info(f"Cancelled queued start of {script_key}.")
+            return True
+    return False
+
+def notify_start_scheduler():
+    with _start_cv:
+        _start_cv.notify_all()
+
+def format_queue_notice(file_name, position):
+    return f"⏳ Host busy: '{file_name}' is queued at position {position}. It will start automatically."
+# --- End Start Scheduler ---
+
+# --- Database Operations ---
+# Writes go through db_execute(): the in-memory state is updated right away and
+# the row is persisted by the write-behind flusher (or inline with DB_WRITE_MODE=sync).
 def save_user_file(user_id, file_name, file_type='py'):
-    with DB_LOCK:
-        conn = sqlite3.connect(DATABASE_PATH, check_same_thread=False)
-        c = conn.cursor()
-        try:
-            c.execute('INSERT OR REPLACE INTO user_files (user_id, file_name, file_type) VALUES (?, ?, ?)',
-                      (user_id, file_name, file_type))
-            conn.commit()
-            if user_id not in user_files:
-                user_files[user_id] = []
-            user_files[user_id] = [(fn, ft) for fn, ft in user_files[user_id] if fn != file_name]
-            user_files[user_id].append((file_name, file_type))
-            logger.info(f"Saved file '{file_name}' ({file_type}) for user {user_id}")
-        except sqlite3.Error as e:
-            logger.error(f"❌ SQLite error saving file for user {user_id}, {file_name}: {e}")
-        except Exception as e:
-            logger.error(f"❌ Unexpected error saving file for {user_id}, {file_name}: {e}", exc_info=True)
-        finally:
-            conn.close()
+    try:
+        user_files.get(user_id)  # page the user in before the row is queued
+        db_execute(('user_files', user_id, file_name),
+                   ('INSERT OR REPLACE INTO user_files (user_id, file_name, file_type) VALUES (?, ?, ?)',
+                    (user_id, file_name, file_type)))
+        user_files.set_file(user_id, file_name, file_type)
+        logger.info(f"Saved file '{file_name}' ({file_type}) for user {user_id}")
+    except sqlite3.Error as e:
+        logger.error(f"❌ SQLite error saving file for user {user_id}, {file_name}: {e}")
+    except Exception as e:
+        logger.error(f"❌ Unexpected error saving file for {user_id}, {file_name}: {e}", exc_info=True)
 
 def remove_user_file_db(user_id, file_name):
-    with DB_LOCK:
-        conn = sqlite3.connect(DATABASE_PATH, check_same_thread=False)
+    try:
+        user_files.get(user_id)  # page the user in before the delete is queued
+        db_execute(('file', user_id, file_name),
+                   ('DELETE FROM user_files WHERE user_id = ? AND file_name = ?', (user_id, file_name)),
+                   ('DELETE FROM script_policies WHERE user_id = ? AND file_name = ?', (user_id, file_name)),
+                   ('DELETE FROM script_run_state WHERE user_id = ? AND file_name = ?', (user_id, file_name)),
+                   ('DELETE FROM script_health_probes WHERE user_id = ? AND file_name = ?', (user_id, file_name)))
+        user_files.remove_file(user_id, file_name)
+        script_restart_policies.pop((user_id, file_name), None)
+        script_health_probes.pop((user_id, file_name), None)
+        logger.info(f"Removed file '{file_name}' for user {user_id} from DB")
+    except sqlite3.Error as e:
+        logger.error(f"❌ SQLite error removing file for {user_id}, {file_name}: {e}")
+    except Exception as e:
+        logger.error(f"❌ Unexpected error removing file for {user_id}, {file_name}: {e}", exc_info=True)
+
+def save_restart_policy(user_id, file_name, restart_policy):
+    try:
+        db_execute(('script_policies', user_id, file_name),
+                   ('INSERT OR REPLACE INTO script_policies (user_id, file_name, restart_policy) VALUES (?, ?, ?)',
+                    (user_id, file_name, restart_policy)))
+        script_restart_policies[(user_id, file_name)] = restart_policy
+        logger.info(f"Saved restart policy '{restart_policy}' for '{file_name}' of user {user_id}")
+    except sqlite3.Error as e:
+        logger.error(f"❌ SQLite error saving restart policy for {user_id}, {file_name}: {e}")
+    except Exception as e:
+        logger.error(f"❌ Unexpected error saving restart policy for {user_id}, {file_name}: {e}", exc_info=True)
+
+def save_health_probe(user_id, file_name, probe):
+    """Store a script's health probe; probe=None removes it."""
+    try:
+        if probe is None:
+            db_execute(('script_health_probes', user_id, file_name),
+                       ('DELETE FROM script_health_probes WHERE user_id = ? AND file_name = ?', (user_id, file_name)))
+            script_health_probes.pop((user_id, file_name), None)
+        else:
+            db_execute(('script_health_probes', user_id, file_name),
+                       ('INSERT OR REPLACE INTO script_health_probes (user_id, file_name, probe, target, timeout, auto_restart) '
+                        'VALUES (?, ?, ?, ?, ?, ?)',
+                        (user_id, file_name, probe['probe'], probe['target'], probe['timeout'], int(probe['auto_restart']))))
+            script_health_probes[(user_id, file_name)] = probe
+        logger.info(f"Saved health probe {probe} for '{file_name}' of user {user_id}")
+    except sqlite3.Error as e:
+        logger.error(f"❌ SQLite error saving health probe for {user_id}, {file_name}: {e}")
+    except Exception as e:
+        logger.error(f"❌ Unexpected error saving health probe for {user_id}, {file_name}: {e}", exc_info=True)
+
+def set_script_desired_state(user_id, file_name, desired_state):
+    try:
+        db_execute(('script_run_state', user_id, file_name),
+                   ('INSERT OR REPLACE INTO script_run_state (user_id, file_name, desired_state, updated_at) VALUES (?, ?, ?, ?)',
+                    (user_id, file_name, desired_state, datetime.now().isoformat())))
+        logger.info(f"Desired state of '{file_name}' for user {user_id} set to '{desired_state}'")
+    except sqlite3.Error as e:
+        logger.error(f"❌ SQLite error saving run state for {user_id}, {file_name}: {e}")
+    except Exception as e:
+        logger.error(f"❌ Unexpected error saving run state for {user_id}, {file_name}: {e}", exc_info=True)
+
+def get_scripts_to_resume():
+    flush_db_writes()
+    with db_reader() as conn:
         c = conn.cursor()
         try:
-            c.execute('DELETE FROM user_files WHERE user_id = ? AND file_name = ?', (user_id, file_name))
-            conn.commit()
-            if user_id in user_files:
-                user_files[user_id] = [f for f in user_files[user_id] if f[0] != file_name]
-                if not user_files[user_id]:
-                    del user_files[user_id]
-            logger.info(f"Removed file '{file_name}' for user {user_id} from DB")
+            c.execute("SELECT user_id, file_name FROM script_run_state WHERE desired_state = 'running' ORDER BY updated_at")
+            return c.fetchall()
         except sqlite3.Error as e:
-            logger.error(f"❌ SQLite error removing file for {user_id}, {file_name}: {e}")
-        except Exception as e:
-            logger.error(f"❌ Unexpected error removing file for {user_id}, {file_name}: {e}", exc_info=True)
-        finally:
-            conn.close()
+            logger.error(f"❌ SQLite error loading scripts to resume: {e}")
+            return []
 
 def add_active_user(user_id):
+    if user_id in active_users:
+        return  # already persisted (or queued); /start spikes should not touch the DB at all
     active_users.add(user_id)
-    with DB_LOCK:
-        conn = sqlite3.connect(DATABASE_PATH, check_same_thread=False)
-        c = conn.cursor()
-        try:
-            c.execute('INSERT OR IGNORE INTO active_users (user_id) VALUES (?)', (user_id,))
-            conn.commit()
-            logger.info(f"Added/Confirmed active user {user_id} in DB")
-        except sqlite3.Error as e:
-            logger.error(f"❌ SQLite error adding active user {user_id}: {e}")
-        except Exception as e:
-            logger.error(f"❌ Unexpected error adding active user {user_id}: {e}", exc_info=True)
-        finally:
-            conn.close()
+    try:
+        db_execute(('active_users', user_id), ('INSERT OR IGNORE INTO active_users (user_id) VALUES (?)', (user_id,)))
+        logger.info(f"Added/Confirmed active user {user_id} in DB")
+    except sqlite3.Error as e:
+        logger.error(f"❌ SQLite error adding active user {user_id}: {e}")
+    except Exception as e:
+        logger.error(f"❌ Unexpected error adding active user {user_id}: {e}", exc_info=True)
 
 def save_subscription(user_id, expiry):
-    with DB_LOCK:
-        conn = sqlite3.connect(DATABASE_PATH, check_same_thread=False)
-        c = conn.cursor()
-        try:
-            expiry_str = expiry.isoformat()
-            c.execute('INSERT OR REPLACE INTO subscriptions (user_id, expiry) VALUES (?, ?)', (user_id, expiry_str))
-            conn.commit()
-            user_subscriptions[user_id] = {'expiry': expiry}
-            logger.info(f"Saved subscription for {user_id}, expiry {expiry_str}")
-        except sqlite3.Error as e:
-            logger.error(f"❌ SQLite error saving subscription for {user_id}: {e}")
-        except Exception as e:
-            logger.error(f"❌ Unexpected error saving subscription for {user_id}: {e}", exc_info=True)
-        finally:
-            conn.close()
+    try:
+        expiry_str = expiry.isoformat()
+        user_subscriptions.get(user_id)  # page in the old value before the write is queued
+        db_execute(('subscriptions', user_id),
+                   ('INSERT OR REPLACE INTO subscriptions (user_id, expiry) VALUES (?, ?)', (user_id, expiry_str)))
+        user_subscriptions[user_id] = {'expiry': expiry}
+        subscribed_users.add(user_id)
+        schedule_subscription_expiry(user_id, expiry)
+        logger.info(f"Saved subscription for {user_id}, expiry {expiry_str}")
+    except sqlite3.Error as e:
+        logger.error(f"❌ SQLite error saving subscription for {user_id}: {e}")
+    except Exception as e:
+        logger.error(f"❌ Unexpected error saving subscription for {user_id}: {e}", exc_info=True)
 
 def remove_subscription_db(user_id):
-    with DB_LOCK:
-        conn = sqlite3.connect(DATABASE_PATH, check_same_thread=False)
-        c = conn.cursor()
-        try:
-            c.execute('DELETE FROM subscriptions WHERE user_id = ?', (user_id,))
-            conn.commit()
-            if user_id in user_subscriptions:
-                del user_subscriptions[user_id]
-            logger.info(f"Removed subscription for {user_id} from DB")
-        except sqlite3.Error as e:
-            logger.error(f"❌ SQLite error removing subscription for {user_id}: {e}")
-        except Exception as e:
-            logger.error(f"❌ Unexpected error removing subscription for {user_id}: {e}", exc_info=True)
-        finally:
-            conn.close()
+    try:
+        subscribed = user_id in user_subscriptions
+        db_execute(('subscriptions', user_id), ('DELETE FROM subscriptions WHERE user_id = ?', (user_id,)),
+                   ('DELETE FROM subscription_notices WHERE user_id = ?', (user_id,)))
+        if subscribed:
+            del user_subscriptions[user_id]
+        subscribed_users.discard(user_id)  # queued expiry events see the missing row and are dropped
+        logger.info(f"Removed subscription for {user_id} from DB")
+    except sqlite3.Error as e:
+        logger.error(f"❌ SQLite error removing subscription for {user_id}: {e}")
+    except Exception as e:
+        logger.error(f"❌ Unexpected error removing subscription for {user_id}: {e}", exc_info=True)
 
 def add_admin_db(admin_id):
-    with DB_LOCK:
-        conn = sqlite3.connect(DATABASE_PATH, check_same_thread=False)
-        c = conn.cursor()
-        try:
-            c.execute('INSERT OR IGNORE INTO admins (user_id) VALUES (?)', (admin_id,))
-            conn.commit()
-            admin_ids.add(admin_id)
-            logger.info(f"Added admin {admin_id} to DB")
-        except sqlite3.Error as e:
-            logger.error(f"❌ SQLite error adding admin {admin_id}: {e}")
-        except Exception as e:
-            logger.error(f"❌ Unexpected error adding admin {admin_id}: {e}", exc_info=True)
-        finally:
-            conn.close()
+    try:
+        db_execute(('admins', admin_id), ('INSERT OR IGNORE INTO admins (user_id) VALUES (?)', (admin_id,)))
+        admin_ids.add(admin_id)
+        logger.info(f"Added admin {admin_id} to DB")
+    except sqlite3.Error as e:
+        logger.error(f"❌ SQLite error adding admin {admin_id}: {e}")
+    except Exception as e:
+        logger.error(f"❌ Unexpected error adding admin {admin_id}: {e}", exc_info=True)
 
 def remove_admin_db(admin_id):
     if admin_id == OWNER_ID:
         logger.warning("Attempted to remove OWNER_ID from admins.")
         return False
-    with DB_LOCK:
-        conn = sqlite3.connect(DATABASE_PATH, check_same_thread=False)
+    with db_writer() as conn:
         c = conn.cursor()
         removed = False
         try:
@@ -701,10 +3721,175 @@ def remove_admin_db(admin_id):
         except Exception as e:
             logger.error(f"❌ Unexpected error removing admin {admin_id}: {e}", exc_info=True)
             return False
-        finally:
-            conn.close()
 # --- End Database Operations ---
 
+# --- Subscription Expiry ---
+# Subscriptions used to be compared with datetime.now() on every tier check and
+# expired rows were only deleted when their user happened to /start. Now a heap
+# keyed by event time drives one timer thread: SUBSCRIPTION_NOTICE_DAYS before
+# expiry the user gets a notice, at expiry the row is removed (so the tier is
+# 'free' from then on), scripts over the free file limit are stopped and the
+# user is told. get_user_tier only has to test subscribed_users.
+# Only events within the next EXPIRY_WINDOW_HOURS are held in the heap; the
+# window is refilled from the expiry index when the thread reaches its end, so
+# memory does not grow with the number of subscribers. Events are not removed
+# when a subscription is extended or revoked: each carries the expiry it was
+# scheduled for and is dropped if that no longer matches the current row.
+_expiry_heap = []  # (when, seq, user_id, kind, expiry)
+_expiry_cv = threading.Condition()
+_expiry_seq = itertools.count()
+_expiry_horizon = None  # events before this time are in the heap
+_expiry_thread = None
+expiry_stats = {'notices': 0, 'expired': 0, 'scripts_stopped': 0, 'stale': 0, 'last_run': None}
+
+def _advance_expiry_window(now):
+    """Load the events due before now + EXPIRY_WINDOW_HOURS that are not in the heap yet."""
+    global _expiry_horizon
+    start = _expiry_horizon
+    _expiry_horizon = now + timedelta(hours=EXPIRY_WINDOW_HOURS)
+    # A subscription has an event in [start, horizon) if it expires before horizon + the notice period.
+    query = ('SELECT s.user_id, s.expiry, n.expiry FROM subscriptions s '
+             'LEFT JOIN subscription_notices n ON n.user_id = s.user_id WHERE s.expiry < ?')
+    params = [(_expiry_horizon + timedelta(days=SUBSCRIPTION_NOTICE_DAYS)).isoformat()]
+    if start is not None:
+        query += ' AND s.expiry >= ?'
+        params.append(start.isoformat())
+    for user_id, expiry_str, notified_for in _read_state(query, params):
+        value = _parse_subscription(user_id, expiry_str)
+        if value is _MISSING:
+            continue
+        expiry = value['expiry']
+        for kind, when in (('notice', expiry - timedelta(days=SUBSCRIPTION_NOTICE_DAYS)), ('expired', expiry)):
+            if kind == 'notice' and notified_for == expiry_str:
+                continue
+            if (start is None or when >= start) and when < _expiry_horizon:
+                heapq.heappush(_expiry_heap, (when, next(_expiry_seq), user_id, kind, expiry))
+
+def schedule_subscription_expiry(user_id, expiry):
+    """Queue the notice and expiry of a new or extended subscription (called by save_subscription)."""
+    now = datetime.now()
+    with _expiry_cv:
+        if _expiry_horizon is None:
+            return  # the scheduler is not running yet; its first window reads the row from the DB
+        for kind, when in (('notice', expiry - timedelta(days=SUBSCRIPTION_NOTICE_DAYS)), ('expired', expiry)):
+            if kind == 'notice' and when <= now:
+                continue  # a subscription shorter than the notice period: the activation message said when it ends
+            if when < _expiry_horizon:  # later events are read from the DB when the window gets there
+                heapq.heappush(_expiry_heap, (when, next(_expiry_seq), user_id, kind, expiry))
+        _expiry_cv.notify()
+
+def _expiry_loop():
+    while True:
+        with _expiry_cv:
+            now = datetime.now()
+            if now >= _expiry_horizon:
+                _advance_expiry_window(now)
+            # Wait a little past the first due event so others due around the same time join its batch.
+            wake_at = _expiry_horizon
+            if _expiry_heap:
+                wake_at = min(wake_at, _expiry_heap[0][0] + timedelta(seconds=EXPIRY_BATCH_SECONDS))
+            if wake_at > now:
+                _expiry_cv.wait(min((wake_at - now).total_seconds(), 3600))  # re-check hourly for clock changes
+                continue
+            due = []
+            while _expiry_heap and _expiry_heap[0][0] <= now:
+                due.append(heapq.heappop(_expiry_heap))
+        try:
+            process_expiry_events(due)
+        except Exception as e:
+            logger.error(f"❌ Subscription expiry run failed: {e}", exc_info=True)
+
+def stop_over_quota_scripts(user_id):
+    """Stop the scripts of files past the user's file limit (newest uploads first to go). Returns their names."""
+    limit = get_user_file_limit(user_id)
+    files = list(user_files.get(user_id, {}))
+    if limit == float('inf') or len(files) <= limit:
+        return []
+    stopped = []
+    for file_name in files[int(limit):]:
+        script_key = f"{user_id}_{file_name}"
+        cancel_pending_restart(script_key)
+        queued = cancel_queued_start(script_key)
+        if not queued and not is_bot_running(user_id, file_name):
+            continue
+        set_script_desired_state(user_id, file_name, 'stopped')
+        process_info = bot_scripts.get(script_key)
+        if process_info:
+            kill_process_tree(process_info)
+            bot_scripts.pop(script_key, None)
+        stopped.append(file_name)
+    if stopped:
+        logger.info(f"Stopped over-quota scripts of user {user_id} (limit {limit}): {stopped}")
+    return stopped
+
+def process_expiry_events(due):
+    """Handle a batch of due events: downgrade expired users, then send every notice in one paced run."""
+    notices = []
+    expired_count = notice_count = 0
+    for _, _, user_id, kind, expiry in due:
+        current = user_subscriptions.get(user_id)
+        if current is None or current['expiry'] != expiry:
+            expiry_stats['stale'] += 1  # extended or removed since the event was queued
+            continue
+        if kind == 'notice':
+            if expiry <= datetime.now():
+                continue  # the expiry event in this batch covers it
+            db_execute(('subscription_notices', user_id),
+                       ('INSERT OR REPLACE INTO subscription_notices (user_id, expiry) VALUES (?, ?)',
+                        (user_id, expiry.isoformat())))
+            days_left = max(1, round((expiry - datetime.now()).total_seconds() / 86400))
+            notices.append((user_id, f"⏳ Your subscription expires in {days_left} day(s), on {expiry:%Y-%m-%d %H:%M}.\n"
+                                     f"Contact {YOUR_USERNAME} to extend it and keep your {SUBSCRIBED_USER_LIMIT}-file limit."))
+            notice_count += 1
+        else:
+            remove_subscription_db(user_id)
+            stopped = stop_over_quota_scripts(user_id)
+            expiry_stats['scripts_stopped'] += len(stopped)
+            text = f"⌛ Your subscription expired on {expiry:%Y-%m-%d %H:%M}. You are now a free user ({FREE_USER_LIMIT} files)."
+            if stopped:
+                text += f"\n🔴 Stopped scripts over the limit: {', '.join(stopped)}"
+            notices.append((user_id, text))
+            expired_count += 1
+    expiry_stats['notices'] += notice_count
+    expiry_stats['expired'] += expired_count
+    expiry_stats['last_run'] = datetime.now()
+    if not notices:
+        return
+    logger.info(f"Subscription expiry: {expired_count} expired, {notice_count} expiring soon.")
+    for i, (user_id, text) in enumerate(notices):
+        try:
+            bot.send_message(user_id, text)
+        except Exception as e:
+            logger.warning(f"Could not send expiry notice to {user_id}: {e}")
+        if (i + 1) % 25 == 0:
+            time.sleep(1.5)  # same pacing as broadcasts
+    try:
+        bot.send_message(OWNER_ID, f"📅 Subscriptions: {expired_count} expired, "
+                                   f"{notice_count} expiring within {SUBSCRIPTION_NOTICE_DAYS} days.")
+    except Exception as e:
+        logger.warning(f"Could not send expiry summary to owner: {e}")
+
+def reset_expiry_index():
+    """Rebuild the heap from the DB, e.g. after a restore replaced the subscriptions table."""
+    global _expiry_horizon
+    with _expiry_cv:
+        if _expiry_horizon is None:
+            return
+        _expiry_heap.clear()
+        _expiry_horizon = None
+        _advance_expiry_window(datetime.now())
+        _expiry_cv.notify()
+
+def start_expiry_scheduler():
+    global _expiry_thread
+    with _expiry_cv:
+        if _expiry_thread is not None:
+            return
+        _advance_expiry_window(datetime.now())  # also picks up everything that expired while the bot was down
+        _expiry_thread = threading.Thread(target=_expiry_loop, name='subscription-expiry', daemon=True)
+        _expiry_thread.start()
+# --- End Subscription Expiry ---
+
 # --- Menu creation (Inline and ReplyKeyboards) ---
 def create_main_menu_inline(user_id):
     markup = types.InlineKeyboardMarkup(row_width=2)
@@ -748,6 +3933,15 @@ def create_reply_keyboard_main_menu(user_id):
         markup.add(*[types.KeyboardButton(text) for text in row_buttons_text])
     return markup
 
+def get_control_panel_text(script_owner_id, file_name, file_type, status_text):
+    script_key = f"{script_owner_id}_{file_name}"
+    return (f"⚙️ Controls for: `{file_name}` ({file_type}) of User `{script_owner_id}`\nStatus: {status_text}"
+            f"{format_script_node(script_key)}"
+            f"{format_resource_usage(script_key) if is_bot_running(script_owner_id, file_name) else ''}\n"
+            f"🔁 Restart policy: {get_restart_policy(script_owner_id, file_name)}"
+            f"{format_health(script_owner_id, file_name)}"
+            f"{format_restart_history(script_key)}")
+
 def create_control_buttons(script_owner_id, file_name, is_running=True):
     markup = types.InlineKeyboardMarkup(row_width=2)
     if is_running:
@@ -767,6 +3961,8 @@ def create_control_buttons(script_owner_id, file_name, is_running=True):
         markup.row(
             types.InlineKeyboardButton("📜 View Logs", callback_data=f'logs_{script_owner_id}_{file_name}')
         )
+    markup.row(types.InlineKeyboardButton(f"🔁 Restart: {get_restart_policy(script_owner_id, file_name)}",
+                                          callback_data=f'policy_{script_owner_id}_{file_name}'))
     markup.add(types.InlineKeyboardButton("🔙 Back to Files", callback_data='check_files'))
     return markup
 
@@ -826,13 +4022,8 @@ def handle_zip_file(downloaded_file_content, file_name_zip, message):
         if req_file:
             req_path = os.path.join(temp_dir, req_file)
             logger.info(f"requirements.txt found: {req_path}")
-            bot.reply_to(message, f"📦 Checking requirements.txt for missing packages...")
-            
-            # Install only missing requirements
-            if install_missing_requirements(req_path, message):
-                bot.reply_to(message, "✅ Requirements check completed!")
-            else:
-                bot.reply_to(message, "⚠️ Some requirements failed to install, but continuing...")
+            # Reports its progress and per-package results in a single edited message
+            install_missing_requirements(req_path, message, user_id=user_id)
 
         # Find main script
         main_script_name = None
@@ -887,7 +4078,9 @@ def handle_zip_file(downloaded_file_content, file_name_zip, message):
         bot.reply_to(message, f"✅ All files extracted successfully! Starting main script: `{main_script_name}`...", parse_mode='Markdown')
         
         # Start the main script
-        threading.Thread(target=run_script, args=(main_script_path, user_id, user_folder, main_script_name, message)).start()
+        position = request_script_start(main_script_path, user_id, user_folder, main_script_name, message)
+        if position:
+            bot.reply_to(message, format_queue_notice(main_script_name, position))
 
     except zipfile.BadZipFile as e:
         logger.error(f"Bad zip file from {user_id}: {e}")
@@ -906,7 +4099,9 @@ def handle_zip_file(downloaded_file_content, file_name_zip, message):
 def handle_py_file(file_path, script_owner_id, user_folder, file_name, message):
     try:
         save_user_file(script_owner_id, file_name, 'py')
-        threading.Thread(target=run_script, args=(file_path, script_owner_id, user_folder, file_name, message)).start()
+        position = request_script_start(file_path, script_owner_id, user_folder, file_name, message)
+        if position:
+            bot.reply_to(message, format_queue_notice(file_name, position))
     except Exception as e:
         logger.error(f"❌ Error processing Python file {file_name} for {script_owner_id}: {e}", exc_info=True)
         bot.reply_to(message, f"❌ Error processing Python file: {str(e)}")
@@ -957,15 +4152,11 @@ def _logic_send_welcome(message):
         user_status = "👑 Owner"
     elif user_id in admin_ids:
         user_status = "🛡️ Admin"
-    elif user_id in user_subscriptions:
-        expiry_date = user_subscriptions[user_id].get('expiry')
-        if expiry_date and expiry_date > datetime.now():
-            user_status = "⭐ Premium"
-            days_left = (expiry_date - datetime.now()).days
-            expiry_info = f"\n⏳ Subscription expires in: {days_left} days"
-        else:
-            user_status = "🆓 Free User (Expired Sub)"
-            remove_subscription_db(user_id)
+    elif get_user_tier(user_id) == 'subscribed':
+        user_status = "⭐ Premium"
+        expiry_date = user_subscriptions.get(user_id, {}).get('expiry')
+        if expiry_date:
+            expiry_info = f"\n⏳ Subscription expires in: {max(0, (expiry_date - datetime.now()).days)} days"
     else:
         user_status = "🆓 Free User"
 
@@ -1009,14 +4200,13 @@ def _logic_upload_file(message):
 
 def _logic_check_files(message):
     user_id = message.from_user.id
-    user_files_list = user_files.get(user_id, [])
-    if not user_files_list:
+    files_of_user = user_files.get(user_id, {})
+    if not files_of_user:
         bot.reply_to(message, "📂 Your files:\n\n(No files uploaded yet)")
         return
     markup = types.InlineKeyboardMarkup(row_width=1)
-    for file_name, file_type in sorted(user_files_list):
-        is_running = is_bot_running(user_id, file_name)
-        status_icon = "🟢 Running" if is_running else "🔴 Stopped"
+    for file_name, file_type in sorted(files_of_user.items()):
+        status_icon = script_status_label(user_id, file_name)
         btn_text = f"{file_name} ({file_type}) - {status_icon}"
         markup.add(types.InlineKeyboardButton(btn_text, callback_data=f'file_{user_id}_{file_name}'))
     bot.reply_to(message, "📂 Your files:\nClick to manage.", reply_markup=markup, parse_mode='Markdown')
@@ -1034,7 +4224,7 @@ def _logic_bot_speed(message):
             user_level = "👑 Owner"
         elif user_id in admin_ids:
             user_level = "🛡️ Admin"
-        elif user_id in user_subscriptions and user_subscriptions[user_id].get('expiry', datetime.min) > datetime.now():
+        elif get_user_tier(user_id) == 'subscribed':
             user_level = "⭐ Premium"
         else:
             user_level = "🆓 Free User"
@@ -1061,7 +4251,7 @@ def _logic_subscriptions_panel(message):
 def _logic_statistics(message):
     user_id = message.from_user.id
     total_users = len(active_users)
-    total_files_records = sum(len(files) for files in user_files.values())
+    total_files_records = user_files.total_records
 
     running_bots_count = 0
     user_running_bots = 0
@@ -1080,6 +4270,8 @@ def _logic_statistics(message):
 
     if user_id in admin_ids:
         stats_msg_admin = (f"🔒 Bot Status: {'🔴 Locked' if bot_locked else '🟢 Unlocked'}\n"
+                           f"⭐ Subscribers: {len(subscribed_users)} ({expiry_stats['expired']} expired, "
+                           f"{expiry_stats['notices']} notified since start)\n"
                            f"🤖 Your Running Bots: {user_running_bots}")
         stats_msg = stats_msg_base + stats_msg_admin
     else:
@@ -1135,11 +4327,12 @@ def _logic_run_all_scripts(message_or_call):
     logger.info(f"Admin {admin_user_id} initiated 'run all scripts' from chat {admin_chat_id}.")
 
     started_count = 0
+    queued_count = 0
     attempted_users = 0
     skipped_files = 0
     error_files_details = []
 
-    all_user_files_snapshot = dict(user_files)
+    all_user_files_snapshot = user_files.snapshot()
 
     for target_user_id, files_for_user in all_user_files_snapshot.items():
         if not files_for_user:
@@ -1148,20 +4341,20 @@ def _logic_run_all_scripts(message_or_call):
         logger.info(f"Processing scripts for user {target_user_id}...")
         user_folder = get_user_folder(target_user_id)
 
-        for file_name, file_type in files_for_user:
+        for file_name, file_type in files_for_user.items():
             if not is_bot_running(target_user_id, file_name):
                 file_path = os.path.join(user_folder, file_name)
                 if os.path.exists(file_path):
                     logger.info(f"Admin {admin_user_id} attempting to start '{file_name}' ({file_type}) for user {target_user_id}.")
                     try:
                         if file_type == 'py':
-                            threading.Thread(target=run_script, args=(file_path, target_user_id, user_folder, file_name, admin_message_obj_for_script_runner)).start()
+                            if request_script_start(file_path, target_user_id, user_folder, file_name, admin_message_obj_for_script_runner):
+                                queued_count += 1
                             started_count += 1
                         else:
                             logger.warning(f"Unknown file type '{file_type}' for {file_name} (user {target_user_id}). Skipping.")
                             error_files_details.append(f"`{file_name}` (User {target_user_id}) - Unknown type")
                             skipped_files += 1
-                        time.sleep(0.7)
                     except Exception as e:
                         logger.error(f"Error queueing start for '{file_name}' (user {target_user_id}): {e}")
                         error_files_details.append(f"`{file_name}` (User {target_user_id}) - Start error")
@@ -1173,6 +4366,7 @@ def _logic_run_all_scripts(message_or_call):
 
     summary_msg = (f"✅ All Users' Scripts - Processing Complete:\n\n"
                    f"▶️ Attempted to start: {started_count} scripts.\n"
+                   f"⏳ Waiting in start queue: {queued_count}.\n"
                    f"👥 Users processed: {attempted_users}.\n")
     if skipped_files > 0:
         summary_msg += f"⚠️ Skipped/Error files: {skipped_files}\n"
@@ -1184,6 +4378,227 @@ def _logic_run_all_scripts(message_or_call):
     reply_func(summary_msg, parse_mode='Markdown')
     logger.info(f"Run all scripts finished. Admin: {admin_user_id}. Started: {started_count}. Skipped/Errors: {skipped_files}")
 
+def _logic_stop_all_scripts(message):
+    if message.from_user.id not in admin_ids:
+        bot.reply_to(message, "⚠️ Admin permissions required.")
+        return
+    script_keys = list(bot_scripts.keys())
+    for script_key in script_keys + list(_queued_starts.keys()):
+        cancel_pending_restart(script_key)
+        cancel_queued_start(script_key)
+    if not script_keys:
+        bot.reply_to(message, "ℹ️ No scripts are running.")
+        return
+    bot.reply_to(message, f"⏳ Stopping {len(script_keys)} scripts...")
+    logger.info(f"Admin {message.from_user.id} initiated 'stop all scripts' ({len(script_keys)} running).")
+    process_infos = [bot_scripts.get(key) for key in script_keys]
+    stats = terminate_scripts(process_infos)
+    for script_info in process_infos:
+        if script_info:
+            set_script_desired_state(script_info['script_owner_id'], script_info['file_name'], 'stopped')
+            with SCRIPT_STATE_LOCK:
+                if bot_scripts.get(script_info['script_key']) is script_info:
+                    bot_scripts.pop(script_info['script_key'], None)
+    bot.reply_to(message, f"🔴 Stopped {stats['scripts']} scripts in {stats['elapsed']:.2f}s.\n"
+                          f"💀 Needed SIGKILL: {stats['killed']}")
+
+def _logic_top(message):
+    if message.from_user.id not in admin_ids:
+        bot.reply_to(message, "⚠️ Admin permissions required.")
+        return
+    parts = (message.text or '').split()
+    sort_by = 'mem' if len(parts) > 1 and parts[1].lower() in ('mem', 'memory', 'ram', 'rss') else 'cpu'
+    rows = []
+    for script_key in list(bot_scripts):
+        latest = get_latest_sample(script_key)
+        if latest:
+            rows.append((script_key, latest))
+    if not rows:
+        bot.reply_to(message, "📊 No resource samples yet. Try again in a few seconds.")
+        return
+    rows.sort(key=lambda r: r[1]['rss' if sort_by == 'mem' else 'cpu'], reverse=True)
+    lines = [f"{'PID':>7} {'CPU%':>6} {'RSS MB':>7} {'THR':>4} {'IO MB':>7}  SCRIPT"]
+    for script_key, s in rows[:15]:
+        lines.append(f"{s['pid']:>7} {s['cpu']:>6.1f} {s['rss'] / 1024 / 1024:>7.1f} {s['threads']:>4} "
+                     f"{s['io'] / 1024 / 1024:>7.1f}  {script_key[:40]}{format_script_node(script_key)}")
+    total_cpu = sum(s['cpu'] for _, s in rows)
+    total_rss = sum(s['rss'] for _, s in rows) / 1024 / 1024
+    bot.reply_to(message, f"📊 Top scripts by {'memory' if sort_by == 'mem' else 'CPU'} "
+                          f"({len(rows)} sampled, total {total_cpu:.1f}% CPU, {total_rss:.1f} MB):\n"
+                          "```\n" + "\n".join(lines) + "\n```\nUse `/top cpu` or `/top mem`.", parse_mode='Markdown')
+
+def _logic_workers(message):
+    if message.from_user.id not in admin_ids:
+        bot.reply_to(message, "⚠️ Admin permissions required.")
+        return
+    if not worker_nodes:
+        bot.reply_to(message, "🖥 No worker nodes configured (set WORKER_NODES). All scripts run on this host.")
+        return
+    refresh_worker_nodes()
+    counts = {}
+    for info in list(bot_scripts.values()):
+        node_name = info.get('node') or LOCAL_NODE
+        counts[node_name] = counts.get(node_name, 0) + 1
+    lines = [f"{'NODE':<12} {'STATE':<8} {'SCRIPTS':>7} {'FREE MB':>8} {'FREE CPU':>8} LIMITS"]
+    if RUN_SCRIPTS_LOCALLY:
+        lines.append(f"{LOCAL_NODE:<12} {'up':<8} {counts.get(LOCAL_NODE, 0):>7} "
+                     f"{psutil.virtual_memory().available // (1024 * 1024):>8} {'-':>8} "
+                     f"{'cgroup' if _init_cgroups() else 'rlimit'}")
+    for node_name, node in worker_nodes.items():
+        status = node['status']
+        if status:
+            lines.append(f"{node_name[:12]:<12} {'up':<8} {counts.get(node_name, 0):>7} "
+                         f"{status['mem_free_mb']:>8} {status['cpu_free']:>8.1f} "
+                         f"{'cgroup' if status.get('cgroups') else 'rlimit'}")
+        else:
+            lines.append(f"{node_name[:12]:<12} {'down':<8} {counts.get(node_name, 0):>7} {'-':>8} {'-':>8} -")
+    errors = [f"⚠️ {name}: {node['error']}" for name, node in worker_nodes.items() if node['error']]
+    bot.reply_to(message, "🖥 Worker nodes:\n```\n" + "\n".join(lines) + "\n```" + ("\n" + "\n".join(errors) if errors else ''),
+                 parse_mode='Markdown')
+
+def _logic_importmap(message):
+    parts = (message.text or '').split()[1:]
+    if not parts:
+        bot.reply_to(message, "🔎 Usage: `/importmap <import name>` shows which package is installed for it.\n"
+                              "Admins: `/importmap <import name> <package>` (or `none`) changes it.", parse_mode='Markdown')
+        return
+    if len(parts) == 1:
+        prefix, distribution = resolve_import(parts[0])
+        bot.reply_to(message, f"🔎 {parts[0]} -> {distribution or 'nothing (standard library / never installed)'}"
+                              f"{f' (matched {prefix})' if prefix != parts[0] else ''}")
+        return
+    if message.from_user.id not in admin_ids:
+        bot.reply_to(message, "⚠️ Admin permissions required.")
+        return
+    distribution = None if parts[1].lower() == 'none' else parts[1]
+    set_import_name(parts[0], distribution)
+    bot.reply_to(message, f"✅ {parts[0]} -> {distribution or 'never installed'}")
+
+def _logic_installs(message):
+    if message.from_user.id not in admin_ids:
+        bot.reply_to(message, "⚠️ Admin permissions required.")
+        return
+    bot.reply_to(message, install_queue_summary())
+
+def _logic_wheelhouse(message):
+    if message.from_user.id not in admin_ids:
+        bot.reply_to(message, "⚠️ Admin permissions required.")
+        return
+    if not WHEELHOUSE_ENABLED:
+        bot.reply_to(message, "📦 The wheelhouse is disabled (WHEELHOUSE=0); installs go straight to PyPI.")
+        return
+    parts = (message.text or '').split()[1:]
+    if parts and parts[0].lower() == 'prewarm':
+        if OFFLINE_INSTALLS:
+            bot.reply_to(message, "⚠️ Offline mode: the wheelhouse cannot be filled.")
+            return
+        packages = parts[1:] or WHEELHOUSE_PREWARM
+        bot.reply_to(message, f"⏳ Fetching wheels for {', '.join(packages)}...")
+        result = prewarm_wheelhouse(packages)
+        status = "✅ Done" if result['ok'] else "⚠️ Some packages failed"
+        bot.reply_to(message, f"{status}: {result['downloaded']} new wheels.\n\n{wheelhouse_summary()}")
+        return
+    if parts and parts[0].lower() == 'evict':
+        removed, freed = evict_wheelhouse(0 if len(parts) < 2 or not parts[1].isdigit() else int(parts[1]) * 1024 * 1024)
+        bot.reply_to(message, f"🗑 Removed {removed} wheels ({freed / 1024 / 1024:.1f} MB).\n\n{wheelhouse_summary()}")
+        return
+    bot.reply_to(message, wheelhouse_summary() + "\n\n`/wheelhouse prewarm [pkg ...]` - fetch wheels\n"
+                 "`/wheelhouse evict [MB]` - shrink to MB (default: empty it)", parse_mode='Markdown')
+
+def _logic_backup(message):
+    if message.from_user.id not in admin_ids:
+        bot.reply_to(message, "⚠️ Admin permissions required.")
+        return
+    parts = (message.text or '').split()[1:]
+    if parts and parts[0].lower() == 'now':
+        bot.reply_to(message, "⏳ Taking a backup...")
+        try:
+            metrics = backup_database('manual')
+        except Exception as e:
+            logger.error(f"❌ Manual backup failed: {e}", exc_info=True)
+            bot.reply_to(message, f"❌ Backup failed: {e}")
+            return
+        bot.reply_to(message, f"✅ Saved `{metrics['name']}` in {metrics['duration_ms']:.0f} ms.\n\n{backup_summary()}",
+                     parse_mode='Markdown')
+        return
+    if parts and parts[0].lower() == 'restore':
+        if message.from_user.id != OWNER_ID:
+            bot.reply_to(message, "⚠️ Owner only.")
+            return
+        if len(parts) < 2:
+            bot.reply_to(message, "♻️ Usage: `/backup restore <name>` (names are listed by `/backup`)", parse_mode='Markdown')
+            return
+        try:
+            result = restore_database(parts[1])
+        except FileNotFoundError:
+            bot.reply_to(message, f"⚠️ No backup named `{parts[1]}`.", parse_mode='Markdown')
+            return
+        except Exception as e:
+            logger.error(f"❌ Restore of {parts[1]} failed: {e}", exc_info=True)
+            bot.reply_to(message, f"❌ Restore failed: {e}")
+            return
+        bot.reply_to(message, f"♻️ Restored `{os.path.basename(parts[1])}` (writes paused {result['lock_ms']:.0f} ms).\n"
+                              f"The previous state was saved as `{result['pre_restore']}`. Running scripts were not touched.",
+                     parse_mode='Markdown')
+        return
+    bot.reply_to(message, backup_summary() + "\n\n`/backup now` - take a snapshot\n"
+                 "`/backup restore <name>` - roll the database back to it (owner only)", parse_mode='Markdown')
+
+HEALTH_USAGE = ("🩺 Usage:\n"
+                "`/health <file>` - show the probe\n"
+                "`/health <file> off` - remove it\n"
+                "`/health <file> heartbeat [path] [timeout] [restart]` - script must touch `path` (default `<name>.heartbeat`)\n"
+                "`/health <file> log [timeout] [restart]` - log must be written to (print with flush=True)\n"
+                "`/health <file> cpu [timeout] [restart]` - CPU must not sit at 100%\n"
+                "`/health <file> http <port>[/path] [timeout] [restart]` - port must answer\n"
+                "Timeouts are in seconds; add `restart` to restart the script automatically when it fails.")
+
+def _logic_health(message):
+    user_id = message.from_user.id
+    parts = (message.text or '').split()[1:]
+    if not parts:
+        bot.reply_to(message, HEALTH_USAGE, parse_mode='Markdown')
+        return
+    file_name = parts[0]
+    if not user_files.has_file(user_id, file_name):
+        bot.reply_to(message, f"⚠️ You have no file named `{file_name}`.", parse_mode='Markdown')
+        return
+    if len(parts) == 1:
+        probe = script_health_probes.get((user_id, file_name))
+        bot.reply_to(message, f"🩺 `{file_name}`: {describe_health_probe(probe) if probe else 'no health probe'}"
+                              f"\nStatus: {script_status_label(user_id, file_name)}", parse_mode='Markdown')
+        return
+    kind, args = parts[1].lower(), parts[2:]
+    if kind == 'off':
+        save_health_probe(user_id, file_name, None)
+        script_health.pop(f"{user_id}_{file_name}", None)
+        bot.reply_to(message, f"🩺 Health probe removed from `{file_name}`.", parse_mode='Markdown')
+        return
+    if kind not in HEALTH_PROBE_DEFAULT_TIMEOUTS:
+        bot.reply_to(message, HEALTH_USAGE, parse_mode='Markdown')
+        return
+    auto_restart = 'restart' in [a.lower() for a in args]
+    args = [a for a in args if a.lower() != 'restart']
+    numbers = [a for a in args if a.isdigit()]
+    targets = [a for a in args if not a.isdigit()]
+    target = None
+    if kind == 'http':
+        target = targets[0] if targets else (numbers.pop(0) if numbers else None)
+        if not target or not target.split('/', 1)[0].isdigit():
+            bot.reply_to(message, "⚠️ HTTP probes need a port, e.g. `/health bot.py http 8080/health 60`.", parse_mode='Markdown')
+            return
+    elif kind == 'heartbeat':
+        target = os.path.normpath(targets[0]) if targets else f"{os.path.splitext(file_name)[0]}.heartbeat"
+        if target.startswith('..') or os.path.isabs(target):
+            bot.reply_to(message, "⚠️ The heartbeat file must be inside your folder.")
+            return
+    timeout = int(numbers[0]) if numbers else HEALTH_PROBE_DEFAULT_TIMEOUTS[kind]
+    timeout = max(timeout, HEALTH_CHECK_INTERVAL * 2)
+    probe = {'probe': kind, 'target': target, 'timeout': timeout, 'auto_restart': auto_restart}
+    save_health_probe(user_id, file_name, probe)
+    script_health.pop(f"{user_id}_{file_name}", None)
+    bot.reply_to(message, f"🩺 Health probe for `{file_name}`: {describe_health_probe(probe)}", parse_mode='Markdown')
+
 # --- Command Handlers & Text Handlers for ReplyKeyboard ---
 @bot.message_handler(commands=['start', 'help'])
 def command_send_welcome(message):
@@ -1259,6 +4674,38 @@ def command_admin_panel(message):
 def command_run_all_code(message):
     _logic_run_all_scripts(message)
 
+@bot.message_handler(commands=['stopallcode'])
+def command_stop_all_code(message):
+    _logic_stop_all_scripts(message)
+
+@bot.message_handler(commands=['workers'])
+def command_workers(message):
+    _logic_workers(message)
+
+@bot.message_handler(commands=['importmap'])
+def command_importmap(message):
+    _logic_importmap(message)
+
+@bot.message_handler(commands=['installs'])
+def command_installs(message):
+    _logic_installs(message)
+
+@bot.message_handler(commands=['backup'])
+def command_backup(message):
+    _logic_backup(message)
+
+@bot.message_handler(commands=['wheelhouse'])
+def command_wheelhouse(message):
+    _logic_wheelhouse(message)
+
+@bot.message_handler(commands=['health'])
+def command_health(message):
+    _logic_health(message)
+
+@bot.message_handler(commands=['top'])
+def command_top(message):
+    _logic_top(message)
+
 @bot.message_handler(commands=['ping'])
 def ping(message):
     start_ping_time = time.time()
@@ -1358,6 +4805,8 @@ def handle_callbacks(call):
             delete_bot_callback(call)
         elif data.startswith('logs_'):
             logs_bot_callback(call)
+        elif data.startswith('policy_'):
+            restart_policy_callback(call)
         elif data == 'speed':
             speed_callback(call)
         elif data == 'back_to_main':
@@ -1428,8 +4877,8 @@ def upload_callback(call):
 def check_files_callback(call):
     user_id = call.from_user.id
     chat_id = call.message.chat.id
-    user_files_list = user_files.get(user_id, [])
-    if not user_files_list:
+    files_of_user = user_files.get(user_id, {})
+    if not files_of_user:
         bot.answer_callback_query(call.id, "⚠️ No files uploaded.", show_alert=True)
         try:
             markup = types.InlineKeyboardMarkup()
@@ -1440,9 +4889,8 @@ def check_files_callback(call):
         return
     bot.answer_callback_query(call.id)
     markup = types.InlineKeyboardMarkup(row_width=1)
-    for file_name, file_type in sorted(user_files_list):
-        is_running = is_bot_running(user_id, file_name)
-        status_icon = "🟢 Running" if is_running else "🔴 Stopped"
+    for file_name, file_type in sorted(files_of_user.items()):
+        status_icon = script_status_label(user_id, file_name)
         btn_text = f"{file_name} ({file_type}) - {status_icon}"
         markup.add(types.InlineKeyboardButton(btn_text, callback_data=f'file_{user_id}_{file_name}'))
     markup.add(types.InlineKeyboardButton("🔙 Back to Main", callback_data='back_to_main'))
@@ -1468,8 +4916,8 @@ def file_control_callback(call):
             check_files_callback(call)
             return
 
-        user_files_list = user_files.get(script_owner_id, [])
-        if not any(f[0] == file_name for f in user_files_list):
+        file_type = user_files.file_type(script_owner_id, file_name)
+        if file_type is None:
             logger.warning(f"File '{file_name}' not found for user {script_owner_id} during control.")
             bot.answer_callback_query(call.id, "⚠️ File not found.", show_alert=True)
             check_files_callback(call)
@@ -1477,11 +4925,10 @@ def file_control_callback(call):
 
         bot.answer_callback_query(call.id)
         is_running = is_bot_running(script_owner_id, file_name)
-        status_text = '🟢 Running' if is_running else '🔴 Stopped'
-        file_type = next((f[1] for f in user_files_list if f[0] == file_name), '?')
+        status_text = script_status_label(script_owner_id, file_name)
         try:
             bot.edit_message_text(
-                f"⚙️ Controls for: `{file_name}` ({file_type}) of User `{script_owner_id}`\nStatus: {status_text}",
+                get_control_panel_text(script_owner_id, file_name, file_type, status_text),
                 call.message.chat.id, call.message.message_id,
                 reply_markup=create_control_buttons(script_owner_id, file_name, is_running),
                 parse_mode='Markdown'
@@ -1511,14 +4958,12 @@ def start_bot_callback(call):
             bot.answer_callback_query(call.id, "⚠️ Permission denied to start this script.", show_alert=True)
             return
 
-        user_files_list = user_files.get(script_owner_id, [])
-        file_info = next((f for f in user_files_list if f[0] == file_name), None)
-        if not file_info:
+        file_type = user_files.file_type(script_owner_id, file_name)
+        if file_type is None:
             bot.answer_callback_query(call.id, "⚠️ File not found.", show_alert=True)
             check_files_callback(call)
             return
 
-        file_type = file_info[1]
         user_folder = get_user_folder(script_owner_id)
         file_path = os.path.join(user_folder, file_name)
 
@@ -1536,16 +4981,23 @@ def start_bot_callback(call):
                 logger.error(f"Error updating buttons (already running): {e}")
             return
 
-        bot.answer_callback_query(call.id, f"⏳ Attempting to start {file_name} for user {script_owner_id}...")
-
-        threading.Thread(target=run_script, args=(file_path, script_owner_id, user_folder, file_name, call.message)).start()
-
-        time.sleep(1.5)
+        reset_restart_state(f"{script_owner_id}_{file_name}")
+        position = request_script_start(file_path, script_owner_id, user_folder, file_name, call.message)
+        if position:
+            bot.answer_callback_query(call.id, f"⏳ Host busy. {file_name} queued at position {position}.", show_alert=True)
+        else:
+            bot.answer_callback_query(call.id, f"⏳ Attempting to start {file_name} for user {script_owner_id}...")
+            time.sleep(1.5)
         is_now_running = is_bot_running(script_owner_id, file_name)
-        status_text = '🟢 Running' if is_now_running else '🟡 Starting (or failed, check logs/replies)'
+        if is_now_running:
+            status_text = '🟢 Running'
+        elif position:
+            status_text = f'⏳ Queued (position {position})'
+        else:
+            status_text = '🟡 Starting (or failed, check logs/replies)'
         try:
             bot.edit_message_text(
-                f"⚙️ Controls for: `{file_name}` ({file_type}) of User `{script_owner_id}`\nStatus: {status_text}",
+                get_control_panel_text(script_owner_id, file_name, file_type, status_text),
                 chat_id_for_reply, call.message.message_id,
                 reply_markup=create_control_buttons(script_owner_id, file_name, is_now_running), parse_mode='Markdown'
             )
@@ -1579,21 +5031,22 @@ def stop_bot_callback(call):
             bot.answer_callback_query(call.id, "⚠️ Permission denied.", show_alert=True)
             return
 
-        user_files_list = user_files.get(script_owner_id, [])
-        file_info = next((f for f in user_files_list if f[0] == file_name), None)
-        if not file_info:
+        file_type = user_files.file_type(script_owner_id, file_name)
+        if file_type is None:
             bot.answer_callback_query(call.id, "⚠️ File not found.", show_alert=True)
             check_files_callback(call)
             return
 
-        file_type = file_info[1]
         script_key = f"{script_owner_id}_{file_name}"
+        cancel_pending_restart(script_key)
+        if cancel_queued_start(script_key):
+            set_script_desired_state(script_owner_id, file_name, 'stopped')
 
         if not is_bot_running(script_owner_id, file_name):
             bot.answer_callback_query(call.id, f"⚠️ Script '{file_name}' already stopped.", show_alert=True)
             try:
                 bot.edit_message_text(
-                    f"⚙️ Controls for: `{file_name}` ({file_type}) of User `{script_owner_id}`\nStatus: 🔴 Stopped",
+                    get_control_panel_text(script_owner_id, file_name, file_type, "🔴 Stopped"),
                     chat_id_for_reply, call.message.message_id,
                     reply_markup=create_control_buttons(script_owner_id, file_name, False), parse_mode='Markdown')
             except Exception as e:
@@ -1601,18 +5054,18 @@ def stop_bot_callback(call):
             return
 
         bot.answer_callback_query(call.id, f"⏳ Stopping {file_name} for user {script_owner_id}...")
+        set_script_desired_state(script_owner_id, file_name, 'stopped')
         process_info = bot_scripts.get(script_key)
         if process_info:
             kill_process_tree(process_info)
-            if script_key in bot_scripts:
-                del bot_scripts[script_key]
-                logger.info(f"Removed {script_key} from running after stop.")
+            bot_scripts.pop(script_key, None)
+            logger.info(f"Removed {script_key} from running after stop.")
         else:
-            logger.warning(f"Script {script_key} running by psutil but not in bot_scripts dict.")
+            logger.warning(f"Script {script_key} exited before it could be stopped.")
 
         try:
             bot.edit_message_text(
-                f"⚙️ Controls for: `{file_name}` ({file_type}) of User `{script_owner_id}`\nStatus: 🔴 Stopped",
+                get_control_panel_text(script_owner_id, file_name, file_type, "🔴 Stopped"),
                 chat_id_for_reply, call.message.message_id,
                 reply_markup=create_control_buttons(script_owner_id, file_name, False), parse_mode='Markdown'
             )
@@ -1640,14 +5093,12 @@ def restart_bot_callback(call):
             bot.answer_callback_query(call.id, "⚠️ Permission denied.", show_alert=True)
             return
 
-        user_files_list = user_files.get(script_owner_id, [])
-        file_info = next((f for f in user_files_list if f[0] == file_name), None)
-        if not file_info:
+        file_type = user_files.file_type(script_owner_id, file_name)
+        if file_type is None:
             bot.answer_callback_query(call.id, "⚠️ File not found.", show_alert=True)
             check_files_callback(call)
             return
 
-        file_type = file_info[1]
         user_folder = get_user_folder(script_owner_id)
         file_path = os.path.join(user_folder, file_name)
         script_key = f"{script_owner_id}_{file_name}"
@@ -1655,30 +5106,34 @@ def restart_bot_callback(call):
         if not os.path.exists(file_path):
             bot.answer_callback_query(call.id, f"⚠️ Error: File `{file_name}` missing! Re-upload.", show_alert=True)
             remove_user_file_db(script_owner_id, file_name)
-            if script_key in bot_scripts:
-                del bot_scripts[script_key]
+            bot_scripts.pop(script_key, None)
             check_files_callback(call)
             return
 
         bot.answer_callback_query(call.id, f"⏳ Restarting {file_name} for user {script_owner_id}...")
+        reset_restart_state(script_key)
         if is_bot_running(script_owner_id, file_name):
             logger.info(f"Restart: Stopping existing {script_key}...")
             process_info = bot_scripts.get(script_key)
             if process_info:
                 kill_process_tree(process_info)
-            if script_key in bot_scripts:
-                del bot_scripts[script_key]
+            bot_scripts.pop(script_key, None)
             time.sleep(1.5)
 
         logger.info(f"Restart: Starting script {script_key}...")
-        threading.Thread(target=run_script, args=(file_path, script_owner_id, user_folder, file_name, call.message)).start()
+        position = request_script_start(file_path, script_owner_id, user_folder, file_name, call.message)
 
         time.sleep(1.5)
         is_now_running = is_bot_running(script_owner_id, file_name)
-        status_text = '🟢 Running' if is_now_running else '🟡 Starting (or failed)'
+        if is_now_running:
+            status_text = '🟢 Running'
+        elif position:
+            status_text = f'⏳ Queued (position {position})'
+        else:
+            status_text = '🟡 Starting (or failed)'
         try:
             bot.edit_message_text(
-                f"⚙️ Controls for: `{file_name}` ({file_type}) of User `{script_owner_id}`\nStatus: {status_text}",
+                get_control_panel_text(script_owner_id, file_name, file_type, status_text),
                 chat_id_for_reply, call.message.message_id,
                 reply_markup=create_control_buttons(script_owner_id, file_name, is_now_running), parse_mode='Markdown'
             )
@@ -1712,14 +5167,15 @@ def delete_bot_callback(call):
             bot.answer_callback_query(call.id, "⚠️ Permission denied.", show_alert=True)
             return
 
-        user_files_list = user_files.get(script_owner_id, [])
-        if not any(f[0] == file_name for f in user_files_list):
+        if not user_files.has_file(script_owner_id, file_name):
             bot.answer_callback_query(call.id, "⚠️ File not found.", show_alert=True)
             check_files_callback(call)
             return
 
         bot.answer_callback_query(call.id, f"🗑️ Deleting {file_name} and all associated files for user {script_owner_id}...")
         script_key = f"{script_owner_id}_{file_name}"
+        cancel_pending_restart(script_key)
+        cancel_queued_start(script_key)
         
         # Stop if running
         if is_bot_running(script_owner_id, file_name):
@@ -1727,8 +5183,7 @@ def delete_bot_callback(call):
             process_info = bot_scripts.get(script_key)
             if process_info:
                 kill_process_tree(process_info)
-            if script_key in bot_scripts:
-                del bot_scripts[script_key]
+            bot_scripts.pop(script_key, None)
             time.sleep(0.5)
 
         user_folder = get_user_folder(script_owner_id)
@@ -1783,35 +5238,25 @@ def logs_bot_callback(call):
             bot.answer_callback_query(call.id, "⚠️ Permission denied.", show_alert=True)
             return
 
-        user_files_list = user_files.get(script_owner_id, [])
-        if not any(f[0] == file_name for f in user_files_list):
+        if not user_files.has_file(script_owner_id, file_name):
             bot.answer_callback_query(call.id, "⚠️ File not found.", show_alert=True)
             check_files_callback(call)
             return
 
-        user_folder = get_user_folder(script_owner_id)
-        log_path = os.path.join(user_folder, f"{os.path.splitext(file_name)[0]}.log")
-        if not os.path.exists(log_path):
+        max_log_kb = 100
+        max_tg_msg = 4096
+        log_data = read_script_log_tail(script_owner_id, file_name, max_log_kb * 1024)
+        if log_data is None:
             bot.answer_callback_query(call.id, f"⚠️ No logs for '{file_name}'.", show_alert=True)
             return
 
         bot.answer_callback_query(call.id)
         try:
-            log_content = ""
-            file_size = os.path.getsize(log_path)
-            max_log_kb = 100
-            max_tg_msg = 4096
+            file_size, log_content = log_data
             if file_size == 0:
                 log_content = "(Log empty)"
             elif file_size > max_log_kb * 1024:
-                with open(log_path, 'rb') as f:
-                    f.seek(-max_log_kb * 1024, os.SEEK_END)
-                    log_bytes = f.read()
-                log_content = log_bytes.decode('utf-8', errors='ignore')
                 log_content = f"(Last {max_log_kb} KB)\n...\n" + log_content
-            else:
-                with open(log_path, 'r', encoding='utf-8', errors='ignore') as f:
-                    log_content = f.read()
 
             if len(log_content) > max_tg_msg:
                 log_content = log_content[-max_tg_msg:]
@@ -1825,7 +5270,7 @@ def logs_bot_callback(call):
 
             bot.send_message(chat_id_for_reply, f"📜 Logs for `{file_name}` (User `{script_owner_id}`):\n```\n{log_content}\n```", parse_mode='Markdown')
         except Exception as e:
-            logger.error(f"Error reading/sending log {log_path}: {e}", exc_info=True)
+            logger.error(f"Error reading/sending log of {file_name} (user {script_owner_id}): {e}", exc_info=True)
             bot.send_message(chat_id_for_reply, f"❌ Error reading log for `{file_name}`.")
     except (ValueError, IndexError) as e:
         logger.error(f"Error parsing logs callback '{call.data}': {e}")
@@ -1834,6 +5279,49 @@ def logs_bot_callback(call):
         logger.error(f"Error in logs_bot_callback for '{call.data}': {e}", exc_info=True)
         bot.answer_callback_query(call.id, "Error fetching logs.", show_alert=True)
 
+def restart_policy_callback(call):
+    try:
+        _, script_owner_id_str, file_name = call.data.split('_', 2)
+        script_owner_id = int(script_owner_id_str)
+        requesting_user_id = call.from_user.id
+
+        if not (requesting_user_id == script_owner_id or requesting_user_id in admin_ids):
+            bot.answer_callback_query(call.id, "⚠️ Permission denied.", show_alert=True)
+            return
+
+        file_type = user_files.file_type(script_owner_id, file_name)
+        if file_type is None:
+            bot.answer_callback_query(call.id, "⚠️ File not found.", show_alert=True)
+            check_files_callback(call)
+            return
+
+        current_policy = get_restart_policy(script_owner_id, file_name)
+        new_policy = RESTART_POLICIES[(RESTART_POLICIES.index(current_policy) + 1) % len(RESTART_POLICIES)]
+        save_restart_policy(script_owner_id, file_name, new_policy)
+        if new_policy == 'never':
+            cancel_pending_restart(f"{script_owner_id}_{file_name}")
+        logger.info(f"Restart policy for {script_owner_id}_{file_name} set to '{new_policy}' by {requesting_user_id}")
+        bot.answer_callback_query(call.id, f"🔁 Restart policy: {new_policy}")
+
+        is_running = is_bot_running(script_owner_id, file_name)
+        try:
+            bot.edit_message_text(
+                get_control_panel_text(script_owner_id, file_name, file_type, script_status_label(script_owner_id, file_name)),
+                call.message.chat.id, call.message.message_id,
+                reply_markup=create_control_buttons(script_owner_id, file_name, is_running), parse_mode='Markdown'
+            )
+        except telebot.apihelper.ApiTelegramException as e:
+            if "message is not modified" in str(e):
+                logger.warning(f"Msg not modified (policy {file_name})")
+            else:
+                raise
+    except (ValueError, IndexError) as e:
+        logger.error(f"Error parsing policy callback '{call.data}': {e}")
+        bot.answer_callback_query(call.id, "Error: Invalid policy command.", show_alert=True)
+    except Exception as e:
+        logger.error(f"Error in restart_policy_callback for '{call.data}': {e}", exc_info=True)
+        bot.answer_callback_query(call.id, "Error changing restart policy.", show_alert=True)
+
 def speed_callback(call):
     user_id = call.from_user.id
     chat_id = call.message.chat.id
@@ -1847,7 +5335,7 @@ def speed_callback(call):
             user_level = "👑 Owner"
         elif user_id in admin_ids:
             user_level = "🛡️ Admin"
-        elif user_id in user_subscriptions and user_subscriptions[user_id].get('expiry', datetime.min) > datetime.now():
+        elif get_user_tier(user_id) == 'subscribed':
             user_level = "⭐ Premium"
         else:
             user_level = "🆓 Free User"
@@ -1875,14 +5363,11 @@ def back_to_main_callback(call):
         user_status = "👑 Owner"
     elif user_id in admin_ids:
         user_status = "🛡️ Admin"
-    elif user_id in user_subscriptions:
-        expiry_date = user_subscriptions[user_id].get('expiry')
-        if expiry_date and expiry_date > datetime.now():
-            user_status = "⭐ Premium"
-            days_left = (expiry_date - datetime.now()).days
-            expiry_info = f"\n⏳ Subscription expires in: {days_left} days"
-        else:
-            user_status = "🆓 Free User (Expired Sub)"
+    elif get_user_tier(user_id) == 'subscribed':
+        user_status = "⭐ Premium"
+        expiry_date = user_subscriptions.get(user_id, {}).get('expiry')
+        if expiry_date:
+            expiry_info = f"\n⏳ Subscription expires in: {max(0, (expiry_date - datetime.now()).days)} days"
     else:
         user_status = "🆓 Free User"
     main_menu_text = (f"〽️ Welcome back, {call.from_user.first_name}!\n\n🆔 ID: `{user_id}`\n"
@@ -2024,7 +5509,7 @@ def execute_broadcast(broadcast_text, photo_id, video_id, caption, admin_chat_id
     failed_count = 0
     blocked_count = 0
     start_exec_time = time.time()
-    users_to_broadcast = list(active_users)
+    users_to_broadcast = active_users.snapshot()
     total_users = len(users_to_broadcast)
     logger.info(f"Executing broadcast to {total_users} users.")
     batch_size = 25
@@ -2297,20 +5782,71 @@ def process_check_subscription_id(message):
         logger.error(f"Error processing check sub: {e}", exc_info=True)
         bot.reply_to(message, "Error.")
 
+# --- Warm Resume ---
+def resume_scripts():
+    """Queue every script whose desired state is 'running' through the start scheduler."""
+    to_resume = []
+    for script_owner_id, file_name in get_scripts_to_resume():
+        user_folder = get_user_folder(script_owner_id)
+        file_path = os.path.join(user_folder, file_name)
+        if not user_files.has_file(script_owner_id, file_name) or not os.path.exists(file_path):
+            logger.warning(f"Resume: '{file_name}' of user {script_owner_id} no longer exists. Skipping.")
+            set_script_desired_state(script_owner_id, file_name, 'stopped')
+            continue
+        to_resume.append((file_path, script_owner_id, user_folder, file_name))
+    if not to_resume:
+        logger.info("Resume: no scripts to resume.")
+        return
+
+    logger.info(f"Resume: queueing {len(to_resume)} scripts (max {MAX_CONCURRENT_LAUNCHES} launching at once).")
+    resume_start = time.time()
+    for file_path, script_owner_id, user_folder, file_name in to_resume:
+        if shutting_down:
+            return
+        request_script_start(file_path, script_owner_id, user_folder, file_name, None)
+        time.sleep(RESUME_STAGGER_SECONDS)
+
+    pending = {(owner, name) for _, owner, _, name in to_resume}
+    while pending and time.time() - resume_start < RESUME_REPORT_TIMEOUT:
+        pending = {(owner, name) for owner, name in pending if not is_bot_running(owner, name)}
+        if pending:
+            time.sleep(0.5)
+    duration = round(time.time() - resume_start, 2)
+    running_count = len(to_resume) - len(pending)
+    summary_msg = f"♻️ Warm resume finished:\n\n🟢 Running: {running_count}/{len(to_resume)}\n"
+    if pending:
+        summary_msg += f"⚠️ Not running after {duration}s: {len(pending)} (check logs)"
+    else:
+        summary_msg += f"⏱️ Time to all running: {duration}s"
+    logger.info(summary_msg)
+    try:
+        bot.send_message(OWNER_ID, summary_msg)
+    except Exception as e:
+        logger.error(f"Failed to send resume summary to owner: {e}")
+# --- End Warm Resume ---
+
 # --- Cleanup Function ---
 def cleanup():
+    global shutting_down
+    shutting_down = True
     logger.warning("Shutdown. Cleaning up processes...")
     script_keys_to_stop = list(bot_scripts.keys())
     if not script_keys_to_stop:
         logger.info("No scripts running. Exiting.")
+        stop_zygote()
+        flush_db_writes()
         return
+    # Worker agents keep their scripts running; they are adopted again on the next startup.
+    remote_keys = [key for key in script_keys_to_stop if (bot_scripts.get(key) or {}).get('node')]
+    if remote_keys:
+        logger.info(f"Leaving {len(remote_keys)} scripts running on worker nodes.")
+        script_keys_to_stop = [key for key in script_keys_to_stop if key not in remote_keys]
     logger.info(f"Stopping {len(script_keys_to_stop)} scripts...")
-    for key in script_keys_to_stop:
-        if key in bot_scripts:
-            logger.info(f"Stopping: {key}")
-            kill_process_tree(bot_scripts[key])
-        else:
-            logger.info(f"Script {key} already removed.")
+    stats = terminate_scripts([bot_scripts.get(key) for key in script_keys_to_stop])
+    logger.warning(f"Stopped {stats['scripts']} scripts in {stats['elapsed']:.2f}s "
+                   f"({stats['killed']} needed SIGKILL).")
+    stop_zygote()
+    flush_db_writes()  # exit handlers above may have queued state changes
     logger.warning("Cleanup finished.")
 
 atexit.register(cleanup)
@@ -2321,6 +5857,22 @@ if __name__ == '__main__':
                 f"🔧 Base Dir: {BASE_DIR}\n📁 Upload Dir: {UPLOAD_BOTS_DIR}\n" +
                 f"📊 Data Dir: {IROTECH_DIR}\n🔑 Owner ID: {OWNER_ID}\n🛡️ Admins: {admin_ids}\n" + "=" * 40)
     keep_alive()
+    if ZYGOTE_ENABLED:
+        start_zygote()
+    threading.Thread(target=resource_sampler_loop, name='resource-sampler', daemon=True).start()
+    if worker_nodes:
+        refresh_worker_nodes(adopt=True)
+        logger.info("Worker nodes: " + ", ".join(f"{name} ({'up' if node['status'] else node['error']})" for name, node in worker_nodes.items()))
+        threading.Thread(target=worker_poll_loop, name='worker-poller', daemon=True).start()
+    schedule_task(HEALTH_CHECK_INTERVAL, _health_check_tick)
+    start_expiry_scheduler()
+    threading.Thread(target=resume_scripts, name='warm-resume', daemon=True).start()
+    if os.name != 'nt':
+        schedule_task(ORPHAN_SWEEP_INTERVAL, _orphan_sweep_tick)
+    if WHEELHOUSE_ENABLED:
+        threading.Thread(target=prewarm_wheelhouse, name='wheelhouse-prewarm', daemon=True).start()
+    if BACKUP_INTERVAL_HOURS > 0:
+        threading.Thread(target=backup_loop, name='db-backup', daemon=True).start()
     logger.info("🚀 Starting polling...")
     while True:
         try:
@@ -0,0 +1,89 @@
+import ast
+import textwrap
+
+import bot
+
+
+def _imports(source):
+    return bot._collect_imports(ast.parse(textwrap.dedent(source)))
+
+
+def test_plain_imports_are_required():
+    found = _imports("""
+        import requests
+        from aiogram.types import Message
+        import importlib
+        importlib.import_module('yaml')
+        __import__('numpy')
+        from . import sibling
+    """)
+    assert found == {'requests': False, 'aiogram.types': False, 'importlib': False, 'yaml': False, 'numpy': False}
+
+
+def test_import_error_guards_make_imports_optional():
+    found = _imports("""
+        try:
+            import ujson
+        except ImportError:
+            ujson = None
+        try:
+            import orjson
+        except (ValueError, ModuleNotFoundError):
+            pass
+        try:
+            import uvloop
+        except:
+            pass
+    """)
+    assert found == {'ujson': True, 'orjson': True, 'uvloop': True}
+
+
+def test_broad_handlers_do_not_make_imports_optional():
+    found = _imports("""
+        try:
+            import requests
+            requests.get('https://example.com')
+        except Exception:
+            pass
+        try:
+            import aiohttp
+        except BaseException:
+            raise
+    """)
+    assert found == {'requests': False, 'aiohttp': False}
+
+
+def test_required_anywhere_wins():
+    found = _imports("""
+        try:
+            import requests
+        except ImportError:
+            requests = None
+        import requests
+    """)
+    assert found == {'requests': False}
+
+
+def test_handler_body_is_not_guarded():
+    found = _imports("""
+        try:
+            import ujson as json
+        except ImportError:
+            import simplejson as json
+    """)
+    assert found == {'ujson': True, 'simplejson': False}
+
+
+def test_scan_follows_local_modules(tmp_path):
+    (tmp_path / 'main.py').write_text("import os\nimport helpers\n")
+    (tmp_path / 'helpers.py').write_text("import requests\ntry:\n    import ujson\nexcept ImportError:\n    pass\n")
+    required, error = bot.collect_script_requirements(str(tmp_path / 'main.py'), str(tmp_path))
+    assert error is None
+    assert required == {'requests': False, 'ujson': True}
+
+
+def test_scan_reports_syntax_errors(tmp_path):
+    (tmp_path / 'main.py').write_text("def broken(:\n")
+    required, error = bot.collect_script_requirements(str(tmp_path / 'main.py'), str(tmp_path))
+    assert required == {}
+    assert isinstance(error, SyntaxError)
@@ -0,0 +1,97 @@
+import os
+import textwrap
+
+import pytest
+from packaging.requirements import Requirement
+
+import bot
+
+
+def _write(directory, name, text):
+    path = directory / name
+    path.write_text(textwrap.dedent(text))
+    return str(path)
+
+
+def test_parse_handles_includes_constraints_and_options(tmp_path):
+    _write(tmp_path, 'base.txt', "six>=1.0\n")
+    _write(tmp_path, 'pins.txt', "six==1.16.0\n")
+    req_path = _write(tmp_path, 'requirements.txt', """
+        -r base.txt
+        -c pins.txt
+        --pre
+        requests[socks] \\
+            >=2.0  # trailing comment
+        # a comment line
+        psutil
+        psutil!=5.9.0
+        https://example.com/pkg-1.0.tar.gz
+        --index-url https://example.com/simple
+    """)
+    parsed = bot.parse_requirements_file(req_path)
+    assert set(parsed['requirements']) == {'six', 'requests', 'psutil'}
+    assert str(parsed['requirements']['requests'].specifier) == '>=2.0'
+    assert parsed['requirements']['requests'].extras == {'socks'}
+    assert str(parsed['requirements']['psutil'].specifier) == '!=5.9.0'
+    assert str(parsed['constraints']['six'].specifier) == '==1.16.0'
+    assert parsed['direct'] == ['https://example.com/pkg-1.0.tar.gz']
+    assert parsed['pre']
+    assert len(parsed['files']) == 3
+
+
+def test_include_cycles_are_read_once(tmp_path):
+    _write(tmp_path, 'a.txt', "-r b.txt\nsix\n")
+    _write(tmp_path, 'b.txt', "-r a.txt\npsutil\n")
+    parsed = bot.parse_requirements_file(str(tmp_path / 'a.txt'))
+    assert set(parsed['requirements']) == {'six', 'psutil'}
+
+
+def test_markers_for_other_platforms_are_skipped(tmp_path):
+    req_path = _write(tmp_path, 'requirements.txt', """
+        pywin32; sys_platform == "win32"
+        uvloop; sys_platform != "win32"
+        tomli; python_version < "3.0"
+    """)
+    assert set(bot.parse_requirements_file(req_path)['requirements']) == {'uvloop'}
+
+
+@pytest.fixture
+def installed(monkeypatch):
+    versions = {}
+    monkeypatch.setattr(bot, 'installed_version', lambda name, env_id=None: versions.get(name))
+    return versions
+
+
+@pytest.mark.parametrize('line, version, satisfied', [
+    ('six', '1.16.0', True),
+    ('six', None, False),
+    ('six~=1.15', '1.16.0', True),
+    ('six~=1.15.0', '1.16.0', False),
+    ('six!=1.16.0', '1.16.0', False),
+    ('six>=1.0,<2', '1.16.0', True),
+    ('six>=2.0', '2.0rc1', False),
+    ('six>=2.0rc1', '2.0rc1', True),
+])
+def test_specifier_evaluation(installed, line, version, satisfied):
+    if version:
+        installed['six'] = version
+    assert (bot.requirement_unsatisfied(Requirement(line)) is None) == satisfied
+
+
+def test_constraint_narrows_requirement(installed):
+    installed['six'] = '1.15.0'
+    assert bot.requirement_unsatisfied(Requirement('six>=1.0'), constraint=Requirement('six==1.16.0'))
+    assert bot.requirement_unsatisfied(Requirement('six>=1.0'), constraint=Requirement('six<1.16')) is None
+
+
+def test_direct_url_is_never_satisfied(installed):
+    installed['pkg'] = '1.0'
+    assert bot.requirement_unsatisfied(Requirement('pkg @ https://example.com/pkg-1.0.tar.gz'))
+
+
+def test_unsatisfied_requirements_includes_direct_lines(tmp_path, installed):
+    installed['six'] = '1.16.0'
+    req_path = _write(tmp_path, 'requirements.txt', "six\npsutil\n./local_pkg\n")
+    (tmp_path / 'local_pkg').mkdir()
+    missing = bot.unsatisfied_requirements(bot.parse_requirements_file(req_path))
+    assert missing == [('psutil', 'not installed'), (os.path.join(str(tmp_path), './local_pkg'), 'cannot be checked locally')]
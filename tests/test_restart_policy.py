@@ -0,0 +1,63 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def restarts(monkeypatch):
+    """Capture scheduled restarts instead of running them; keep the DB and Telegram out of it."""
+    scheduled = []
+    monkeypatch.setattr(bot, 'schedule_task', lambda delay, func, *args: scheduled.append(delay) or [delay, 0, func, args, False])
+    monkeypatch.setattr(bot, 'set_script_desired_state', lambda *args: None)
+    monkeypatch.setattr(bot.bot, 'send_message', lambda *args, **kwargs: None)
+    monkeypatch.setattr(bot.random, 'uniform', lambda low, high: high)
+    monkeypatch.setattr(bot, 'script_restart_state', {})
+    monkeypatch.setattr(bot, 'script_restart_policies', {})
+    return scheduled
+
+
+def _info(ran_for=1):
+    return {'script_owner_id': 1, 'file_name': 'a.py', 'chat_id': 1, 'message': None,
+            'start_time': datetime.now() - timedelta(seconds=ran_for)}
+
+
+def test_backoff_doubles_up_to_the_cap(restarts, monkeypatch):
+    monkeypatch.setattr(bot, 'CRASH_LOOP_MAX_FAILURES', 100)
+    for _ in range(10):
+        bot.apply_restart_policy('1_a.py', _info(), 1)
+    assert restarts[:4] == [5, 10, 20, 40]
+    assert restarts[-1] == bot.RESTART_BACKOFF_MAX
+
+
+def test_long_run_resets_backoff(restarts):
+    bot.apply_restart_policy('1_a.py', _info(), 1)
+    bot.apply_restart_policy('1_a.py', _info(), 1)
+    bot.apply_restart_policy('1_a.py', _info(ran_for=bot.RESTART_RESET_AFTER), 1)
+    assert restarts == [5, 10, 5]
+
+
+def test_crash_loop_parks_script(restarts):
+    for _ in range(bot.CRASH_LOOP_MAX_FAILURES):
+        bot.apply_restart_policy('1_a.py', _info(), 1)
+    state = bot.script_restart_state['1_a.py']
+    assert state['parked']
+    assert len(restarts) == bot.CRASH_LOOP_MAX_FAILURES - 1
+
+
+def test_failures_outside_window_do_not_park(restarts, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(bot.time, 'time', lambda: clock[0])
+    for _ in range(bot.CRASH_LOOP_MAX_FAILURES * 2):
+        bot.apply_restart_policy('1_a.py', _info(), 1)
+        clock[0] += bot.CRASH_LOOP_WINDOW / (bot.CRASH_LOOP_MAX_FAILURES - 1) + 1
+    assert not bot.script_restart_state['1_a.py']['parked']
+
+
+@pytest.mark.parametrize('policy, returncode, restarted', [
+    ('on-failure', 1, True), ('on-failure', 0, False), ('always', 0, True), ('never', 1, False)])
+def test_policy_decides_restart(restarts, policy, returncode, restarted):
+    bot.script_restart_policies[(1, 'a.py')] = policy
+    bot.apply_restart_policy('1_a.py', _info(), returncode)
+    assert bool(restarts) == restarted
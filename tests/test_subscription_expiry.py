@@ -0,0 +1,108 @@
+import sqlite3
+from datetime import datetime, timedelta
+
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def expiry_heap(monkeypatch):
+    heap = []
+    monkeypatch.setattr(bot, '_expiry_heap', heap)
+    monkeypatch.setattr(bot, '_expiry_horizon', datetime.now() + timedelta(hours=bot.EXPIRY_WINDOW_HOURS))
+    return heap
+
+
+def _events(heap):
+    return [(user_id, kind) for _, _, user_id, kind, _ in sorted(heap)]
+
+
+def test_schedule_queues_only_events_inside_the_window(expiry_heap):
+    expiry = datetime.now() + timedelta(days=bot.SUBSCRIPTION_NOTICE_DAYS, hours=1)
+    bot.schedule_subscription_expiry(1, expiry)
+    assert _events(expiry_heap) == [(1, 'notice')]  # the expiry itself is read from the DB later
+
+
+def test_schedule_queues_notice_then_expiry(expiry_heap, monkeypatch):
+    monkeypatch.setattr(bot, '_expiry_horizon', datetime.now() + timedelta(days=bot.SUBSCRIPTION_NOTICE_DAYS + 1))
+    bot.schedule_subscription_expiry(1, datetime.now() + timedelta(days=bot.SUBSCRIPTION_NOTICE_DAYS, hours=1))
+    assert _events(expiry_heap) == [(1, 'notice'), (1, 'expired')]
+
+
+def test_schedule_skips_past_notice(expiry_heap):
+    bot.schedule_subscription_expiry(1, datetime.now() + timedelta(hours=1))
+    assert _events(expiry_heap) == [(1, 'expired')]
+
+
+def test_schedule_leaves_events_past_the_window_to_the_db(expiry_heap):
+    bot.schedule_subscription_expiry(1, datetime.now() + timedelta(hours=bot.EXPIRY_WINDOW_HOURS + 1,
+                                                                    days=bot.SUBSCRIPTION_NOTICE_DAYS + 1))
+    assert expiry_heap == []
+
+
+def test_heap_pops_in_time_order(expiry_heap):
+    now = datetime.now()
+    for user_id, hours in ((1, 5), (2, 1), (3, 3)):
+        bot.schedule_subscription_expiry(user_id, now + timedelta(hours=hours))
+    assert [user_id for user_id, _ in _events(expiry_heap)] == [2, 3, 1]
+
+
+def test_advance_window_loads_only_new_events(monkeypatch):
+    now = datetime.now()
+    rows = [(1, (now + timedelta(hours=1)).isoformat(), None),
+            (2, (now + timedelta(days=bot.SUBSCRIPTION_NOTICE_DAYS, hours=1)).isoformat(), None),
+            (3, 'not a date', None)]
+    rows.append((4, rows[1][1], rows[1][1]))  # notice already sent for this expiry
+    monkeypatch.setattr(bot, '_read_state', lambda query, params=(): rows)
+    monkeypatch.setattr(bot, '_expiry_heap', [])
+    monkeypatch.setattr(bot, '_expiry_horizon', None)
+    bot._advance_expiry_window(now)
+    # The first window also holds overdue events: user 1's notice is sent at once, before it expires.
+    assert _events(bot._expiry_heap) == [(1, 'notice'), (1, 'expired'), (2, 'notice')]
+
+
+@pytest.fixture
+def expiry_effects(monkeypatch):
+    effects = []
+    monkeypatch.setattr(bot, 'user_subscriptions', {})
+    monkeypatch.setattr(bot, 'expiry_stats', dict.fromkeys(bot.expiry_stats, 0))
+    monkeypatch.setattr(bot, 'remove_subscription_db', lambda user_id: effects.append(('removed', user_id)))
+    monkeypatch.setattr(bot, 'stop_over_quota_scripts', lambda user_id: [])
+    monkeypatch.setattr(bot, 'db_execute', lambda key, statement: effects.append(('noticed', key[1])))
+    monkeypatch.setattr(bot.bot, 'send_message', lambda chat_id, text: effects.append(('sent', chat_id)))
+    return effects
+
+
+def test_due_events_expire_and_notify(expiry_effects):
+    expired_at = datetime.now() - timedelta(seconds=1)
+    expires_soon = datetime.now() + timedelta(days=1)
+    bot.user_subscriptions.update({1: {'expiry': expired_at}, 2: {'expiry': expires_soon}})
+    bot.process_expiry_events([(expired_at, 0, 1, 'expired', expired_at), (expires_soon, 1, 2, 'notice', expires_soon)])
+    assert ('removed', 1) in expiry_effects and ('noticed', 2) in expiry_effects
+    assert ('sent', 1) in expiry_effects and ('sent', 2) in expiry_effects
+    assert bot.expiry_stats['expired'] == 1 and bot.expiry_stats['notices'] == 1
+
+
+def test_extended_or_removed_subscriptions_are_stale(expiry_effects):
+    old_expiry = datetime.now() - timedelta(seconds=1)
+    bot.user_subscriptions[1] = {'expiry': old_expiry + timedelta(days=30)}
+    bot.process_expiry_events([(old_expiry, 0, 1, 'expired', old_expiry), (old_expiry, 1, 2, 'expired', old_expiry)])
+    assert expiry_effects == []
+    assert bot.expiry_stats['stale'] == 2
+
+
+def test_expired_rows_are_not_subscribed_at_load(tmp_path, monkeypatch):
+    bot.close_db_connections()
+    monkeypatch.setattr(bot, 'DATABASE_PATH', str(tmp_path / 'bot_data.db'))
+    try:
+        bot.init_db()
+        now = datetime.now()
+        with sqlite3.connect(bot.DATABASE_PATH) as conn:
+            conn.executemany('INSERT INTO subscriptions (user_id, expiry) VALUES (?, ?)',
+                             [(1, (now - timedelta(days=1)).isoformat()), (2, (now + timedelta(days=1)).isoformat())])
+        subscribed = bot.UserIdSet('subscriptions', expires_column='expiry')
+        assert len(subscribed) == 1
+        assert 1 not in subscribed and 2 in subscribed
+    finally:
+        bot.close_db_connections()
@@ -0,0 +1,70 @@
+import threading
+
+import bot
+
+
+def _id_set(ids=(), merge_at=4):
+    user_ids = bot.UserIdSet('active_users')
+    user_ids.clear()  # start empty instead of loading from the DB
+    user_ids.MERGE_AT = merge_at
+    for user_id in ids:
+        user_ids.add(user_id)
+    return user_ids
+
+
+def test_membership_across_buffer_and_array():
+    user_ids = _id_set([5, 3, 9, 1, 7, 2])  # the first four are merged into the array
+    assert len(user_ids._ids) == 4 and user_ids._added == {7, 2}
+    assert all(user_id in user_ids for user_id in (1, 2, 3, 5, 7, 9))
+    assert 4 not in user_ids and 10 not in user_ids
+    assert list(user_ids) == [1, 2, 3, 5, 7, 9]
+    assert len(user_ids) == 6
+
+
+def test_add_is_idempotent():
+    user_ids = _id_set([1, 2, 3, 4, 1, 2])
+    assert list(user_ids) == [1, 2, 3, 4]
+
+
+def test_discard_from_buffer_and_array():
+    user_ids = _id_set([1, 2, 3, 4, 5])
+    user_ids.discard(5)
+    user_ids.discard(2)
+    user_ids.discard(42)
+    assert list(user_ids) == [1, 3, 4]
+    assert 2 not in user_ids and 5 not in user_ids
+
+
+def test_discard_does_not_change_an_array_readers_hold():
+    user_ids = _id_set(range(10))
+    held = user_ids._ids
+    user_ids.discard(3)
+    assert list(held) == list(range(8))
+    assert 3 not in user_ids
+
+
+def test_concurrent_readers_see_untouched_ids():
+    user_ids = _id_set(range(0, 20000, 2), merge_at=64)
+    errors = []
+    done = threading.Event()
+
+    def read():
+        while not done.is_set():
+            try:
+                if 10000 not in user_ids or 10001 in user_ids:
+                    errors.append('wrong answer')
+            except Exception as e:
+                errors.append(e)
+
+    readers = [threading.Thread(target=read) for _ in range(4)]
+    for reader in readers:
+        reader.start()
+    for user_id in range(0, 10000, 2):
+        user_ids.discard(user_id)
+    for user_id in range(1, 2000, 2):
+        user_ids.add(user_id + 20000)
+    done.set()
+    for reader in readers:
+        reader.join()
+    assert errors == []
+    assert len(user_ids) == 5000 + 1000
@@ -0,0 +1,425 @@
+# -*- coding: utf-8 -*-
+"""Worker agent: runs hosted scripts on behalf of a control bot.
+
+bot.py places scripts on the agents listed in WORKER_NODES. An agent can run
+on the same machine as the bot or on another host; to test placement locally,
+start several agents on different ports and data directories:
+
+    python worker_agent.py --name w1 --port 8101 --data-dir worker_data/w1
+    python worker_agent.py --name w2 --port 8102 --data-dir worker_data/w2
+    WORKER_NODES="w1=http://127.0.0.1:8101,w2=http://127.0.0.1:8102" python bot.py
+
+Like the bot's own host, every user gets a venv (<data-dir>/venvs/<user_id>)
+that packages are installed into from a local wheelhouse, and every script
+runs in its own cgroup with the tier's CPU, memory and pid limits (setrlimit
+and nice when cgroups v2 is not delegated to the agent).
+
+HTTP/JSON protocol (every request carries the X-Worker-Token header):
+  GET  /status                     node capacity and all scripts it knows about
+  POST /scripts/start              {"script_key", "user_id", "file_name", "bundle" (base64 zip),
+                                    "requirements" {import name: pip package}, "limits"} -> {"pid"}
+  GET  /scripts/<key>              {"pid", "running", "returncode", ...}
+  POST /scripts/<key>/stop         {"grace": seconds}; SIGTERM now, SIGKILL after grace
+  GET  /scripts/<key>/logs?bytes=N last N bytes of the script log
+"""
+import argparse
+import base64
+import hmac
+import importlib
+import importlib.machinery
+import io
+import ipaddress
+import json
+import logging
+import os
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import sysconfig
+import tempfile
+import threading
+import time
+import venv
+import zipfile
+
+import psutil
+from flask import Flask, jsonify, request
+
+import zygote
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('worker_agent')
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+app = Flask('worker_agent')
+config = {'name': 'worker', 'token': '', 'data_dir': 'worker_data', 'wheelhouse': 'worker_data/wheelhouse',
+          'offline': False, 'cgroups_dir': None}
+scripts = {}
+scripts_lock = threading.Lock()
+_start_locks = {}  # script key -> lock held for the whole start
+_install_locks = {}  # user id -> lock serializing installs into that user's venv
+_locks_guard = threading.Lock()
+_wheelhouse_lock = threading.Lock()
+
+
+@app.before_request
+def check_token():
+    supplied = request.headers.get('X-Worker-Token', '')
+    if config['token'] and not hmac.compare_digest(supplied, config['token']):
+        return jsonify({'error': 'bad token'}), 403
+
+
+def _keyed_lock(locks, key):
+    with _locks_guard:
+        return locks.setdefault(key, threading.Lock())
+
+
+def _user_folder(user_id):
+    folder = os.path.join(config['data_dir'], str(int(user_id)))
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+
+def _script_state(script_key, entry):
+    process = entry['process']
+    returncode = process.poll()
+    state = {'script_key': script_key, 'pid': process.pid, 'running': returncode is None, 'returncode': returncode,
+             'user_id': entry['user_id'], 'file_name': entry['file_name'], 'started': entry['started']}
+    if returncode is None:
+        try:
+            proc = entry['proc']
+            with proc.oneshot():
+                state['cpu'] = proc.cpu_percent(None)
+                state['rss'] = proc.memory_info().rss
+                state['threads'] = proc.num_threads()
+                try:
+                    io_counters = proc.io_counters()
+                    state['io'] = io_counters.read_bytes + io_counters.write_bytes
+                except (psutil.AccessDenied, AttributeError):
+                    state['io'] = 0
+        except psutil.Error:
+            pass
+    return state
+
+
+def _write_cgroup_file(path, value):
+    with open(path, 'w') as f:
+        f.write(value)
+
+
+def _init_cgroups():
+    """Prepare <own cgroup>/scripts for per-script cgroups, as bot.py does. Returns its path or None."""
+    try:
+        if os.name == 'nt' or not os.path.exists(os.path.join(CGROUP_ROOT, 'cgroup.controllers')):
+            logger.warning("cgroups v2 not available: CPU share and pid caps fall back to nice/setrlimit.")
+            return None
+        with open('/proc/self/cgroup') as f:
+            own_path = next(line.strip()[3:] for line in f if line.startswith('0::'))
+        own_dir = os.path.join(CGROUP_ROOT, own_path.lstrip('/'))
+        with open(os.path.join(own_dir, 'cgroup.controllers')) as f:
+            available = set(f.read().split())
+        controllers = ' '.join(f'+{c}' for c in ('cpu', 'memory', 'pids') if c in available)
+        if not controllers:
+            logger.warning("No cpu/memory/pids cgroup controllers delegated: limits fall back to nice/setrlimit.")
+            return None
+        # cgroup v2 forbids processes in inner nodes, so move the agent into a leaf first.
+        agent_dir = os.path.join(own_dir, 'agent')
+        scripts_dir = os.path.join(own_dir, 'scripts')
+        os.makedirs(agent_dir, exist_ok=True)
+        os.makedirs(scripts_dir, exist_ok=True)
+        _write_cgroup_file(os.path.join(agent_dir, 'cgroup.procs'), str(os.getpid()))
+        _write_cgroup_file(os.path.join(own_dir, 'cgroup.subtree_control'), controllers)
+        _write_cgroup_file(os.path.join(scripts_dir, 'cgroup.subtree_control'), controllers)
+        logger.info(f"cgroups v2 enabled for hosted scripts at {scripts_dir} ({controllers}).")
+        return scripts_dir
+    except (OSError, StopIteration) as e:
+        logger.warning(f"Could not set up cgroups v2 ({e}): limits fall back to nice/setrlimit.")
+        return None
+
+
+def _create_cgroup(script_key, limits):
+    if not config['cgroups_dir']:
+        return None
+    cgroup_dir = None
+    try:
+        cgroup_dir = tempfile.mkdtemp(prefix=re.sub(r'[^A-Za-z0-9_.-]', '_', script_key) + '-', dir=config['cgroups_dir'])
+        if limits.get('cpu'):
+            _write_cgroup_file(os.path.join(cgroup_dir, 'cpu.max'), f"{int(limits['cpu'] * 100000)} 100000")
+        if limits.get('memory_mb'):
+            _write_cgroup_file(os.path.join(cgroup_dir, 'memory.max'), str(limits['memory_mb'] * 1024 * 1024))
+            try:
+                _write_cgroup_file(os.path.join(cgroup_dir, 'memory.swap.max'), '0')
+            except OSError:
+                pass
+        if limits.get('pids'):
+            _write_cgroup_file(os.path.join(cgroup_dir, 'pids.max'), str(limits['pids']))
+        return cgroup_dir
+    except OSError as e:
+        logger.error(f"Failed to create cgroup for {script_key}: {e}. Falling back to setrlimit.")
+        if cgroup_dir:
+            _remove_cgroup(cgroup_dir)
+        return None
+
+
+def _remove_cgroup(cgroup_dir):
+    # The script is gone; anything still in its cgroup escaped its session.
+    try:
+        with open(os.path.join(cgroup_dir, 'cgroup.procs')) as f:
+            leftover = f.read().split()
+        if leftover and os.path.exists(os.path.join(cgroup_dir, 'cgroup.kill')):
+            _write_cgroup_file(os.path.join(cgroup_dir, 'cgroup.kill'), '1')
+            deadline = time.time() + 1
+            while time.time() < deadline:
+                with open(os.path.join(cgroup_dir, 'cgroup.procs')) as f:
+                    if not f.read().strip():
+                        break
+                time.sleep(0.02)
+    except OSError:
+        pass
+    try:
+        os.rmdir(cgroup_dir)
+    except OSError as e:
+        logger.warning(f"Could not remove cgroup {cgroup_dir}: {e}")
+
+
+def _watch_script(script_key, entry):
+    returncode = entry['process'].wait()
+    logger.info(f"{script_key} (PID {entry['process'].pid}) exited with code {returncode}")
+    if entry['cgroup_dir']:
+        _remove_cgroup(entry['cgroup_dir'])
+
+
+def _user_venv(user_id):
+    """(site-packages, python) of the user's venv, created on first use. Call with the user's install lock held."""
+    venv_dir = os.path.join(config['data_dir'], 'venvs', str(int(user_id)))
+    python = os.path.join(venv_dir, 'Scripts', 'python.exe') if os.name == 'nt' else os.path.join(venv_dir, 'bin', 'python')
+    if not os.path.exists(python):
+        venv.EnvBuilder(symlinks=os.name != 'nt', with_pip=False, clear=True).create(venv_dir)
+        logger.info(f"Created venv for user {user_id}")
+    return sysconfig.get_path('purelib', vars={'base': venv_dir, 'platbase': venv_dir}), python
+
+
+def _importable(module_name, site_packages):
+    """Whether a (dotted) module can be imported from site_packages. Nothing is imported."""
+    search_path = [site_packages]
+    parts = module_name.split('.')
+    try:
+        for depth, part in enumerate(parts):
+            spec = importlib.machinery.PathFinder.find_spec(part, search_path)
+            if spec is None:
+                return False
+            search_path = spec.submodule_search_locations
+            if search_path is None:
+                return depth == len(parts) - 1
+        return True
+    except (ImportError, ValueError):
+        return False
+
+
+def _pip(args, packages, constraints, timeout):
+    command = [sys.executable, '-m', 'pip'] + args + ['--progress-bar', 'off'] + packages
+    for constraint_path in constraints:
+        command += ['-c', constraint_path]
+    try:
+        return subprocess.run(command, capture_output=True, text=True, encoding='utf-8', errors='ignore', timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return subprocess.CompletedProcess(command, 1, '', f"pip timed out after {timeout}s")
+
+
+def _install_requirements(user_id, user_folder, requirements):
+    """Install the packages for every import name the user's venv cannot import, in one pip run.
+    Same order as the bot: the agent's wheelhouse first, filled from the index on a miss (never
+    with --offline), with the user's constraints.txt applied. Returns (venv python, error or None)."""
+    with _keyed_lock(_install_locks, int(user_id)):
+        site_packages, python = _user_venv(user_id)
+        importlib.invalidate_caches()
+        missing = sorted({package for name, package in requirements.items()
+                          if package and not _importable(name, site_packages)})
+        if not missing:
+            return python, None
+        constraints = [path for path in (os.path.join(user_folder, 'constraints.txt'),) if os.path.exists(path)]
+        install = ['--python', python, 'install', '--no-warn-script-location']
+        local = ['--no-index', '--find-links', config['wheelhouse']]
+        timeout = 120 + 60 * len(missing)
+        logger.info(f"Installing {missing} for user {user_id}")
+        result = _pip(install + local, missing, constraints, timeout)
+        if result.returncode != 0 and not config['offline']:
+            with _wheelhouse_lock:  # every venv on this node fills the same directory
+                fill = _pip(['wheel', '--wheel-dir', config['wheelhouse'], '--find-links', config['wheelhouse']],
+                            missing, constraints, timeout)
+            if fill.returncode == 0:
+                result = _pip(install + local, missing, constraints, timeout)
+            else:
+                logger.warning(f"Wheelhouse fill failed; installing from the index:\n{(fill.stderr or fill.stdout)[-1000:]}")
+                result = _pip(install, missing, constraints, timeout)
+    if result.returncode != 0:
+        return python, f"Failed to install {', '.join(missing)}:\n{(result.stderr or result.stdout)[-3000:]}"
+    return python, None
+
+
+def _stop_process(script_key, entry, grace):
+    process = entry['process']
+    if process.poll() is not None:
+        return
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        return
+    if grace > 0:
+        try:
+            process.wait(timeout=grace)
+            return
+        except subprocess.TimeoutExpired:
+            logger.warning(f"{script_key} ignored SIGTERM for {grace}s. Killing.")
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    process.wait()
+
+
+@app.route('/status')
+def status():
+    with scripts_lock:
+        states = {key: _script_state(key, entry) for key, entry in scripts.items()}
+    memory = psutil.virtual_memory()
+    cpu_count = os.cpu_count() or 1
+    load1 = os.getloadavg()[0] if hasattr(os, 'getloadavg') else psutil.cpu_percent(None) / 100 * cpu_count
+    return jsonify({'node': config['name'], 'cpu_count': cpu_count, 'cpu_free': max(0.0, cpu_count - load1),
+                    'mem_total_mb': memory.total // (1024 * 1024), 'mem_free_mb': memory.available // (1024 * 1024),
+                    'cgroups': config['cgroups_dir'] is not None, 'scripts': states})
+
+
+@app.route('/scripts/start', methods=['POST'])
+def start_script():
+    payload = request.get_json(force=True)
+    script_key, file_name = payload['script_key'], os.path.basename(payload['file_name'])
+    # Held until the process is registered: a second start of the same script waits here and then sees it running.
+    with _keyed_lock(_start_locks, script_key):
+        with scripts_lock:
+            entry = scripts.get(script_key)
+            if entry and entry['process'].poll() is None:
+                return jsonify({'error': f"{script_key} is already running", 'pid': entry['process'].pid}), 409
+        user_folder = _user_folder(payload['user_id'])
+        with zipfile.ZipFile(io.BytesIO(base64.b64decode(payload['bundle']))) as bundle:
+            for member in bundle.namelist():
+                target = os.path.realpath(os.path.join(user_folder, member))
+                if not target.startswith(os.path.realpath(user_folder) + os.sep):
+                    return jsonify({'error': f"unsafe path in bundle: {member}"}), 400
+            bundle.extractall(user_folder)
+        python, error = _install_requirements(payload['user_id'], user_folder, payload.get('requirements') or {})
+        if error:
+            return jsonify({'error': error}), 500
+
+        limits = payload.get('limits') or {}
+        log_path = os.path.join(user_folder, f"{os.path.splitext(file_name)[0]}.log")
+        cgroup_dir = _create_cgroup(script_key, limits)
+        # The zygote launcher applies the limits and execs the script; preexec_fn is unsafe in this threaded server.
+        command = [python, zygote.__file__, '--exec', json.dumps(limits), cgroup_dir or '',
+                   python, os.path.join(user_folder, file_name)]
+        try:
+            with open(log_path, 'w', encoding='utf-8', errors='ignore') as log_file:
+                process = subprocess.Popen(command, cwd=user_folder, stdout=log_file, stderr=log_file,
+                                           stdin=subprocess.DEVNULL, start_new_session=True)
+        except OSError:
+            if cgroup_dir:
+                _remove_cgroup(cgroup_dir)
+            raise
+        entry = {'process': process, 'proc': psutil.Process(process.pid), 'user_id': int(payload['user_id']),
+                 'file_name': file_name, 'log_path': log_path, 'started': time.time(), 'cgroup_dir': cgroup_dir}
+        with scripts_lock:
+            scripts[script_key] = entry
+    threading.Thread(target=_watch_script, args=(script_key, entry), daemon=True).start()
+    logger.info(f"Started {script_key} (PID {process.pid}, limits {limits}, cgroup {cgroup_dir or 'none'})")
+    return jsonify({'pid': process.pid})
+
+
+@app.route('/scripts/<path:script_key>')
+def script_status(script_key):
+    with scripts_lock:
+        entry = scripts.get(script_key)
+    if not entry:
+        return jsonify({'error': 'unknown script'}), 404
+    return jsonify(_script_state(script_key, entry))
+
+
+@app.route('/scripts/<path:script_key>/stop', methods=['POST'])
+def stop_script(script_key):
+    grace = float((request.get_json(silent=True) or {}).get('grace', 5))
+    with scripts_lock:
+        entry = scripts.get(script_key)
+    if not entry:
+        return jsonify({'error': 'unknown script'}), 404
+    # Return right away so the bot can stop many scripts in parallel and poll for the result.
+    threading.Thread(target=_stop_process, args=(script_key, entry, grace), daemon=True).start()
+    return jsonify({'pid': entry['process'].pid, 'stopping': True})
+
+
+@app.route('/scripts/<path:script_key>/logs')
+def script_logs(script_key):
+    with scripts_lock:
+        entry = scripts.get(script_key)
+    if not entry or not os.path.exists(entry['log_path']):
+        return jsonify({'error': 'no log'}), 404
+    max_bytes = int(request.args.get('bytes', 100 * 1024))
+    with open(entry['log_path'], 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(0, size - max_bytes))
+        data = f.read()
+    return jsonify({'size': size, 'log': data.decode('utf-8', errors='ignore')})
+
+
+def _is_loopback(host):
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def _stop_all(signum=None, frame=None):
+    with scripts_lock:
+        entries = list(scripts.items())
+    threads = [threading.Thread(target=_stop_process, args=(key, entry, 5)) for key, entry in entries]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if signum is not None:
+        sys.exit(0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Worker agent for hosted scripts.')
+    parser.add_argument('--name', default=os.environ.get('WORKER_NAME', 'worker'))
+    parser.add_argument('--host', default=os.environ.get('WORKER_HOST', '127.0.0.1'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('WORKER_PORT', 8101)))
+    parser.add_argument('--data-dir', default=os.environ.get('WORKER_DATA_DIR', 'worker_data'))
+    parser.add_argument('--token', default=os.environ.get('WORKER_TOKEN', ''))
+    parser.add_argument('--wheelhouse', default=os.environ.get('WORKER_WHEELHOUSE'),
+                        help='local wheel cache shared by all venvs (default: <data-dir>/wheelhouse)')
+    parser.add_argument('--offline', action='store_true', default=os.environ.get('OFFLINE_INSTALLS', '0') == '1',
+                        help='install only from the wheelhouse, never from the index')
+    parser.add_argument('--clean', action='store_true', help='wipe the data directory on start')
+    args = parser.parse_args()
+    if not args.token:
+        # Without a token anyone who can reach the port can run arbitrary code through /scripts/start.
+        if not _is_loopback(args.host):
+            parser.error(f"refusing to listen on {args.host} without --token (or WORKER_TOKEN)")
+        logger.warning("⚠️ No --token set: any local process can start scripts through this agent.")
+    data_dir = os.path.abspath(args.data_dir)
+    config.update(name=args.name, token=args.token, data_dir=data_dir, offline=args.offline,
+                  wheelhouse=os.path.abspath(args.wheelhouse or os.path.join(data_dir, 'wheelhouse')))
+    if args.clean:
+        shutil.rmtree(config['data_dir'], ignore_errors=True)
+    os.makedirs(config['data_dir'], exist_ok=True)
+    os.makedirs(config['wheelhouse'], exist_ok=True)
+    config['cgroups_dir'] = _init_cgroups()
+    signal.signal(signal.SIGTERM, _stop_all)
+    logger.info(f"Worker agent {args.name} listening on {args.host}:{args.port}, data in {config['data_dir']}")
+    app.run(host=args.host, port=args.port, threaded=True)
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""Fork server ("zygote") for hosted scripts.
+
+bot.py starts this when ZYGOTE_ENABLED is set. It imports the common bot
+libraries once and then forks one child per hosted script, so a start skips
+interpreter boot and import time and the preloaded pages are shared
+copy-on-write between all scripts.
+
+Protocol: newline-delimited JSON over a Unix socket.
+  {"cmd": "spawn", "script": ..., "cwd": ..., "log": ..., "limits": {...}, "cgroup_dir": ...}
+      -> {"pid": 1234} or {"error": "..."}
+  {"cmd": "events"}
+      -> the connection stays open and receives {"event": "exit", "pid": ..., "returncode": ...}
+  {"cmd": "ping"}
+      -> {"ok": true, "preloaded": [...]}
+
+Usage: python zygote.py <socket_path> [module ...]
+       python zygote.py --exec <limits json> <cgroup dir or ''> <program> [arg ...]
+The --exec form applies the limits to itself and execs the program; the worker
+agent launches scripts through it because preexec_fn is unsafe in a threaded
+parent.
+"""
+import atexit
+import importlib
+import json
+import os
+import runpy
+import selectors
+import signal
+import socket
+import sys
+import threading
+import traceback
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def apply_limits(limits, cgroup_dir):
+    # Same rules as bot._apply_script_limits; kept here so the zygote never imports bot.py.
+    if cgroup_dir:
+        with open(os.path.join(cgroup_dir, 'cgroup.procs'), 'w') as f:
+            f.write('0')
+    if resource is None:
+        return
+    if limits.get('open_files'):
+        hard = resource.getrlimit(resource.RLIMIT_NOFILE)[1]
+        n = limits['open_files'] if hard == resource.RLIM_INFINITY else min(limits['open_files'], hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (n, n))
+    if not cgroup_dir:
+        if limits.get('memory_mb'):
+            limit_bytes = limits['memory_mb'] * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_DATA, (limit_bytes, limit_bytes))
+        if limits.get('nice'):
+            os.nice(limits['nice'])
+
+
+def exec_with_limits(limits, cgroup_dir, argv):
+    apply_limits(limits, cgroup_dir)
+    os.execv(argv[0], argv)
+
+
+def run_child(request):
+    """Runs in the forked child: become the hosted script and never return."""
+    returncode = 0
+    try:
+        os.setsid()
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        log_fd = os.open(request['log'], os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        null_fd = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(null_fd, 0)
+        os.dup2(log_fd, 1)
+        os.dup2(log_fd, 2)
+        os.closerange(3, 65536)
+        apply_limits(request.get('limits') or {}, request.get('cgroup_dir'))
+        os.chdir(request['cwd'])
+        script = request['script']
+        sys.argv = [script]
+        sys.path[0] = os.path.dirname(os.path.abspath(script))
+        runpy.run_path(script, run_name='__main__')
+    except SystemExit as e:
+        if e.code is None:
+            returncode = 0
+        elif isinstance(e.code, int):
+            returncode = e.code
+        else:
+            print(e.code, file=sys.stderr)
+            returncode = 1
+    except BaseException:
+        traceback.print_exc()
+        returncode = 1
+    finally:
+        # Mirror a normal interpreter exit: wait for non-daemon threads, run atexit hooks.
+        try:
+            threading._shutdown()
+            atexit._run_exitfuncs()
+        except BaseException:
+            traceback.print_exc()
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(returncode)
+
+
+def _send(conn, payload):
+    try:
+        conn.sendall((json.dumps(payload) + '\n').encode('utf-8'))
+        return True
+    except OSError:
+        return False
+
+
+def _read_request(conn):
+    buf = b''
+    while not buf.endswith(b'\n'):
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        buf += chunk
+    return json.loads(buf.decode('utf-8')) if buf.strip() else None
+
+
+def serve(socket_path, modules):
+    preloaded = []
+    for name in modules:
+        try:
+            importlib.import_module(name)
+            preloaded.append(name)
+        except Exception as e:
+            print(f"zygote: could not preload {name}: {e}", file=sys.stderr)
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    os.chmod(socket_path, 0o600)
+    server.listen(64)
+
+    wake_r, wake_w = os.pipe()
+    os.set_blocking(wake_r, False)
+    os.set_blocking(wake_w, False)
+    signal.set_wakeup_fd(wake_w)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    selector = selectors.DefaultSelector()
+    selector.register(server, selectors.EVENT_READ, 'accept')
+    selector.register(wake_r, selectors.EVENT_READ, 'sigchld')
+    subscribers = []
+    parent_pid = os.getppid()
+    print(f"zygote: ready on {socket_path}, preloaded {preloaded}", file=sys.stderr, flush=True)
+
+    while True:
+        for key, _ in selector.select(timeout=5):
+            if key.data == 'sigchld':
+                try:
+                    os.read(wake_r, 4096)
+                except BlockingIOError:
+                    pass
+                while True:
+                    try:
+                        pid, status = os.waitpid(-1, os.WNOHANG)
+                    except ChildProcessError:
+                        break
+                    if pid == 0:
+                        break
+                    event = {'event': 'exit', 'pid': pid, 'returncode': os.waitstatus_to_exitcode(status)}
+                    subscribers = [s for s in subscribers if _send(s, event)]
+            elif key.data == 'accept':
+                conn, _ = server.accept()
+                conn.settimeout(10)
+                try:
+                    request = _read_request(conn)
+                except (OSError, ValueError):
+                    conn.close()
+                    continue
+                if not request:
+                    conn.close()
+                elif request.get('cmd') == 'events':
+                    conn.settimeout(None)
+                    subscribers.append(conn)
+                elif request.get('cmd') == 'ping':
+                    _send(conn, {'ok': True, 'preloaded': preloaded})
+                    conn.close()
+                elif request.get('cmd') == 'spawn':
+                    try:
+                        pid = os.fork()
+                    except OSError as e:
+                        _send(conn, {'error': f"fork failed: {e}"})
+                        conn.close()
+                        continue
+                    if pid == 0:
+                        run_child(request)
+                    _send(conn, {'pid': pid})
+                    conn.close()
+                else:
+                    _send(conn, {'error': f"unknown command {request.get('cmd')!r}"})
+                    conn.close()
+        # Exit with the bot: once it is gone nobody can receive exit events.
+        if os.getppid() != parent_pid:
+            sys.exit(0)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 4 and sys.argv[1] == '--exec':
+        exec_with_limits(json.loads(sys.argv[2]), sys.argv[3] or None, sys.argv[4:])
+    if len(sys.argv) < 2:
+        print(__doc__, file=sys.stderr)
+        sys.exit(2)
+    serve(sys.argv[1], sys.argv[2:])